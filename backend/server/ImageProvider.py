@@ -7,6 +7,7 @@ import ee
 import json
 from typing import List, Dict
 from gee_initializer import GEEInitializer
+from single_flight import SingleFlight
 
 
 class ImageProvider:
@@ -59,9 +60,14 @@ class ImageProvider:
             GEEInitializer.initialize_gee(service_account_key_path)
 
     @classmethod
-    def get_images_from_gee_collection(cls, start_date: str, end_date: str,
-                                       area_of_interest: ee.Geometry,
-                                       service_account_key_path: str = "hack25addcode-3171f61bba2c.json") -> List[Dict]:
+    def list_scenes(cls, start_date: str, end_date: str, area_of_interest: ee.Geometry,
+                    service_account_key_path: str = "hack25addcode-3171f61bba2c.json",
+                    with_footprint: bool = False) -> List[Dict]:
+        """
+        Возвращает метаданные подходящих снимков ({'id', 'date', 'cloud_percentage'})
+        без загрузки самих изображений. С with_footprint=True у каждого снимка есть
+        'footprint' - ограничивающий прямоугольник снимка [min_lon, min_lat, max_lon, max_lat].
+        """
         cls._ensure_gee_initialized(service_account_key_path)
 
         collection = (ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED')
@@ -75,62 +81,100 @@ class ImageProvider:
             raise FileNotFoundError(f"Не найдено снимков за указанный период с облачностью менее {cls.CLOUD_FILTER_PERCENTAGE}%. Попробуйте расширить диапазон дат.")
 
         def get_metadata(image):
-            return ee.Feature(None, {
+            properties = {
                 'id': image.get('system:id'),
                 'date': image.date().format('YYYY-MM-dd'),
                 'cloud_percentage': image.get('CLOUDY_PIXEL_PERCENTAGE')
-            })
+            }
+            if with_footprint:
+                properties['footprint'] = image.geometry().bounds().coordinates().get(0)
+            return ee.Feature(None, properties)
 
         print("Получение списка снимков...")
         metadata_list = collection.map(get_metadata).getInfo()['features']
+        scenes = [metadata['properties'] for metadata in metadata_list]
+        for scene in scenes:
+            if 'footprint' in scene:
+                lons = [point[0] for point in scene['footprint']]
+                lats = [point[1] for point in scene['footprint']]
+                scene['footprint'] = [min(lons), min(lats), max(lons), max(lats)]
+        return scenes
+
+    @classmethod
+    def fetch_scene(cls, scene: Dict, stable_bounds: ee.Geometry, dimensions: int = None) -> Dict:
+        """
+        Загружает один снимок (RGB и NIR) в пределах stable_bounds и извлекает каналы.
+        dimensions - размер большей стороны снимка в пикселях (по умолчанию VIS_DIMS).
+        Одновременные загрузки одного и того же снимка с теми же границами объединяются
+        в одну; массивы результата общие, поэтому изменять их на месте нельзя.
+        """
+        dimensions = dimensions or cls.VIS_DIMS
+        key = (scene['id'], stable_bounds.serialize(), dimensions)
+        result, _ = SingleFlight.group('gee_fetch').do(key, cls._download_scene, scene, stable_bounds, dimensions)
+        return result
+
+    @classmethod
+    def _download_scene(cls, scene: Dict, stable_bounds: ee.Geometry, dimensions: int) -> Dict:
+        image_id = scene['id']
+        image = ee.Image(image_id)
+        clipped_image = image.clip(stable_bounds)
+
+        # <<< --- КЛЮЧЕВОЕ ИЗМЕНЕНИЕ: ЗАМЕНА sampleRectangle НА getThumbURL --- >>>
+        # 1. Получаем RGB изображение для визуализации и каналов R, G, B
+        rgb_params = {**cls.VIS_PARAMS_RGB, 'dimensions': dimensions}
+        rgb_url = clipped_image.getThumbURL(rgb_params)
+        rgb_image = cls._url_to_numpy(rgb_url)
+
+        # 2. Получаем NIR канал как отдельное серое изображение
+        nir_params = {**cls.VIS_PARAMS_NIR, 'dimensions': dimensions}
+        nir_url = clipped_image.getThumbURL(nir_params)
+        nir_image_gray = cls._url_to_numpy(nir_url)
+        
+        # 3. Извлекаем каналы из полученных изображений
+        # GEE масштабирует значения каналов в диапазон 0-255 для getThumbURL.
+        # Для вегетационных индексов, которые являются отношениями (ratio),
+        # это не критично и дает корректный результат.
+        red_channel = rgb_image[:, :, 0].astype(np.float32)
+        green_channel = rgb_image[:, :, 1].astype(np.float32)
+        blue_channel = rgb_image[:, :, 2].astype(np.float32)
+        # Для серого изображения все каналы (R,G,B) одинаковы, берем любой
+        nir_channel = nir_image_gray[:, :, 0].astype(np.float32)
+
+        return {
+            'scene_id': image_id,
+            'date': scene['date'],
+            'cloud_percentage': scene['cloud_percentage'],
+            'rgb_image': rgb_image, # Это уже готовый numpy array
+            'red_channel': red_channel,
+            'green_channel': green_channel,
+            'blue_channel': blue_channel,
+            'nir_channel': nir_channel
+        }
+
+    @classmethod
+    def get_images_from_gee_collection(cls, start_date: str, end_date: str,
+                                       area_of_interest: ee.Geometry,
+                                       service_account_key_path: str = "hack25addcode-3171f61bba2c.json",
+                                       scenes: List[Dict] = None) -> List[Dict]:
+        """
+        Загружает все снимки коллекции. Если список scenes (из list_scenes) уже получен,
+        повторный запрос метаданных не выполняется.
+        """
+        if scenes is None:
+            scenes = cls.list_scenes(start_date, end_date, area_of_interest, service_account_key_path)
+        else:
+            cls._ensure_gee_initialized(service_account_key_path)
 
         processed_images = []
         stable_bounds = area_of_interest.bounds()
 
-        for metadata in metadata_list:
-            props = metadata['properties']
-            image_id = props['id']
-            date = props['date']
-            cloud_percentage = props['cloud_percentage']
-            
-            print(f"Обработка снимка от {date} (облачность: {cloud_percentage:.2f}%)")
+        for scene in scenes:
+            print(f"Обработка снимка от {scene['date']} (облачность: {scene['cloud_percentage']:.2f}%)")
             
             try:
-                image = ee.Image(image_id)
-                clipped_image = image.clip(stable_bounds)
-
-                # <<< --- КЛЮЧЕВОЕ ИЗМЕНЕНИЕ: ЗАМЕНА sampleRectangle НА getThumbURL --- >>>
-                # 1. Получаем RGB изображение для визуализации и каналов R, G, B
-                rgb_params = {**cls.VIS_PARAMS_RGB, 'dimensions': cls.VIS_DIMS}
-                rgb_url = clipped_image.getThumbURL(rgb_params)
-                rgb_image = cls._url_to_numpy(rgb_url)
-
-                # 2. Получаем NIR канал как отдельное серое изображение
-                nir_params = {**cls.VIS_PARAMS_NIR, 'dimensions': cls.VIS_DIMS}
-                nir_url = clipped_image.getThumbURL(nir_params)
-                nir_image_gray = cls._url_to_numpy(nir_url)
-                
-                # 3. Извлекаем каналы из полученных изображений
-                # GEE масштабирует значения каналов в диапазон 0-255 для getThumbURL.
-                # Для вегетационных индексов, которые являются отношениями (ratio),
-                # это не критично и дает корректный результат.
-                red_channel = rgb_image[:, :, 0].astype(np.float32)
-                green_channel = rgb_image[:, :, 1].astype(np.float32)
-                blue_channel = rgb_image[:, :, 2].astype(np.float32)
-                # Для серого изображения все каналы (R,G,B) одинаковы, берем любой
-                nir_channel = nir_image_gray[:, :, 0].astype(np.float32)
-
-                processed_images.append({
-                    'date': date,
-                    'cloud_percentage': cloud_percentage,
-                    'rgb_image': rgb_image, # Это уже готовый numpy array
-                    'red_channel': red_channel,
-                    'green_channel': green_channel,
-                    'blue_channel': blue_channel,
-                    'nir_channel': nir_channel
-                })
+                processed_images.append(cls.fetch_scene(scene, stable_bounds))
             except Exception as e:
-                print(f"Ошибка при обработке снимка {image_id}: {e}. Пропускаем.")
+                print(f"Ошибка при обработке снимка {scene['id']}: {e}. Пропускаем.")
         
         if not processed_images:
             raise FileNotFoundError("Не удалось обработать ни одного снимка. Возможно, все они содержат ошибки или пусты.")
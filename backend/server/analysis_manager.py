@@ -2,17 +2,31 @@
 
 import json
 import time
+import datetime
+import hashlib
+import math
+import threading
 import logging
 from typing import Dict, List, Optional
 from ImageProvider import ImageProvider
 from index_calculator import VegetationIndexCalculator
 from gee_initializer import GEEInitializer
+from zoning import ZoningEngine
+from image_encoder import ImageEncoder
+from worker_pool import WorkerPool
+from renderer import SceneRenderer
+from raster_store import RasterCodec
+from app_config import AppConfig
+from single_flight import SingleFlight
+from aoi_mask import AoiMask
+from memory_budget import MemoryBudget
+from tiles import TileRenderer
+from geotiff import CogWriter
+from change_detection import ChangeDetector
 import numpy as np
+import cv2
 import base64
-from io import BytesIO
-from PIL import Image
 import ee
-import cv2
 
 logger = logging.getLogger(__name__)
 
@@ -22,348 +36,1301 @@ class AnalysisManager:
     Отвечает за получение данных, вычисление индексов, генерацию изображений
     и сохранение результатов в базу данных.
     """
+    # render_mode: 'lazy' - сохраняются только растры и статистика, изображения строятся
+    # при первом запросе; 'eager' - все изображения строятся сразу при анализе.
+    # memory_budget_mb: лимит памяти процесса на все одновременные анализы (None - без лимита), см. MemoryBudget.
+    # batch_resolution_m / batch_max_dimensions: разрешение и наибольший размер окна загрузки пакетного анализа.
+    # progress_save_scenes / progress_save_seconds: как часто сохранять незавершенный анализ - после стольких
+    # новых снимков или через столько секунд после прошлого сохранения, что наступит раньше.
+    DEFAULT_SETTINGS = {'render_mode': 'lazy', 'memoization': True, 'aoi_mask': True, 'memory_budget_mb': 1536,
+                        'batch_resolution_m': 10, 'batch_max_dimensions': 2048,
+                        'progress_save_scenes': 5, 'progress_save_seconds': 10}
+    RENDER_MODES = ('lazy', 'eager')
+    # Размер страницы списка анализов по умолчанию и наибольший допустимый
+    ANALYSIS_LIST_LIMIT = 50
+    ANALYSIS_LIST_MAX_LIMIT = 200
+    # Проекции элементов списка анализов: summary - без геометрии области, bounds - с областью и ее прямоугольником
+    ANALYSIS_LIST_PROJECTIONS = ('summary', 'bounds')
+    # Версия алгоритма анализа: входит в ключ мемоизации, увеличивать при изменении расчетов
+    ANALYSIS_CODE_VERSION = '3'
+    # Слои, которые раньше сохранялись под отдельными ключами результата снимка
+    LEGACY_LAYER_KEYS = {'ndvi_overlay': 'ndvi_overlay_image', 'problem_zones': 'problem_zones_image'}
+    # Последний выданный ID анализа: ID строго возрастают в пределах процесса
+    _last_analysis_id = 0
+    _analysis_id_lock = threading.Lock()
+    # Прозрачный PNG для тайлов вне снимка: кодируется один раз на процесс и отдается без записи в хранилище
+    _empty_tile = None
+
     def __init__(self, db_manager):
         self.db = db_manager
-
-    # --- Методы для работы с данными пользователя в БД ---
-
-    def _get_user_data_object(self, token: str) -> dict:
-        """Вспомогательная функция для получения и парсинга данных пользователя."""
-        data_str = self.db.get_user_data(token)
-        if data_str:
-            try:
-                data_obj = json.loads(data_str)
-                if 'analyses' not in data_obj: data_obj['analyses'] = []
-                if 'saved_fields' not in data_obj: data_obj['saved_fields'] = []
-                return data_obj
-            except json.JSONDecodeError:
-                logger.warning(f"Не удалось распарсить JSON для токена {token}. Возвращаем пустую структуру.")
-                return {'analyses': [], 'saved_fields': []}
-        return {'analyses': [], 'saved_fields': []}
-
-    def _save_user_data_object(self, token: str, data_obj: dict) -> bool:
-        """Вспомогательная функция для сохранения объекта данных пользователя."""
-        try:
-            data_str = json.dumps(data_obj)
-            return self.db.save_user_data(token, data_str)
-        except Exception as e:
-            logger.error(f"Ошибка при сериализации и сохранении данных для токена {token}: {e}")
-            return False
+        self.zoning = ZoningEngine()
+        self.encoder = ImageEncoder()
+        self.settings = AppConfig.get_section('analysis', self.DEFAULT_SETTINGS)
+        # Лимит памяти общий для всех одновременных анализов процесса
+        self.memory_budget = MemoryBudget.shared(self.settings.get('memory_budget_mb'))
+        if AnalysisManager._empty_tile is None:
+            data, media_type = self.encoder.encode(TileRenderer.empty_tile(), 'tile', 'png')
+            AnalysisManager._empty_tile = {'blob_id': hashlib.sha256(data).hexdigest(), 'media_type': media_type, 'data': data}
 
     # --- Методы для вычислений и обработки ---
 
-    def _calculate_zones(self, index_map: np.ndarray, thresholds: Dict[str, List[float]]) -> Dict:
-        """Разделяет карту индекса на зоны и вычисляет их процентное соотношение."""
-        total_pixels = np.count_nonzero(~np.isnan(index_map))
-        if total_pixels == 0:
-            return {'low': 0, 'medium': 0, 'high': 0}
-            
-        zones = {}
-        for zone_name, (lower, upper) in thresholds.items():
-            mask = (index_map >= lower) & (index_map < upper)
-            pixel_count = np.count_nonzero(mask)
-            zones[zone_name] = round((pixel_count / total_pixels) * 100, 2)
-            
-        return zones
+    def _calculate_index_stats(self, values: np.ndarray) -> Dict:
+        """Базовая статистика по валидным значениям индекса."""
+        if values.size == 0:
+            return {'min': 0.0, 'max': 0.0, 'mean': 0.0, 'std': 0.0}
+        return {'min': float(values.min()), 'max': float(values.max()),
+                'mean': float(values.mean()), 'std': float(values.std())}
 
     def _calculate_all_indices(self, calculator: VegetationIndexCalculator) -> Dict:
-        """Вычисляет все вегетационные индексы и их статистику на основе калькулятора."""
+        """Вычисляет все вегетационные индексы, их статистику, зоны и гистограммы."""
+        index_functions = {
+            'ndvi': calculator.calculate_ndvi,
+            'savi': calculator.calculate_savi,
+            'vari': calculator.calculate_vari,
+            'evi': calculator.calculate_evi,
+        }
         indices_data = {}
-        
-        # NDVI
-        ndvi_map = calculator.calculate_ndvi()
-        ndvi_stats = {'min': float(np.nanmin(ndvi_map)), 'max': float(np.nanmax(ndvi_map)), 'mean': float(np.nanmean(ndvi_map)), 'std': float(np.nanstd(ndvi_map))}
-        ndvi_zones = self._calculate_zones(ndvi_map, {'low': [-1, 0.2], 'medium': [0.2, 0.5], 'high': [0.5, 1.01]})
-        indices_data['ndvi'] = {'map': ndvi_map, 'stats': ndvi_stats, 'zones': ndvi_zones}
-        
-        # SAVI
-        savi_map = calculator.calculate_savi()
-        savi_stats = {'min': float(np.nanmin(savi_map)), 'max': float(np.nanmax(savi_map)), 'mean': float(np.nanmean(savi_map)), 'std': float(np.nanstd(savi_map))}
-        indices_data['savi'] = {'map': savi_map, 'stats': savi_stats}
-
-        # VARI
-        vari_map = calculator.calculate_vari()
-        vari_stats = {'min': float(np.nanmin(vari_map)), 'max': float(np.nanmax(vari_map)), 'mean': float(np.nanmean(vari_map)), 'std': float(np.nanstd(vari_map))}
-        indices_data['vari'] = {'map': vari_map, 'stats': vari_stats}
-        
-        # EVI
-        evi_map = calculator.calculate_evi()
-        evi_stats = {'min': float(np.nanmin(evi_map)), 'max': float(np.nanmax(evi_map)), 'mean': float(np.nanmean(evi_map)), 'std': float(np.nanstd(evi_map))}
-        indices_data['evi'] = {'map': evi_map, 'stats': evi_stats}
-        
+        for index_name, calculate in index_functions.items():
+            index_map = calculate()
+            # Значения только внутри маски области; фильтр NaN проходит по ним один раз для статистики и зон
+            values = calculator.index_values[index_name]
+            values = values[np.isfinite(values)]
+            zoning = self.zoning.analyze_values(index_name, values)
+            indices_data[index_name] = {
+                'map': index_map,
+                'stats': self._calculate_index_stats(values),
+                'zones': zoning['zones'],
+                'histogram': zoning['histogram']
+            }
         return indices_data
     
     # --- Методы для генерации изображений ---
+    # Визуализации строит SceneRenderer (uint8-массивы L, RGB или RGBA), кодирование
+    # в конкретный формат выполняет ImageEncoder в пуле потоков.
 
-    def _array_to_base64(self, array: np.ndarray) -> str:
-        """Конвертирует numpy array (карту индекса) в серую base64 строку для отчета."""
-        try:
-            array_min = np.nanmin(array)
-            array_max = np.nanmax(array)
-            if array_max > array_min:
-                normalized = (255 * (array - array_min) / (array_max - array_min))
-            else:
-                normalized = np.zeros_like(array)
-
-            normalized[np.isnan(normalized)] = 0
-            normalized = normalized.astype(np.uint8)
-                
-            image = Image.fromarray(normalized, mode='L').convert('RGB')
-            buffered = BytesIO()
-            image.save(buffered, format="JPEG")
-            return base64.b64encode(buffered.getvalue()).decode()
-        except Exception as e:
-            logger.error(f"Ошибка конвертации массива в base64: {e}")
-            return ""
+    def _encode_and_store_images(self, images: Dict[str, tuple]) -> Dict[str, Optional[Dict]]:
+        """
+        Кодирует изображения параллельно в пуле потоков 'encode' и сохраняет их в хранилище.
+        images: {имя: (uint8 массив, тип выходного изображения для профиля кодирования)}.
+        """
+        pool = WorkerPool.get('encode')
+        futures = {name: pool.submit(self.encoder.encode, array, output_type)
+                   for name, (array, output_type) in images.items()}
+        refs = {}
+        for name, future in futures.items():
+            try:
+                data, media_type = future.result()
+                refs[name] = self._store_image(data, media_type)
+            except Exception as e:
+                logger.error(f"Ошибка кодирования изображения {name}: {e}")
+                refs[name] = None
+        return refs
 
-    # <<< --- НОВЫЙ МЕТОД ДЛЯ RGB --- >>>
-    def _rgb_array_to_base64(self, rgb_array: np.ndarray) -> str:
-        """Конвертирует цветной RGB numpy array в base64 строку."""
-        try:
-            image = Image.fromarray(rgb_array.astype(np.uint8), mode='RGB')
-            buffered = BytesIO()
-            image.save(buffered, format="JPEG")
-            return base64.b64encode(buffered.getvalue()).decode()
-        except Exception as e:
-            logger.error(f"Ошибка конвертации RGB массива в base64: {e}")
+    # --- Методы для хранения изображений вне JSON анализа ---
+
+    def _store_image(self, data: bytes, media_type: str, owner_id: Optional[int] = None) -> Optional[Dict]:
+        """
+        Сохраняет байты изображения в хранилище и возвращает ссылку для JSON анализа.
+        owner_id - для изображения, на которое не будет ссылаться анализ: оно закрепляется
+        за пользователем, чтобы сборка мусора не удалила его (см. DatabaseManager.link_user_blob).
+        """
+        if not data:
+            return None
+        blob_id = self.db.save_blob(data, media_type)
+        if not blob_id:
+            return None
+        if owner_id is not None and not self.db.link_user_blob(owner_id, blob_id):
+            return None
+        return {'blob_id': blob_id, 'media_type': media_type, 'url': f'/api/images/{blob_id}'}
+
+    def _inline_image(self, image_ref, scene_result: Dict):
+        """Заменяет ссылку на изображение base64-строкой (для старых клиентов)."""
+        if not isinstance(image_ref, dict):
+            return image_ref
+        if 'blob_id' in image_ref:
+            blob_id = image_ref['blob_id']
+        elif 'layer' in image_ref:
+            blob_id, _ = self._render_layer_blob(scene_result, image_ref['layer'])
+        else:
             return ""
+        blob = self.db.get_blob(blob_id) if blob_id else None
+        return base64.b64encode(blob[0]).decode() if blob else ""
+
+    def _inline_images(self, analysis_data: Dict) -> Dict:
+        """Возвращает копию анализа, в которой все ссылки на изображения заменены base64."""
+        inlined = dict(analysis_data)
+        inlined_results = []
+        for result in analysis_data.get('results_per_image', []):
+            inlined_result = dict(result)
+            inlined_result['images'] = {name: self._inline_image(ref, result) for name, ref in result.get('images', {}).items()}
+            for key in self.LEGACY_LAYER_KEYS.values():
+                if key in result:
+                    inlined_result[key] = self._inline_image(result[key], result)
+            inlined_results.append(inlined_result)
+        inlined['results_per_image'] = inlined_results
+        return inlined
+
+    # --- Ленивое построение изображений по сохраненным растрам ---
 
-    def _colorize_ndvi(self, ndvi_map: np.ndarray) -> str:
+    def _lazy_image_refs(self, analysis_id: str, scene_index: int) -> Dict:
+        """Ссылки на изображения снимка, которые будут построены при первом запросе."""
+        def ref(layer):
+            return {'layer': layer, 'url': f'/api/analysis/{analysis_id}/scenes/{scene_index}/{layer}'}
+        refs = {'images': {name: ref(name) for name in ('rgb', 'ndvi', 'savi', 'vari', 'evi')}}
+        for layer, key in self.LEGACY_LAYER_KEYS.items():
+            refs[key] = ref(layer)
+        return refs
+
+    def _render_layer_blob(self, scene_result: Dict, layer: str, image_format: Optional[str] = None):
         """
-        Принимает карту NDVI (значения от -1 до 1) и возвращает
-        цветное PNG изображение в формате base64 с альфа-каналом для оверлея.
+        Возвращает (blob_id, media_type) изображения слоя снимка. Готовые изображения
+        (eager-режим) отдаются как есть, остальные строятся по сохраненному растру
+        один раз на (растр, слой, формат) и кэшируются.
         """
-        try:
-            ndvi_map_clipped = np.clip(ndvi_map, 0, 1)
-            normalized = (ndvi_map_clipped * 255).astype(np.uint8)
-            mask_nan = np.isnan(ndvi_map)
-
-            # Создаем кастомную цветовую карту Red -> Yellow -> Green
-            lut = np.zeros((256, 1, 3), dtype=np.uint8)
-            for i in range(256):
-                if i < 128:
-                    lut[i, 0, 0] = 0 # Blue
-                    lut[i, 0, 1] = i * 2 # Green
-                    lut[i, 0, 2] = 255 # Red
-                else:
-                    lut[i, 0, 0] = 0 # Blue
-                    lut[i, 0, 1] = 255 # Green
-                    lut[i, 0, 2] = 255 - (i - 128) * 2 # Red
-            
-            colored_bgr = cv2.LUT(cv2.cvtColor(normalized, cv2.COLOR_GRAY2BGR), lut)
-            bgra = cv2.cvtColor(colored_bgr, cv2.COLOR_BGR2BGRA)
+        stored_ref = scene_result.get('images', {}).get(layer) or scene_result.get(self.LEGACY_LAYER_KEYS.get(layer, ''))
+        if isinstance(stored_ref, dict) and 'blob_id' in stored_ref:
+            if image_format is None or stored_ref['media_type'] == self.encoder.MEDIA_TYPES.get(image_format.lower()):
+                return stored_ref['blob_id'], stored_ref['media_type']
+
+        raster_ref = scene_result.get('raster')
+        if not raster_ref:
+            raise ValueError("Для этого снимка не сохранены растры, построить изображение невозможно.")
+        if layer not in SceneRenderer.available_layers():
+            raise ValueError(f"Неизвестный слой визуализации: {layer}")
 
-            # Устанавливаем прозрачность для NaN значений
-            bgra[:, :, 3] = 255
-            bgra[mask_nan, 3] = 0
+        output_type = SceneRenderer.output_type(layer)
+        resolved_format = self.encoder.get_profile(output_type, image_format)['format']
+        cache_key = f"{raster_ref['blob_id']}:{layer}:{resolved_format}"
+        cached_blob_id = self.db.get_rendered_blob_id(cache_key)
+        if cached_blob_id:
+            return cached_blob_id, self.encoder.MEDIA_TYPES[resolved_format]
 
-            _, buffer = cv2.imencode('.png', bgra)
-            return base64.b64encode(buffer).decode('utf-8')
+        raster_blob = self.db.get_blob(raster_ref['blob_id'])
+        if raster_blob is None:
+            raise ValueError("Растр снимка не найден в хранилище.")
+        rgb_image, index_maps = RasterCodec.unpack(raster_blob[0])
+        rendered = SceneRenderer.render_scene(
+            rgb_image=rgb_image, index_maps=index_maps,
+            stats=scene_result.get('statistics'), layers=[layer],
+            problem_threshold=(self.zoning.get_thresholds('ndvi') or [0.2])[0]
+        )
+        data, media_type = self.encoder.encode(rendered[layer], output_type, resolved_format)
+        blob_id = self.db.save_blob(data, media_type)
+        if blob_id:
+            self.db.save_rendered_blob_id(cache_key, blob_id)
+        return blob_id, media_type
+
+    def render_scene_layer(self, user_id: int, analysis_id: str, scene_index: int, layer: str,
+                           image_format: Optional[str] = None) -> Dict:
+        """Возвращает изображение слоя снимка анализа, строя его при первом запросе."""
+        try:
+            analysis_data = self._load_analysis_data(user_id, analysis_id)
+            if not analysis_data:
+                return {'status': 'error', 'detail': 'Анализ не найден'}
+            results = analysis_data.get('results_per_image', [])
+            if not 0 <= scene_index < len(results):
+                return {'status': 'error', 'detail': 'Снимок с таким номером не найден'}
 
+            blob_id, media_type = self._render_layer_blob(results[scene_index], layer, image_format)
+            if not blob_id:
+                return {'status': 'error', 'detail': 'Не удалось сохранить изображение'}
+            return {'status': 'success', 'blob_id': blob_id, 'media_type': media_type}
+        except ValueError as e:
+            return {'status': 'error', 'detail': str(e)}
         except Exception as e:
-            logger.error(f"Ошибка при раскрашивании NDVI: {e}")
-            return ""
+            logger.error(f"Ошибка построения слоя {layer} анализа {analysis_id}: {e}")
+            return {'status': 'error', 'detail': str(e)}
+
+    # --- Тайлы карты по сохраненным растрам ---
 
-    # <<< --- ИЗМЕНЕННЫЙ МЕТОД --- >>>
-    def _create_problem_zones_image(self, rgb_image: np.ndarray, ndvi_map: np.ndarray, threshold: float = 0.2) -> str:
+    def _tile_layer(self, scene_result: Dict, raster_blob_id: str, layer: str) -> np.ndarray:
+        """RGBA-изображение слоя снимка в разрешении растра, из которого режутся тайлы."""
+        cache_key = f"{raster_blob_id}:{layer}"
+        rgba = TileRenderer.get_layer(cache_key)
+        if rgba is not None:
+            return rgba
+
+        raster_blob = self.db.get_blob(raster_blob_id)
+        if raster_blob is None:
+            raise ValueError("Растр снимка не найден в хранилище.")
+        rgb_image, index_maps = RasterCodec.unpack(raster_blob[0])
+        rendered = SceneRenderer.render_scene(
+            rgb_image=rgb_image, index_maps=index_maps,
+            stats=scene_result.get('statistics'), layers=[layer],
+            problem_threshold=(self.zoning.get_thresholds('ndvi') or [0.2])[0]
+        )
+        # Серые карты индексов не имеют альфа-канала: пиксели без значения (вне поля) делаем прозрачными
+        valid = np.isfinite(index_maps[layer]) if layer in SceneRenderer.INDEX_NAMES else None
+        rgba = TileRenderer.to_rgba(rendered[layer], valid)
+        TileRenderer.put_layer(cache_key, rgba)
+        return rgba
+
+    def render_tile(self, user_id: int, analysis_id: str, scene_index: int, layer: str,
+                    z: int, x: int, y: int) -> Dict:
         """
-        Подсвечивает проблемные зоны (NDVI < threshold) красным цветом
-        на сером фоне оригинального снимка для отчета.
+        Возвращает тайл z/x/y слоя снимка анализа. Тайл строится при первом запросе
+        и кэшируется в хранилище изображений; тайлы вне снимка - общий прозрачный PNG,
+        который отдается готовыми данными (поле data) без обращения к хранилищу.
         """
         try:
-            # Получаем целевые размеры из RGB-изображения
-            h, w = rgb_image.shape[:2]
+            TileRenderer.validate(z, x, y)
+            if layer not in SceneRenderer.available_layers():
+                return {'status': 'error', 'detail': f"Неизвестный слой визуализации: {layer}"}
+            scene_key = (user_id, analysis_id, scene_index)
+            scene = TileRenderer.get_scene(scene_key)
+            if scene is None:
+                analysis_data = self._load_analysis_data(user_id, analysis_id)
+                if not analysis_data:
+                    return {'status': 'error', 'detail': 'Анализ не найден'}
+                results = analysis_data.get('results_per_image', [])
+                if not 0 <= scene_index < len(results):
+                    return {'status': 'error', 'detail': 'Снимок с таким номером не найден'}
 
-            # Изменяем размер карты NDVI, чтобы он соответствовал RGB-изображению
-            # Используем INTER_NEAREST, чтобы избежать создания новых значений NDVI при интерполяции
-            resized_ndvi_map = cv2.resize(ndvi_map, (w, h), interpolation=cv2.INTER_NEAREST)
+                scene_result = results[scene_index]
+                raster_ref = scene_result.get('raster')
+                if not raster_ref:
+                    return {'status': 'error', 'detail': 'Для этого снимка не сохранены растры, построить тайлы невозможно.'}
+                scene = {'raster_blob_id': raster_ref['blob_id'], 'bounds': scene_result['bounds'],
+                         'statistics': scene_result.get('statistics')}
+                TileRenderer.put_scene(scene_key, scene)
 
-            problem_mask = (resized_ndvi_map < threshold) & (~np.isnan(resized_ndvi_map))
-            bgr_image = cv2.cvtColor(rgb_image, cv2.COLOR_RGB2BGR)
-            gray_image = cv2.cvtColor(bgr_image, cv2.COLOR_BGR2GRAY)
-            gray_bgr = cv2.cvtColor(gray_image, cv2.COLOR_GRAY2BGR)
+            if not TileRenderer.intersects(scene['bounds'], z, x, y):
+                return {'status': 'success', **self._empty_tile}
 
-            red_layer = np.zeros_like(gray_bgr)
-            red_layer[:, :] = [0, 0, 255] # BGR -> Red
+            media_type = self.encoder.MEDIA_TYPES['png']
+            cache_key = f"{scene['raster_blob_id']}:tile:{layer}:{z}/{x}/{y}"
+            blob_id = self.db.get_rendered_blob_id(cache_key)
+            if not blob_id:
+                rgba = self._tile_layer(scene, scene['raster_blob_id'], layer)
+                interpolation = cv2.INTER_LINEAR if layer == 'rgb' else cv2.INTER_NEAREST
+                tile = TileRenderer.cut(rgba, scene['bounds'], z, x, y, interpolation)
+                data, media_type = self.encoder.encode(tile, 'tile', 'png')
+                blob_id = self.db.save_blob(data, media_type)
+                if not blob_id:
+                    return {'status': 'error', 'detail': 'Не удалось сохранить тайл'}
+                self.db.save_rendered_blob_id(cache_key, blob_id)
+            return {'status': 'success', 'blob_id': blob_id, 'media_type': media_type}
+        except ValueError as e:
+            return {'status': 'error', 'detail': str(e)}
+        except Exception as e:
+            logger.error(f"Ошибка построения тайла {z}/{x}/{y} слоя {layer} анализа {analysis_id}: {e}")
+            return {'status': 'error', 'detail': str(e)}
 
-            output_image = gray_bgr.copy()
-            if np.any(problem_mask):
-                # Накладываем красный цвет с 40% прозрачностью
-                blended = cv2.addWeighted(gray_bgr[problem_mask], 0.6, red_layer[problem_mask], 0.4, 0)
-                output_image[problem_mask] = blended
+    # --- Экспорт растров индексов ---
 
-            _, buffer = cv2.imencode('.jpg', output_image)
-            return base64.b64encode(buffer).decode('utf-8')
+    def prepare_geotiff_export(self, user_id: int, analysis_id: str, scene_index: int) -> Dict:
+        """
+        Готовит экспорт карт индексов снимка в Cloud-Optimized GeoTIFF. Возвращает
+        CogWriter, из которого файл отдается клиенту по частям, его размер и имя файла.
+        """
+        try:
+            analysis_data = self._load_analysis_data(user_id, analysis_id)
+            if not analysis_data:
+                return {'status': 'error', 'detail': 'Анализ не найден'}
+            results = analysis_data.get('results_per_image', [])
+            if not 0 <= scene_index < len(results):
+                return {'status': 'error', 'detail': 'Снимок с таким номером не найден'}
 
-        except Exception as e:
-            logger.error(f"Ошибка при создании карты проблемных зон: {e}")
-            return ""
+            scene_result = results[scene_index]
+            raster_ref = scene_result.get('raster')
+            if not raster_ref:
+                return {'status': 'error', 'detail': 'Для этого снимка не сохранены растры, экспорт невозможен.'}
+            raster_blob = self.db.get_blob(raster_ref['blob_id'])
+            if raster_blob is None:
+                return {'status': 'error', 'detail': 'Растр снимка не найден в хранилище.'}
 
+            _, index_maps = RasterCodec.unpack(raster_blob[0])
+            metadata = {'analysis_id': analysis_id, 'scene_id': scene_result.get('scene_id', ''),
+                        'date': scene_result.get('date', ''), 'cloud_coverage': scene_result.get('cloud_coverage', '')}
+            writer = CogWriter(index_maps, RasterCodec.INDEX_NAMES, scene_result['bounds'], metadata)
+            return {
+                'status': 'success',
+                'writer': writer,
+                'content_length': writer.content_length(),
+                'filename': f"analysis_{analysis_id}_scene_{scene_index}_{scene_result.get('date', '')}.tif",
+            }
+        except ValueError as e:
+            return {'status': 'error', 'detail': str(e)}
+        except Exception as e:
+            logger.error(f"Ошибка подготовки экспорта GeoTIFF снимка {scene_index} анализа {analysis_id}: {e}")
+            return {'status': 'error', 'detail': str(e)}
 
     # --- Методы для работы с полными данными анализа ---
 
-    def _save_analysis_data(self, token: str, analysis_id: str, analysis_data: Dict) -> bool:
-        """Сохраняет ПОЛНЫЕ данные анализа (включая изображения) в базу данных."""
+    def _save_analysis_data(self, user_id: int, analysis_id: str, analysis_data: Dict) -> bool:
+        """Сохраняет ПОЛНЫЕ данные анализа (включая изображения) в базу данных вместе с краткой сводкой."""
         try:
             analysis_data_serialized = json.dumps(analysis_data, default=str)
-            return self.db.save_analysis_data(token, analysis_id, analysis_data_serialized)
+            summary = self._summary_row(self._build_summary(analysis_data))
+            return self.db.save_analysis_data(user_id, analysis_id, analysis_data_serialized, summary)
         except Exception as e:
             logger.error(f"Ошибка сохранения анализа: {e}")
             return False
     
-    def _load_analysis_data(self, token: str, analysis_id: str) -> Optional[Dict]:
+    def _load_analysis_data(self, user_id: int, analysis_id: str) -> Optional[Dict]:
         """Загружает данные анализа из базы данных."""
         try:
-            data = self.db.get_analysis_data(token, analysis_id)
+            data = self.db.get_analysis_data(user_id, analysis_id)
             if data: return json.loads(data)
             return None
         except Exception as e:
             logger.error(f"Ошибка загрузки анализа: {e}")
             return None
     
+    # --- Краткие сводки анализов ---
+    # Рекомендациям, списку анализов и дашбордам нужны только средние индексов и статистика
+    # снимков; сводка сохраняется вместе с анализом, чтобы не загружать и не разбирать его JSON.
+
+    def _build_summary(self, analysis_data: Dict) -> Dict:
+        results = analysis_data.get('results_per_image', [])
+        averages = {}
+        for index_name in RasterCodec.INDEX_NAMES:
+            means = [r['statistics'][index_name]['mean'] for r in results if index_name in r.get('statistics', {})]
+            if means:
+                averages[index_name] = sum(means) / len(means)
+        return {
+            'analysis_id': analysis_data.get('analysis_id'),
+            'created_at': analysis_data.get('timestamp'),
+            'date_range': analysis_data.get('date_range', {}),
+            'area_of_interest': analysis_data.get('area_of_interest'),
+            'image_count': analysis_data.get('image_count', len(results)),
+            'status': analysis_data.get('metadata', {}).get('status', 'completed'),
+            'averages': averages,
+            'scenes': [{'scene_id': r.get('scene_id'), 'date': r.get('date'), 'cloud_coverage': r.get('cloud_coverage'),
+                        'statistics': r.get('statistics', {})} for r in results],
+        }
+
+    @staticmethod
+    def _summary_row(summary: Dict) -> Dict:
+        """Сводка в формате DatabaseManager.save_analysis_summary."""
+        return {
+            'created_at': summary['created_at'],
+            'date_start': summary['date_range'].get('start'),
+            'date_end': summary['date_range'].get('end'),
+            'image_count': summary['image_count'],
+            'status': summary['status'],
+            'averages': summary['averages'],
+            'area_of_interest': json.dumps(summary['area_of_interest']),
+            'scene_stats': json.dumps(summary['scenes']),
+            'bbox': AnalysisManager._area_bbox(summary['area_of_interest']),
+        }
+
+    @staticmethod
+    def _area_bbox(area_info: Optional[Dict]) -> Optional[List[float]]:
+        try:
+            return AoiMask.bbox(area_info) if area_info else None
+        except (KeyError, TypeError, ValueError, IndexError):
+            return None
+
+    @staticmethod
+    def _summary_from_row(row: Dict) -> Dict:
+        return {
+            'analysis_id': row['analysis_id'],
+            'created_at': row['created_at'],
+            'date_range': {'start': row['date_start'], 'end': row['date_end']},
+            'area_of_interest': json.loads(row['area_of_interest']) if row['area_of_interest'] else None,
+            'image_count': row['image_count'],
+            'status': row['status'],
+            'averages': row['averages'],
+            'scenes': json.loads(row['scene_stats']) if row['scene_stats'] else [],
+        }
+
+    def get_analysis_summary(self, user_id: int, analysis_id: str) -> Dict:
+        """
+        Возвращает сводку анализа без загрузки его данных. Для анализов, сохраненных
+        до появления сводок, она один раз строится по полным данным и сохраняется.
+        """
+        try:
+            row = self.db.get_analysis_summary(user_id, analysis_id)
+            # У сводок, перенесенных из старого списка анализов, нет статистики снимков
+            if row and row['scene_stats'] is not None:
+                return {'status': 'success', 'summary': self._summary_from_row(row)}
+
+            analysis_data = self._load_analysis_data(user_id, analysis_id)
+            if not analysis_data:
+                return {'status': 'error', 'detail': 'Анализ не найден'}
+            summary = self._build_summary(analysis_data)
+            self.db.save_analysis_summary(user_id, analysis_id, self._summary_row(summary))
+            logger.info(f"Построена сводка для ранее сохраненного анализа {analysis_id}")
+            return {'status': 'success', 'summary': summary}
+        except Exception as e:
+            logger.error(f"Ошибка получения сводки анализа {analysis_id}: {e}")
+            return {'status': 'error', 'detail': str(e)}
+
+    @staticmethod
+    def _list_entry(row: Dict, projection: str = 'bounds') -> Dict:
+        """Элемент списка анализов пользователя по строке сводки."""
+        entry = {
+            'analysis_id': row['analysis_id'],
+            'timestamp': row['created_at'],
+            'date_range': {'start': row['date_start'], 'end': row['date_end']},
+            'image_count': row['image_count'],
+            'statistics_summary': {f'{name}_mean': row['averages'].get(name, 0) for name in RasterCodec.INDEX_NAMES},
+        }
+        if projection == 'bounds':
+            entry['area_of_interest'] = json.loads(row['area_of_interest']) if row['area_of_interest'] else None
+            entry['bbox'] = row['bbox']
+        return entry
+
+    @staticmethod
+    def _encode_list_cursor(row: Dict) -> str:
+        """Непрозрачный курсор страницы: ключ сортировки последнего элемента."""
+        raw = json.dumps([row['created_at'], row['analysis_id']]).encode('utf-8')
+        return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+    @staticmethod
+    def _decode_list_cursor(cursor: str):
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            created_at, analysis_id = json.loads(raw)
+            return float(created_at), str(analysis_id)
+        except (ValueError, TypeError):
+            raise ValueError("Неверный курсор списка анализов")
+
+    def list_analyses(self, user_id: int, limit: Optional[int] = None, cursor: Optional[str] = None,
+                      date_from: Optional[str] = None, date_to: Optional[str] = None,
+                      bbox: Optional[List[float]] = None, projection: str = 'bounds') -> Dict:
+        """
+        Страница списка завершенных анализов пользователя (по таблице сводок), от новых к старым.
+        next_cursor - курсор следующей страницы или None, если это последняя страница.
+        Фильтры: date_from/date_to - период анализа пересекается с интервалом,
+        bbox [min_lon, min_lat, max_lon, max_lat] - область анализа пересекается с прямоугольником.
+        """
+        try:
+            limit = self.ANALYSIS_LIST_LIMIT if limit is None else int(limit)
+            if not 1 <= limit <= self.ANALYSIS_LIST_MAX_LIMIT:
+                raise ValueError(f"Размер страницы должен быть от 1 до {self.ANALYSIS_LIST_MAX_LIMIT}")
+            if projection not in self.ANALYSIS_LIST_PROJECTIONS:
+                raise ValueError(f"Неизвестная проекция списка: {projection}")
+            if bbox is not None:
+                bbox = [float(value) for value in bbox]
+                if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+                    raise ValueError("bbox должен быть задан как min_lon,min_lat,max_lon,max_lat")
+            for date in (date_from, date_to):
+                if date is not None:
+                    try:
+                        datetime.date.fromisoformat(date)
+                    except ValueError:
+                        raise ValueError(f"Неверная дата: {date}, ожидается YYYY-MM-DD")
+            after = self._decode_list_cursor(cursor) if cursor else None
+
+            # Лишняя строка показывает, есть ли следующая страница
+            rows = self.db.list_analysis_summaries(user_id, limit=limit + 1, after=after,
+                                                   date_from=date_from, date_to=date_to, bbox=bbox)
+            if rows is None:
+                return {'status': 'error', 'detail': 'Не удалось получить список анализов'}
+            page = rows[:limit]
+            next_cursor = self._encode_list_cursor(page[-1]) if len(rows) > limit else None
+            return {'status': 'success', 'analyses': [self._list_entry(row, projection) for row in page],
+                    'next_cursor': next_cursor}
+        except ValueError as e:
+            return {'status': 'error', 'detail': str(e)}
+        except Exception as e:
+            logger.error(f"Ошибка получения списка анализов: {e}")
+            return {'status': 'error', 'detail': str(e)}
+
+    # --- Мемоизация одинаковых запросов анализа ---
+
+    def _new_analysis_id(self) -> str:
+        """
+        ID анализа по времени в миллисекундах, чтобы анализы одной секунды не перезаписывали друг друга.
+        Анализы, созданные в одну миллисекунду (поля пакетного анализа), получают следующие свободные значения.
+        """
+        with AnalysisManager._analysis_id_lock:
+            analysis_id = max(int(time.time() * 1000), AnalysisManager._last_analysis_id + 1)
+            AnalysisManager._last_analysis_id = analysis_id
+        return str(analysis_id)
+
+    def _normalize_area(self, area_info: Dict) -> Dict:
+        """Каноническое представление области: округленные координаты, полигон без замыкающей точки."""
+        if area_info.get('type') == 'polygon':
+            coords = [[round(float(lon), 6), round(float(lat), 6)] for lon, lat in area_info['coordinates']]
+            if len(coords) > 1 and coords[0] == coords[-1]:
+                coords = coords[:-1]
+            return {'type': 'polygon', 'coordinates': coords}
+        return {'type': 'point_radius', 'lon': round(float(area_info['lon']), 6),
+                'lat': round(float(area_info['lat']), 6), 'radius_km': round(float(area_info['radius_km']), 6)}
+
+    def _analysis_memo_key(self, area_info: Dict, start_date: str, end_date: str, render_mode: str,
+                           grid: Optional[str] = None) -> str:
+        """
+        Хэш всех входных данных, от которых зависит сохраненный результат анализа.
+        grid - сетка снимков, если она отличается от стандартной (пакетный анализ).
+        """
+        canonical = {
+            'area': self._normalize_area(area_info),
+            'date_range': [start_date, end_date],
+            'options': {
+                'render_mode': render_mode,
+                'aoi_mask': bool(self.settings.get('aoi_mask', True)),
+                'zoning': {name: [zone['thresholds'].tolist(), zone['labels']] for name, zone in self.zoning.zones.items()},
+                'histogram': [self.zoning.histogram_bins, self.zoning.histogram_ranges],
+            },
+            'code_version': self.ANALYSIS_CODE_VERSION,
+        }
+        if grid is not None:
+            canonical['options']['grid'] = grid
+        return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode()).hexdigest()
+
+    def _get_memoized_analysis(self, user_id: int, memo_key: str, scene_ids: List[str]) -> Optional[Dict]:
+        """
+        Возвращает готовый анализ, если он выполнялся с теми же входными данными по тому же набору снимков.
+        Чужой анализ клонируется в список вызывающего пользователя (изображения и растры общие).
+        """
+        memo = self.db.get_analysis_memo(memo_key)
+        if not memo or json.loads(memo['scene_ids']) != scene_ids:
+            return None
+
+        analysis_data = json.loads(memo['data'])
+        if memo['user_id'] == user_id:
+            logger.info(f"Повторный запрос анализа: возвращается сохраненный анализ {memo['analysis_id']}")
+            return {'status': 'success', 'analysis_id': memo['analysis_id'], 'data': analysis_data, 'memoized': True}
+
+        return self._clone_analysis(user_id, memo['analysis_id'], analysis_data)
+
+    def _clone_analysis(self, user_id: int, source_id: str, analysis_data: Dict) -> Optional[Dict]:
+        """Сохраняет копию чужого анализа в список пользователя под новым идентификатором."""
+        analysis_id = self._new_analysis_id()
+        analysis_data['analysis_id'] = analysis_id
+        analysis_data['timestamp'] = time.time()
+        for scene_index, result in enumerate(analysis_data.get('results_per_image', [])):
+            if any(isinstance(ref, dict) and 'layer' in ref for ref in result.get('images', {}).values()):
+                result.update(self._lazy_image_refs(analysis_id, scene_index))
+
+        if not self._save_analysis_data(user_id, analysis_id, analysis_data):
+            return None
+        logger.info(f"Анализ {source_id} склонирован пользователю как {analysis_id}")
+        return {'status': 'success', 'analysis_id': analysis_id, 'data': analysis_data, 'memoized': True}
+
+    def _shared_analysis(self, user_id: int, owner_id: Optional[int], result: Dict) -> Dict:
+        """
+        Результат, полученный от параллельного одинакового запроса. Берется сам ответ ведущего
+        запроса, а не запись мемоизации: ее может не быть (например, при уменьшенном разрешении).
+        Другому пользователю анализ клонируется так же, как при мемоизации.
+        """
+        analysis_data = json.loads(json.dumps(result['data']))
+        if owner_id == user_id:
+            return {**result, 'data': analysis_data, 'coalesced': True}
+        cloned = self._clone_analysis(user_id, result['analysis_id'], analysis_data)
+        if cloned is None:
+            raise Exception("Не удалось получить результат параллельного анализа")
+        cloned['coalesced'] = True
+        return cloned
+
     # --- Основной публичный метод ---
 
-    def perform_complete_analysis(self, token: str, start_date: str, end_date: str, 
+    def _area_from_request(self, lon: Optional[float], lat: Optional[float], radius_km: float,
+                           polygon_coords: Optional[List[List[float]]]) -> Dict:
+        """Описание области анализа из параметров запроса."""
+        if polygon_coords:
+            logger.info(f"Запуск анализа коллекции для полигона...")
+            return {'type': 'polygon', 'coordinates': polygon_coords}
+        if lon is not None and lat is not None:
+            logger.info(f"Запуск анализа коллекции для: {lon}, {lat} с радиусом {radius_km} км")
+            return {'type': 'point_radius', 'lon': lon, 'lat': lat, 'radius_km': radius_km}
+        raise ValueError("Не указана область для анализа (ни точка с радиусом, ни полигон).")
+
+    def _area_geometry(self, area_info: Dict) -> ee.Geometry:
+        """Геометрия GEE по описанию области (как оно хранится в анализе)."""
+        if area_info['type'] == 'polygon':
+            return ee.Geometry.Polygon(area_info['coordinates'])
+        point = ee.Geometry.Point([area_info['lon'], area_info['lat']])
+        return point.buffer(area_info['radius_km'] * 1000)
+
+    def _prepare_analysis(self, user_id: int, start_date: str, end_date: str,
+                          lon: Optional[float], lat: Optional[float], radius_km: float,
+                          polygon_coords: Optional[List[List[float]]], render_mode: Optional[str],
+                          base_analysis_id: Optional[str]) -> Dict:
+        """Общая подготовка анализа: область, режим построения изображений, список снимков и ключ мемоизации."""
+        base_analysis = None
+        if base_analysis_id:
+            base_analysis = self._load_analysis_data(user_id, base_analysis_id)
+            if not base_analysis:
+                raise ValueError("Базовый анализ не найден")
+            base_render_mode = base_analysis.get('metadata', {}).get('render_mode', 'eager')
+            if render_mode and render_mode != base_render_mode:
+                raise ValueError("Режим построения изображений расширения должен совпадать с режимом базового анализа.")
+            render_mode = base_render_mode
+            area_info = base_analysis['area_of_interest']
+            logger.info(f"Расширение анализа {base_analysis_id} на период {start_date} - {end_date}")
+        else:
+            area_info = self._area_from_request(lon, lat, radius_km, polygon_coords)
+
+        render_mode = render_mode or self.settings['render_mode']
+        if render_mode not in self.RENDER_MODES:
+            raise ValueError(f"Неизвестный режим построения изображений: {render_mode}")
+
+        GEEInitializer.initialize_gee()
+        area_of_interest = self._area_geometry(area_info)
+
+        # Список снимков - дешевый запрос метаданных; по нему проверяем, не появились ли новые снимки
+        scenes = ImageProvider.list_scenes(start_date, end_date, area_of_interest)
+        return {
+            'area_info': area_info,
+            'area_of_interest': area_of_interest,
+            'render_mode': render_mode,
+            'base_analysis': base_analysis,
+            'scenes': sorted(scenes, key=lambda scene: (scene['date'], scene['id'])),
+            'scene_ids': sorted(scene['id'] for scene in scenes),
+            'memo_key': self._analysis_memo_key(area_info, start_date, end_date, render_mode),
+        }
+
+    def perform_complete_analysis(self, user_id: int, start_date: str, end_date: str, 
                                 lon: Optional[float] = None, lat: Optional[float] = None, 
                                 radius_km: float = 0.5, 
-                                polygon_coords: Optional[List[List[float]]] = None) -> Dict:
+                                polygon_coords: Optional[List[List[float]]] = None,
+                                inline_images: bool = False,
+                                render_mode: Optional[str] = None,
+                                use_cache: bool = True,
+                                base_analysis_id: Optional[str] = None) -> Dict:
         """
         Выполняет полный цикл анализа: получает снимки, рассчитывает индексы,
-        генерирует все необходимые изображения и сохраняет результат.
+        сохраняет компактные растры и статистику, а в режиме 'eager' - и все изображения.
+        Изображения хранятся отдельно от JSON анализа, в результате - только ссылки на них
+        (или base64, если inline_images=True).
+        Если такой же анализ (та же область, период и настройки) уже выполнялся и новых
+        снимков не появилось, возвращается готовый результат (use_cache=False отключает это).
+        Если указан base_analysis_id, анализ строится как расширение сохраненного анализа
+        на новый период: область и режим берутся из него, а загружаются и рассчитываются
+        только снимки, которых в нем нет.
         """
         try:
-            GEEInitializer.initialize_gee()
-            
-            area_info = {}
-            area_of_interest = None
-            if polygon_coords:
-                area_info = {'type': 'polygon', 'coordinates': polygon_coords}
-                area_of_interest = ee.Geometry.Polygon(polygon_coords)
-                logger.info(f"Запуск анализа коллекции для полигона...")
-            elif lon is not None and lat is not None:
-                area_info = {'type': 'point_radius', 'lon': lon, 'lat': lat, 'radius_km': radius_km}
-                point = ee.Geometry.Point([lon, lat])
-                area_of_interest = point.buffer(radius_km * 1000)
-                logger.info(f"Запуск анализа коллекции для: {lon}, {lat} с радиусом {radius_km} км")
+            context = self._prepare_analysis(user_id, start_date, end_date, lon, lat, radius_km,
+                                             polygon_coords, render_mode, base_analysis_id)
+            memo_key, scene_ids = context['memo_key'], context['scene_ids']
+            if use_cache and self.settings.get('memoization', True):
+                memoized = self._get_memoized_analysis(user_id, memo_key, scene_ids)
+                if memoized:
+                    if inline_images:
+                        memoized['data'] = self._inline_images(memoized['data'])
+                    return memoized
+
+            # Одновременные одинаковые запросы выполняются один раз, остальные получают общий результат
+            (owner_id, result), shared = SingleFlight.group('analysis').do(
+                (memo_key, tuple(scene_ids)), self._run_owned_analysis, user_id, context, start_date, end_date
+            )
+            if shared and result.get('status') == 'success':
+                result = self._shared_analysis(user_id, owner_id, result)
+            if inline_images and result.get('status') == 'success':
+                result = {**result, 'data': self._inline_images(result['data'])}
+            return result
+
+        except Exception as e:
+            logger.error(f"Ошибка при выполнении анализа коллекции: {e}")
+            return {'status': 'error', 'detail': str(e)}
+
+    def stream_complete_analysis(self, user_id: int, start_date: str, end_date: str,
+                                 lon: Optional[float] = None, lat: Optional[float] = None,
+                                 radius_km: float = 0.5,
+                                 polygon_coords: Optional[List[List[float]]] = None,
+                                 render_mode: Optional[str] = None,
+                                 use_cache: bool = True,
+                                 base_analysis_id: Optional[str] = None):
+        """
+        То же, что perform_complete_analysis, но в виде генератора событий:
+            {'event': 'started', 'analysis_id', 'total_scenes'}
+            {'event': 'scene', 'scene_index', 'processed', 'total_scenes', 'result'} - готовый снимок
+            {'event': 'scene_skipped', 'scene_id', 'date', 'processed', 'total_scenes', 'detail'}
+            {'event': 'completed', 'status': 'success', 'analysis_id', 'data'}
+            {'event': 'error', 'status': 'error', 'detail'}
+        Незавершенный анализ периодически сохраняется (см. progress_save_scenes), и событие
+        'scene' отдается только после сохранения, включающего этот снимок: к этому моменту
+        снимок доступен по analysis_id, а его изображения - по ссылкам.
+        """
+        try:
+            context = self._prepare_analysis(user_id, start_date, end_date, lon, lat, radius_km,
+                                             polygon_coords, render_mode, base_analysis_id)
+            if use_cache and self.settings.get('memoization', True):
+                memoized = self._get_memoized_analysis(user_id, context['memo_key'], context['scene_ids'])
+                if memoized:
+                    yield {'event': 'completed', **memoized}
+                    return
+            yield from self._iter_analysis(user_id, context, start_date, end_date)
+        except Exception as e:
+            logger.error(f"Ошибка при выполнении анализа коллекции: {e}")
+            yield {'event': 'error', 'status': 'error', 'detail': str(e)}
+
+    def _base_results_by_scene(self, base_analysis: Dict, scenes: List[Dict]) -> Dict[str, Dict]:
+        """
+        Находит снимки периода, уже рассчитанные в базовом анализе: {ID снимка: результат}.
+        Снимки сопоставляются по ID, а для анализов, сохраненных до появления ID снимка, - по дате.
+        """
+        base_by_id = {}
+        base_by_date = {}
+        for result in base_analysis.get('results_per_image', []):
+            if 'scene_id' in result:
+                base_by_id[result['scene_id']] = result
             else:
-                raise ValueError("Не указана область для анализа (ни точка с радиусом, ни полигон).")
+                base_by_date[result['date']] = result
 
-            bounds_coords_list = area_of_interest.bounds().coordinates().get(0).getInfo()
-            bounds_for_leaflet = [[bounds_coords_list[0][1], bounds_coords_list[0][0]], [bounds_coords_list[2][1], bounds_coords_list[2][0]]]
+        reused = {}
+        for scene in scenes:
+            result = base_by_id.get(scene['id']) or base_by_date.pop(scene['date'], None)
+            if result is not None:
+                reused[scene['id']] = {**result, 'scene_id': scene['id']}
+        return reused
 
-            image_data_list = ImageProvider.get_images_from_gee_collection(
-                start_date=start_date, end_date=end_date,
-                area_of_interest=area_of_interest
-            )
-            
-            all_results = []
-            
-            for image_data in image_data_list:
-                calculator = VegetationIndexCalculator(
-                    rgb_image=image_data['rgb_image'], red_channel=image_data['red_channel'],
-                    green_channel=image_data['green_channel'], blue_channel=image_data['blue_channel'],
-                    nir_channel=image_data['nir_channel']
-                )
-                
-                indices = self._calculate_all_indices(calculator)
-                
-                colored_ndvi_base64 = self._colorize_ndvi(indices['ndvi']['map'])
-                problem_zones_base64 = self._create_problem_zones_image(
-                    rgb_image=image_data['rgb_image'],
-                    ndvi_map=indices['ndvi']['map']
-                )
-                
-                single_image_result = {
-                    'date': image_data['date'],
-                    'cloud_coverage': image_data['cloud_percentage'],
-                    'images': {
-                        # <<< --- ИЗМЕНЕНИЕ: Используем правильную функцию для RGB --- >>>
-                        'rgb': self._rgb_array_to_base64(image_data['rgb_image']),
-                        'ndvi': self._array_to_base64(indices['ndvi']['map']),
-                        'savi': self._array_to_base64(indices['savi']['map']),
-                        'vari': self._array_to_base64(indices['vari']['map']),
-                        'evi': self._array_to_base64(indices['evi']['map'])
-                    },
-                    'ndvi_overlay_image': colored_ndvi_base64,
-                    'problem_zones_image': problem_zones_base64,
-                    'bounds': bounds_for_leaflet,
-                    'statistics': {
-                        'ndvi': indices['ndvi']['stats'],
-                        'savi': indices['savi']['stats'],
-                        'vari': indices['vari']['stats'],
-                        'evi': indices['evi']['stats']
-                    },
-                    'zoning': {
-                        'ndvi': indices['ndvi']['zones']
-                    }
-                }
+    def _run_analysis(self, user_id: int, context: Dict, start_date: str, end_date: str,
+                      internal: bool = False) -> Dict:
+        """Выполняет анализ целиком. Возвращает ответ без встроенных изображений."""
+        for event in self._iter_analysis(user_id, context, start_date, end_date, internal=internal):
+            if event['event'] == 'completed':
+                return {key: value for key, value in event.items() if key != 'event'}
+        raise Exception("Анализ завершился без результата")
+
+    def _run_owned_analysis(self, user_id: int, context: Dict, start_date: str, end_date: str):
+        """_run_analysis вместе с пользователем, в чей список сохранен анализ."""
+        return user_id, self._run_analysis(user_id, context, start_date, end_date)
+
+    def _iter_analysis(self, user_id: int, context: Dict, start_date: str, end_date: str, internal: bool = False):
+        """
+        Загружает и обрабатывает снимки по одному в порядке дат. Незавершенный анализ сохраняется
+        раз в progress_save_scenes снимков или progress_save_seconds секунд (каждое сохранение
+        записывает анализ целиком), события 'scene' копятся до ближайшего сохранения.
+        Порядок снимков окончательный сразу, поэтому номера снимков в ссылках
+        ленивого режима не меняются до конца анализа.
+        internal=True - служебный анализ (см. _scene_for_date): со статусом 'internal' с самого
+        начала, поэтому он не попадает в список анализов и не учитывается в квотах.
+        """
+        render_mode = context['render_mode']
+        scenes = context['scenes']
+        base_analysis = context['base_analysis']
+        area_of_interest = context['area_of_interest']
+
+        analysis_id = self._new_analysis_id()
+        all_results = []
+        metadata = { 'resolution': '10m', 'source': 'Sentinel-2', 'render_mode': render_mode,
+                     'status': 'internal' if internal else 'in_progress' }
+        reused = {}
+        if base_analysis is not None:
+            reused = self._base_results_by_scene(base_analysis, scenes)
+            metadata.update({
+                'base_analysis_id': base_analysis['analysis_id'],
+                'reused_scenes': len(reused),
+                'new_scenes': len(scenes) - len(reused)
+            })
+            logger.info(f"Из базового анализа взято снимков: {len(reused)}, новых снимков: {len(scenes) - len(reused)}")
+        analysis_data_response = {
+            'analysis_id': analysis_id,
+            'timestamp': time.time(),
+            'area_of_interest': context['area_info'],
+            'date_range': {'start': start_date, 'end': end_date},
+            'image_count': 0,
+            'results_per_image': all_results,
+            'metadata': metadata
+        }
+        yield {'event': 'started', 'analysis_id': analysis_id, 'total_scenes': len(scenes)}
+
+        stable_bounds = area_of_interest.bounds()
+        bounds_for_leaflet = None
+        budget = self.memory_budget
+        save_every = max(1, int(self.settings.get('progress_save_scenes') or 1))
+        save_seconds = float(self.settings.get('progress_save_seconds') or 0)
+        # События снимков, еще не попавших в сохраненный анализ
+        pending_events = []
+        last_save = time.monotonic()
+        try:
+            for position, scene in enumerate(scenes):
+                single_image_result = reused.get(scene['id'])
+                if single_image_result is None:
+                    if bounds_for_leaflet is None:
+                        bounds_coords_list = stable_bounds.coordinates().get(0).getInfo()
+                        bounds_for_leaflet = [[bounds_coords_list[0][1], bounds_coords_list[0][0]], [bounds_coords_list[2][1], bounds_coords_list[2][0]]]
+                    logger.info(f"Обработка снимка от {scene['date']} (облачность: {scene['cloud_percentage']:.2f}%)")
+                    reserved_mb = 0.0
+                    try:
+                        # Снимки обрабатываются строго по одному; память на снимок резервируется в общем
+                        # бюджете процесса, и если он не помещается, запрашивается в уменьшенном разрешении
+                        scale, reserved_mb = budget.reserve(ImageProvider.VIS_DIMS ** 2)
+                        dimensions = max(1, int(ImageProvider.VIS_DIMS * scale))
+                        image_data = ImageProvider.fetch_scene(scene, stable_bounds, dimensions=dimensions)
+                    except Exception as e:
+                        budget.release(reserved_mb)
+                        logger.warning(f"Ошибка при обработке снимка {scene['id']}: {e}. Пропускаем.")
+                        skipped_event = {'event': 'scene_skipped', 'scene_id': scene['id'], 'date': scene['date'],
+                                         'processed': position + 1, 'total_scenes': len(scenes), 'detail': str(e)}
+                        # Не обгоняем события еще не сохраненных снимков, чтобы processed не убывал
+                        if pending_events:
+                            pending_events.append(skipped_event)
+                        else:
+                            yield skipped_event
+                        continue
+                    try:
+                        single_image_result = self._process_scene(image_data, bounds_for_leaflet, render_mode,
+                                                                  context['area_info'])
+                        # Массивы снимка больше не нужны: растр и изображения уже сохранены
+                        del image_data
+                    finally:
+                        budget.release(reserved_mb)
+                    if scale < 1.0:
+                        single_image_result['resolution_scale'] = round(scale, 3)
+
+                scene_index = len(all_results)
+                if render_mode == 'lazy':
+                    single_image_result.update(self._lazy_image_refs(analysis_id, scene_index))
                 all_results.append(single_image_result)
+                analysis_data_response['image_count'] = len(all_results)
+                pending_events.append({'event': 'scene', 'scene_index': scene_index, 'processed': position + 1,
+                                       'total_scenes': len(scenes), 'result': single_image_result})
+                unsaved = sum(1 for event in pending_events if event['event'] == 'scene')
+                if unsaved >= save_every or time.monotonic() - last_save >= save_seconds:
+                    # Промежуточное сохранение: готовые снимки доступны по ID анализа, пока обрабатываются
+                    # остальные. Каждое сохранение пишет анализ целиком, поэтому оно не делается на каждый снимок
+                    if not self._save_analysis_data(user_id, analysis_id, analysis_data_response):
+                        raise Exception("Не удалось сохранить промежуточный результат анализа")
+                    last_save = time.monotonic()
+                    yield from pending_events
+                    pending_events = []
 
-            analysis_id = str(int(time.time()))
-            all_results.sort(key=lambda x: x['date'])
-            analysis_data_response = {
-                'analysis_id': analysis_id,
-                'timestamp': time.time(),
-                'area_of_interest': area_info,
-                'date_range': {'start': start_date, 'end': end_date},
-                'image_count': len(all_results),
-                'results_per_image': all_results,
-                'metadata': { 'resolution': '10m', 'source': 'Sentinel-2' }
-            }
-            
-            if self._save_analysis_data(token, analysis_id, analysis_data_response):
-                self._update_user_analyses_list(token, analysis_id, analysis_data_response)
-                logger.info(f"Анализ коллекции {analysis_id} успешно сохранен")
-                return {'status': 'success', 'analysis_id': analysis_id, 'data': analysis_data_response}
+            if not all_results:
+                raise FileNotFoundError("Не удалось обработать ни одного снимка. Возможно, все они содержат ошибки или пусты.")
+
+            if budget.limit_mb is not None:
+                metadata['memory_budget_mb'] = budget.limit_mb
+                metadata['peak_rss_mb'] = budget.peak_rss_mb()
+            self._complete_analysis(user_id, analysis_data_response, context['memo_key'], context['scene_ids'],
+                                    internal=internal)
+        except Exception:
+            if all_results:
+                self.db.delete_analysis_data(user_id, analysis_id)
+            raise
+
+        yield from pending_events
+        yield {'event': 'completed', 'status': 'success', 'analysis_id': analysis_id, 'data': analysis_data_response}
+
+    def _complete_analysis(self, user_id: int, analysis_data: Dict, memo_key: str, scene_ids: List[str],
+                           internal: bool = False):
+        """
+        Окончательно сохраняет анализ (сводка со статусом completed включает его в список пользователя) и мемоизирует.
+        Служебный анализ (internal=True) сохраняется со статусом 'internal' и не мемоизируется,
+        чтобы обычный запрос анализа не получил анализ, которого нет в списке.
+        """
+        analysis_id = analysis_data['analysis_id']
+        analysis_data['metadata']['status'] = 'internal' if internal else 'completed'
+        analysis_data['timestamp'] = time.time()
+        if not self._save_analysis_data(user_id, analysis_id, analysis_data):
+            raise Exception("Не удалось сохранить анализ")
+
+        # Анализ с уменьшенными из-за лимита памяти снимками не мемоизируется
+        if not internal and not any('resolution_scale' in result for result in analysis_data['results_per_image']):
+            self.db.save_analysis_memo(memo_key, analysis_id, json.dumps(scene_ids))
+        logger.info(f"Анализ коллекции {analysis_id} успешно сохранен")
+
+    # --- Сравнение двух снимков (обнаружение изменений) ---
+
+    def _scene_from_analysis(self, user_id: int, analysis_id: str, scene_index: Optional[int],
+                             default_last: bool) -> Dict:
+        """Снимок сохраненного анализа; без номера - первый или последний по дате."""
+        analysis_data = self._load_analysis_data(user_id, analysis_id)
+        if not analysis_data:
+            raise ValueError(f"Анализ {analysis_id} не найден")
+        results = analysis_data.get('results_per_image', [])
+        if not results:
+            raise ValueError(f"В анализе {analysis_id} нет снимков")
+        if scene_index is None:
+            scene_index = len(results) - 1 if default_last else 0
+        if not 0 <= scene_index < len(results):
+            raise ValueError(f"Снимок {scene_index} в анализе {analysis_id} не найден")
+        return {'analysis_id': analysis_id, 'scene_index': scene_index, 'result': results[scene_index],
+                'area_of_interest': analysis_data.get('area_of_interest')}
+
+    def _scene_for_date(self, user_id: int, area_info: Dict, date: str) -> Dict:
+        """
+        Снимок поля за дату. Сначала ищется среди сохраненных анализов пользователя
+        с той же областью, включая служебные анализы прошлых сравнений (их растры
+        переиспользуются), иначе выполняется служебный анализ за этот день: он сохраняется,
+        чтобы на снимок можно было сослаться, но не попадает в список анализов пользователя
+        и не учитывается в квотах; его удаляет очистка хранилища (internal_analysis_days).
+        """
+        normalized = self._normalize_area(area_info)
+        for entry in self.db.list_analysis_summaries(user_id, covering_date=date,
+                                                     statuses=('completed', 'internal')) or []:
+            try:
+                if self._normalize_area(json.loads(entry['area_of_interest'])) != normalized:
+                    continue
+            except (KeyError, TypeError, ValueError):
+                continue
+            analysis_data = self._load_analysis_data(user_id, entry['analysis_id'])
+            for scene_index, result in enumerate((analysis_data or {}).get('results_per_image', [])):
+                if result.get('date') == date and result.get('raster'):
+                    logger.info(f"Для даты {date} используется снимок {scene_index} анализа {entry['analysis_id']}")
+                    return {'analysis_id': entry['analysis_id'], 'scene_index': scene_index, 'result': result,
+                            'area_of_interest': analysis_data.get('area_of_interest')}
+
+        next_day = (datetime.date.fromisoformat(date) + datetime.timedelta(days=1)).isoformat()
+        try:
+            if area_info['type'] == 'polygon':
+                context = self._prepare_analysis(user_id, date, next_day, None, None, 0, area_info['coordinates'],
+                                                 None, None)
             else:
-                raise Exception("Не удалось сохранить анализ")
-                
+                context = self._prepare_analysis(user_id, date, next_day, area_info['lon'], area_info['lat'],
+                                                 area_info['radius_km'], None, None, None)
+            analysis = self._run_analysis(user_id, context, date, next_day, internal=True)
         except Exception as e:
-            logger.error(f"Ошибка при выполнении анализа коллекции: {e}")
+            raise ValueError(f"За дату {date} нет снимков: {e}")
+        for scene_index, result in enumerate(analysis['data'].get('results_per_image', [])):
+            if result.get('raster'):
+                return {'analysis_id': analysis['analysis_id'], 'scene_index': scene_index, 'result': result,
+                        'area_of_interest': analysis['data'].get('area_of_interest')}
+        raise ValueError(f"За дату {date} нет снимков с сохраненными растрами")
+
+    def _unpack_scene_raster(self, scene_result: Dict) -> Dict[str, np.ndarray]:
+        raster_ref = scene_result.get('raster')
+        if not raster_ref:
+            raise ValueError(f"Для снимка от {scene_result.get('date')} не сохранены растры, сравнение невозможно.")
+        raster_blob = self.db.get_blob(raster_ref['blob_id'])
+        if raster_blob is None:
+            raise ValueError("Растр снимка не найден в хранилище.")
+        return RasterCodec.unpack(raster_blob[0])[1]
+
+    def perform_change_detection(self, user_id: int,
+                                 date_from: Optional[str] = None, date_to: Optional[str] = None,
+                                 lon: Optional[float] = None, lat: Optional[float] = None,
+                                 radius_km: float = 0.5,
+                                 polygon_coords: Optional[List[List[float]]] = None,
+                                 analysis_id_from: Optional[str] = None, analysis_id_to: Optional[str] = None,
+                                 scene_from: Optional[int] = None, scene_to: Optional[int] = None) -> Dict:
+        """
+        Сравнивает два снимка одного поля: разности всех индексов (to - from), зоны
+        значимого снижения NDVI и карта изменений. Снимки задаются либо двумя датами
+        и областью, либо анализами (analysis_id_to по умолчанию равен analysis_id_from;
+        без номеров снимков берутся первый снимок первого анализа и последний второго).
+        """
+        try:
+            if analysis_id_from:
+                scene_a = self._scene_from_analysis(user_id, analysis_id_from, scene_from, default_last=False)
+                scene_b = self._scene_from_analysis(user_id, analysis_id_to or analysis_id_from, scene_to, default_last=True)
+            elif date_from and date_to:
+                area_info = self._area_from_request(lon, lat, radius_km, polygon_coords)
+                scene_a = self._scene_for_date(user_id, area_info, date_from)
+                scene_b = self._scene_for_date(user_id, area_info, date_to)
+            else:
+                return {'status': 'error', 'detail': 'Укажите две даты и область или ID анализа для сравнения'}
+
+            result_a, result_b = scene_a['result'], scene_b['result']
+            maps_a = self._unpack_scene_raster(result_a)
+            maps_b = self._unpack_scene_raster(result_b)
+            index_names = [name for name in RasterCodec.INDEX_NAMES if name in maps_a and name in maps_b]
+            detector = ChangeDetector()
+            if detector.settings['zone_index'] not in index_names:
+                return {'status': 'error', 'detail': 'В растрах снимков нет индекса для сравнения'}
+
+            # Общая сетка - сетка первого снимка
+            bounds = result_a['bounds']
+            stack_a = ChangeDetector.stack(maps_a, index_names)
+            stack_b = ChangeDetector.align(ChangeDetector.stack(maps_b, index_names), result_b['bounds'],
+                                           bounds, stack_a.shape[:2])
+            del maps_a, maps_b
+            change = detector.compute(stack_a, stack_b, index_names, bounds)
+            if change['statistics'][detector.settings['zone_index']]['valid_pixels'] == 0:
+                return {'status': 'error', 'detail': 'Снимки не пересекаются, сравнение невозможно'}
+
+            data, media_type = self.encoder.encode(change['difference_map'], 'overlay')
+
+            def describe(scene):
+                result = scene['result']
+                return {'analysis_id': scene['analysis_id'], 'scene_index': scene['scene_index'],
+                        'scene_id': result.get('scene_id'), 'date': result.get('date'),
+                        'cloud_coverage': result.get('cloud_coverage')}
+
+            return {
+                'status': 'success',
+                'data': {
+                    'from': describe(scene_a),
+                    'to': describe(scene_b),
+                    'area_of_interest': scene_a.get('area_of_interest'),
+                    'bounds': bounds,
+                    'decline_threshold': float(detector.settings['decline_threshold']),
+                    'statistics': change['statistics'],
+                    'decline_zones': change['decline_zones'],
+                    'difference_image': self._store_image(data, media_type, owner_id=user_id),
+                }
+            }
+        except ValueError as e:
             return {'status': 'error', 'detail': str(e)}
-    
-    def _update_user_analyses_list(self, token: str, analysis_id: str, analysis_data: Dict):
-        """Обновляет список анализов пользователя с краткой сводкой."""
+        except Exception as e:
+            logger.error(f"Ошибка при сравнении снимков: {e}")
+            return {'status': 'error', 'detail': str(e)}
+
+    # --- Пакетный анализ нескольких полей ---
+
+    def perform_batch_analysis(self, user_id: int, field_ids: List[str], start_date: str, end_date: str,
+                               render_mode: Optional[str] = None, use_cache: bool = True) -> Dict:
+        """
+        Анализ нескольких сохраненных полей с общей загрузкой снимков. Поля группируются
+        в окна (общий прямоугольник соседних полей), каждый снимок загружается один раз
+        на окно в родном разрешении Sentinel-2 и нарезается по полям локально, поэтому
+        объем загрузки из GEE зависит от площади, а не от числа полей.
+        Для каждого поля сохраняется отдельный анализ; в ответе - краткие итоги по полям.
+        """
+        try:
+            render_mode = render_mode or self.settings['render_mode']
+            if render_mode not in self.RENDER_MODES:
+                raise ValueError(f"Неизвестный режим построения изображений: {render_mode}")
+
+            saved_fields = {field['id']: {**field, 'area_of_interest': json.loads(field['area_of_interest'])}
+                            for field in self.db.get_fields(user_id, field_ids) or []}
+            field_results = []
+            plans = []
+            for field_id in field_ids:
+                field = saved_fields.get(field_id)
+                if field is None:
+                    field_results.append({'field_id': field_id, 'status': 'error', 'detail': 'Поле с таким ID не найдено'})
+                    continue
+                plan = {'field': field, 'area_info': field['area_of_interest'],
+                        'bbox': AoiMask.bbox(field['area_of_interest']), 'results': [], 'skipped': 0}
+                plan['resolution'] = f"{self._batch_resolution_m(plan['bbox']):g}m"
+                plan['memo_key'] = self._analysis_memo_key(plan['area_info'], start_date, end_date, render_mode,
+                                                           grid=plan['resolution'])
+                plans.append(plan)
+                field_results.append(plan)
+            if not plans:
+                return {'status': 'error', 'detail': 'Не найдено ни одного поля для анализа', 'results': field_results}
+
+            GEEInitializer.initialize_gee()
+            # Один запрос списка снимков на общий прямоугольник всех полей
+            union_bbox = self._union_bbox([p['bbox'] for p in plans])
+            scenes = ImageProvider.list_scenes(start_date, end_date, ee.Geometry.Rectangle(union_bbox), with_footprint=True)
+            scenes.sort(key=lambda scene: (scene['date'], scene['id']))
+            logger.info(f"Пакетный анализ {len(plans)} полей: найдено снимков {len(scenes)}")
+
+            pending = []
+            for plan in plans:
+                plan['scenes'] = [scene for scene in scenes if self._bbox_intersects(scene['footprint'], plan['bbox'])]
+                plan['scene_ids'] = sorted(scene['id'] for scene in plan['scenes'])
+                memoized = None
+                if use_cache and self.settings.get('memoization', True):
+                    memoized = self._get_memoized_analysis(user_id, plan['memo_key'], plan['scene_ids'])
+                if memoized:
+                    plan['response'] = memoized
+                elif plan['scenes']:
+                    pending.append(plan)
+                else:
+                    plan['response'] = {'status': 'error', 'detail': 'Нет снимков, покрывающих поле'}
+
+            for window in self._plan_batch_windows(pending):
+                self._run_batch_window(window, scenes, render_mode, self.memory_budget)
+
+            for plan in pending:
+                plan['response'] = self._save_batch_field_analysis(user_id, plan, start_date, end_date, render_mode)
+
+            summary = []
+            for item in field_results:
+                if 'field' not in item:
+                    summary.append(item)
+                    continue
+                response = item['response']
+                entry = {'field_id': item['field']['id'], 'field_name': item['field'].get('name'), 'status': response['status']}
+                if response['status'] == 'success':
+                    entry.update({'analysis_id': response['analysis_id'], 'image_count': response['data']['image_count']})
+                    if response.get('memoized'):
+                        entry['memoized'] = True
+                else:
+                    entry['detail'] = response.get('detail')
+                summary.append(entry)
+            return {'status': 'success', 'results': summary}
+
+        except Exception as e:
+            logger.error(f"Ошибка при выполнении пакетного анализа: {e}")
+            return {'status': 'error', 'detail': str(e)}
+
+    @staticmethod
+    def _bbox_intersects(a: List[float], b: List[float]) -> bool:
+        return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+    @staticmethod
+    def _union_bbox(bboxes: List[List[float]]) -> List[float]:
+        return [min(b[0] for b in bboxes), min(b[1] for b in bboxes), max(b[2] for b in bboxes), max(b[3] for b in bboxes)]
+
+    @staticmethod
+    def _bbox_extent_m(bbox: List[float]) -> float:
+        """Большая сторона прямоугольника в метрах."""
+        mid_lat = math.radians((bbox[1] + bbox[3]) / 2)
+        width_m = (bbox[2] - bbox[0]) * AoiMask.METERS_PER_DEGREE * math.cos(mid_lat)
+        height_m = (bbox[3] - bbox[1]) * AoiMask.METERS_PER_DEGREE
+        return max(width_m, height_m)
+
+    def _window_dimensions(self, bbox: List[float]) -> int:
+        """Размер большей стороны окна в пикселях при разрешении batch_resolution_m."""
+        return max(1, math.ceil(self._bbox_extent_m(bbox) / float(self.settings['batch_resolution_m'])))
+
+    def _batch_resolution_m(self, field_bbox: List[float]) -> float:
+        """
+        Фактическое разрешение снимков поля в пакетном анализе, м/пиксель: batch_resolution_m,
+        а если поле не помещается в окно batch_max_dimensions пикселей - грубее (поле загружается
+        отдельным окном размером batch_max_dimensions). Входит в ключ мемоизации и metadata.
+        """
+        resolution_m = float(self.settings['batch_resolution_m'])
+        if self._window_dimensions(field_bbox) <= int(self.settings['batch_max_dimensions']):
+            return resolution_m
+        return round(self._bbox_extent_m(field_bbox) / int(self.settings['batch_max_dimensions']), 1)
+
+    def _plan_batch_windows(self, plans: List[Dict]) -> List[Dict]:
+        """
+        Группирует поля в окна загрузки: поля раскладываются по ячейкам сетки, сторона
+        которой равна batch_max_dimensions пикселей, окно - общий прямоугольник полей ячейки.
+        Поля у края ячейки могут выходить за нее, поэтому ячейка, общий прямоугольник которой
+        больше batch_max_dimensions, делится на несколько окон: каждое окно загружается
+        в разрешении batch_resolution_m. Поле, которое не помещается в окно само по себе,
+        загружается отдельным окном с разрешением _batch_resolution_m.
+        """
+        max_dimensions = int(self.settings['batch_max_dimensions'])
+        cell_m = max_dimensions * float(self.settings['batch_resolution_m'])
+        cells = {}
+        for plan in plans:
+            center_lon = (plan['bbox'][0] + plan['bbox'][2]) / 2
+            center_lat = (plan['bbox'][1] + plan['bbox'][3]) / 2
+            cell_lat = cell_m / AoiMask.METERS_PER_DEGREE
+            cell_lon = cell_lat / math.cos(math.radians(center_lat))
+            cells.setdefault((math.floor(center_lon / cell_lon), math.floor(center_lat / cell_lat)), []).append(plan)
+
+        windows = []
+        for cell_plans in cells.values():
+            cell_windows = []
+            for plan in sorted(cell_plans, key=lambda p: (p['bbox'][0], p['bbox'][1])):
+                # Первое окно ячейки, которое вместе с полем остается в пределах batch_max_dimensions
+                for window in cell_windows:
+                    bbox = self._union_bbox([window['bbox'], plan['bbox']])
+                    if self._window_dimensions(bbox) <= max_dimensions:
+                        window['bbox'] = bbox
+                        window['plans'].append(plan)
+                        break
+                else:
+                    cell_windows.append({'bbox': list(plan['bbox']), 'plans': [plan]})
+            for window in cell_windows:
+                window['dimensions'] = min(self._window_dimensions(window['bbox']), max_dimensions)
+            windows.extend(cell_windows)
+        logger.info(f"Пакетный анализ: {len(plans)} полей сгруппировано в {len(windows)} окон загрузки")
+        return windows
+
+    def _run_batch_window(self, window: Dict, scenes: List[Dict], render_mode: str, budget: MemoryBudget):
+        """Загружает каждый снимок окна один раз и обрабатывает по нему все поля окна."""
+        geometry = ee.Geometry.Rectangle(window['bbox'])
+        for scene in scenes:
+            plans = [plan for plan in window['plans'] if scene['id'] in plan['scene_ids']]
+            if not plans:
+                continue
+            logger.info(f"Обработка снимка от {scene['date']} для {len(plans)} полей")
+            reserved_mb = 0.0
+            try:
+                scale, reserved_mb = budget.reserve(window['dimensions'] ** 2)
+                image_data = ImageProvider.fetch_scene(scene, geometry, dimensions=max(1, int(window['dimensions'] * scale)))
+            except Exception as e:
+                budget.release(reserved_mb)
+                logger.warning(f"Ошибка при обработке снимка {scene['id']}: {e}. Пропускаем.")
+                for plan in plans:
+                    plan['skipped'] += 1
+                continue
+            try:
+                self._process_batch_scene(window, plans, image_data, render_mode, scale)
+                del image_data
+            finally:
+                budget.release(reserved_mb)
+
+    def _process_batch_scene(self, window: Dict, plans: List[Dict], image_data: Dict, render_mode: str, scale: float):
+        """Нарезает загруженный снимок окна по полям и обрабатывает каждое поле."""
+        (min_lon, min_lat, max_lon, max_lat) = window['bbox']
+        window_bounds = [[min_lat, min_lon], [max_lat, max_lon]]
+        shape = image_data['rgb_image'].shape[:2]
+        for plan in plans:
+            (y0, y1, x0, x1), field_bounds = AoiMask.crop_window(window_bounds, shape, plan['bbox'])
+            # Срезы - представления без копирования; VegetationIndexCalculator сам делает копии каналов
+            field_image = {**image_data, **{key: image_data[key][y0:y1, x0:x1] for key in
+                           ('rgb_image', 'red_channel', 'green_channel', 'blue_channel', 'nir_channel')}}
+            result = self._process_scene(field_image, field_bounds, render_mode, plan['area_info'])
+            if scale < 1.0:
+                result['resolution_scale'] = round(scale, 3)
+            plan['results'].append(result)
+
+    def _save_batch_field_analysis(self, user_id: int, plan: Dict, start_date: str, end_date: str,
+                                   render_mode: str) -> Dict:
+        """Сохраняет анализ одного поля пакета."""
+        if not plan['results']:
+            return {'status': 'error', 'detail': "Не удалось обработать ни одного снимка. Возможно, все они содержат ошибки или пусты."}
         try:
-            user_data_obj = self._get_user_data_object(token)
-            
-            avg_ndvi, avg_vari, avg_evi = 0, 0, 0
-            if analysis_data.get('image_count', 0) > 0:
-                ndvis = [r['statistics']['ndvi']['mean'] for r in analysis_data['results_per_image']]
-                varis = [r['statistics']['vari']['mean'] for r in analysis_data['results_per_image']]
-                evis = [r['statistics']['evi']['mean'] for r in analysis_data['results_per_image']]
-                avg_ndvi = sum(ndvis) / len(ndvis) if ndvis else 0
-                avg_vari = sum(varis) / len(varis) if varis else 0
-                avg_evi = sum(evis) / len(evis) if evis else 0
-
-            new_analysis = {
+            analysis_id = self._new_analysis_id()
+            results = sorted(plan['results'], key=lambda result: result['date'])
+            if render_mode == 'lazy':
+                for scene_index, result in enumerate(results):
+                    result.update(self._lazy_image_refs(analysis_id, scene_index))
+            analysis_data = {
                 'analysis_id': analysis_id,
-                'timestamp': analysis_data['timestamp'],
-                'area_of_interest': analysis_data['area_of_interest'],
-                'date_range': analysis_data['date_range'],
-                'image_count': analysis_data.get('image_count', 0),
-                'statistics_summary': {
-                    'ndvi_mean': avg_ndvi,
-                    'vari_mean': avg_vari,
-                    'evi_mean': avg_evi
-                }
+                'timestamp': time.time(),
+                'area_of_interest': plan['area_info'],
+                'date_range': {'start': start_date, 'end': end_date},
+                'image_count': len(results),
+                'results_per_image': results,
+                'metadata': {'resolution': plan['resolution'], 'source': 'Sentinel-2',
+                             'render_mode': render_mode, 'field_id': plan['field']['id'], 'batch': True}
             }
-            
-            user_data_obj['analyses'].insert(0, new_analysis)
-            user_data_obj['analyses'] = user_data_obj['analyses'][:50]
-            
-            self._save_user_data_object(token, user_data_obj)
-            
+            self._complete_analysis(user_id, analysis_data, plan['memo_key'], plan['scene_ids'])
+            return {'status': 'success', 'analysis_id': analysis_id, 'data': analysis_data}
         except Exception as e:
-            logger.error(f"Ошибка обновления списка анализов: {e}")
-    
+            logger.error(f"Ошибка сохранения анализа поля {plan['field']['id']}: {e}")
+            return {'status': 'error', 'detail': str(e)}
+
+    def _scene_mask(self, area_info: Dict, bounds_for_leaflet: List, shape) -> Optional[np.ndarray]:
+        """Маска пикселей поля на сетке снимка или None, если считать нужно по всему прямоугольнику."""
+        if not self.settings.get('aoi_mask', True):
+            return None
+        mask = AoiMask.get(area_info, bounds_for_leaflet, shape)
+        if not mask.any():
+            logger.warning("Область анализа меньше пикселя снимка, статистика считается по всему прямоугольнику")
+            return None
+        return mask
+
+    def _process_scene(self, image_data: Dict, bounds_for_leaflet: List, render_mode: str,
+                       area_info: Dict) -> Dict:
+        """Рассчитывает индексы, статистику и изображения одного снимка."""
+        calculator = VegetationIndexCalculator(
+            rgb_image=image_data['rgb_image'], red_channel=image_data['red_channel'],
+            green_channel=image_data['green_channel'], blue_channel=image_data['blue_channel'],
+            nir_channel=image_data['nir_channel'],
+            mask=self._scene_mask(area_info, bounds_for_leaflet, image_data['rgb_image'].shape[:2])
+        )
+
+        indices = self._calculate_all_indices(calculator)
+        index_maps = {name: data['map'] for name, data in indices.items()}
+
+        single_image_result = {
+            'scene_id': image_data['scene_id'],
+            'date': image_data['date'],
+            'cloud_coverage': image_data['cloud_percentage'],
+            'raster': self._store_image(RasterCodec.pack(image_data['rgb_image'], index_maps), RasterCodec.MEDIA_TYPE),
+            'bounds': bounds_for_leaflet,
+            'statistics': {
+                'ndvi': indices['ndvi']['stats'],
+                'savi': indices['savi']['stats'],
+                'vari': indices['vari']['stats'],
+                'evi': indices['evi']['stats']
+            },
+            'zoning': {name: data['zones'] for name, data in indices.items()},
+            'histograms': {name: data['histogram'] for name, data in indices.items()}
+        }
+
+        if render_mode == 'eager':
+            rendered = SceneRenderer.render_scene(
+                rgb_image=image_data['rgb_image'], index_maps=index_maps,
+                stats=single_image_result['statistics'],
+                problem_threshold=(self.zoning.get_thresholds('ndvi') or [0.2])[0]
+            )
+            image_refs = self._encode_and_store_images(
+                {layer: (array, SceneRenderer.output_type(layer)) for layer, array in rendered.items()}
+            )
+            single_image_result['images'] = {name: image_refs[name] for name in ('rgb', 'ndvi', 'savi', 'vari', 'evi')}
+            for layer, key in self.LEGACY_LAYER_KEYS.items():
+                single_image_result[key] = image_refs[layer]
+        return single_image_result
+
     # --- CRUD-методы для управления анализами ---
 
-    def get_analysis_by_id(self, token: str, analysis_id: str) -> Dict:
+    def get_analysis_by_id(self, user_id: int, analysis_id: str, inline_images: bool = False) -> Dict:
         """Получает конкретный анализ по ID."""
         try:
-            analysis_data = self._load_analysis_data(token, analysis_id)
+            analysis_data = self._load_analysis_data(user_id, analysis_id)
             if analysis_data:
+                if inline_images:
+                    analysis_data = self._inline_images(analysis_data)
                 return {'status': 'success', 'analysis_id': analysis_id, 'data': analysis_data}
             else:
                 return {'status': 'error', 'detail': 'Анализ не найден'}
@@ -371,27 +1338,15 @@ class AnalysisManager:
             logger.error(f"Ошибка получения анализа: {e}")
             return {'status': 'error', 'detail': str(e)}
     
-    def delete_analysis(self, token: str, analysis_id: str) -> Dict:
-        """Удаляет анализ из основной БД и из списка пользователя."""
+    def delete_analysis(self, user_id: int, analysis_id: str) -> Dict:
+        """Удаляет анализ вместе с его сводкой (и тем самым из списка пользователя)."""
         try:
-            self.db.delete_analysis_data(token, analysis_id)
-            
-            user_data_obj = self._get_user_data_object(token)
-            initial_count = len(user_data_obj.get('analyses', []))
-            
-            user_data_obj['analyses'] = [
-                analysis for analysis in user_data_obj.get('analyses', []) 
-                if analysis.get('analysis_id') != analysis_id
-            ]
-            
-            if len(user_data_obj['analyses']) < initial_count:
-                self._save_user_data_object(token, user_data_obj)
-                logger.info(f"Анализ {analysis_id} удален из списка пользователя {token}")
-                return {'status': 'success', 'message': 'Анализ успешно удален'}
+            TileRenderer.forget_analysis(analysis_id)
+            if self.db.delete_analysis_data(user_id, analysis_id):
+                logger.info(f"Анализ {analysis_id} удален пользователем {user_id}")
             else:
-                logger.warning(f"Анализ {analysis_id} не был найден в списке пользователя {token} для удаления.")
-                return {'status': 'success', 'message': 'Анализ успешно удален'}
-                
+                logger.warning(f"Анализ {analysis_id} не был найден у пользователя {user_id} для удаления.")
+            return {'status': 'success', 'message': 'Анализ успешно удален'}
         except Exception as e:
             logger.error(f"Критическая ошибка при удалении анализа {analysis_id}: {e}")
             return {'status': 'error', 'detail': str(e)}
\ No newline at end of file
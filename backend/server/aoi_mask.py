@@ -0,0 +1,120 @@
+# --- START OF FILE aoi_mask.py ---
+
+import json
+import math
+import threading
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+import numpy as np
+import cv2
+
+logger = logging.getLogger(__name__)
+
+class AoiMask:
+    """
+    Растровая маска области анализа на сетке снимка. Снимки загружаются по
+    ограничивающему прямоугольнику области, поэтому для полигонов и кругов
+    (точка с радиусом) часть пикселей лежит вне поля; маска отмечает пиксели
+    внутри поля, и индексы и статистика считаются только по ним.
+    Миниатюры GEE строятся в проекции Web Mercator, поэтому широта переводится
+    в пиксели через меркаторскую проекцию, а долгота - линейно.
+    Маски кэшируются по (область, границы, размер сетки): все снимки одного
+    поля используют одну и ту же маску.
+    """
+    MAX_CACHED = 64
+    CIRCLE_VERTICES = 72
+    METERS_PER_DEGREE = 111320.0
+    # Субпиксельная точность вершин для cv2.fillPoly (координаты * 2^SHIFT)
+    SHIFT = 4
+
+    _cache = OrderedDict()
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls, area_info: Dict, bounds: List[List[float]], shape: Tuple[int, int]) -> np.ndarray:
+        """
+        Возвращает bool-маску формы shape. bounds - [[min_lat, min_lon], [max_lat, max_lon]],
+        как в результатах анализа. Маска общая для всех вызовов - изменять ее нельзя.
+        """
+        key = (json.dumps(area_info, sort_keys=True), json.dumps(bounds), tuple(shape))
+        with cls._lock:
+            mask = cls._cache.get(key)
+            if mask is not None:
+                cls._cache.move_to_end(key)
+                return mask
+
+        mask = cls._rasterize(cls.outline(area_info), bounds, shape)
+        mask.setflags(write=False)
+        with cls._lock:
+            cls._cache[key] = mask
+            while len(cls._cache) > cls.MAX_CACHED:
+                cls._cache.popitem(last=False)
+        return mask
+
+    @classmethod
+    def outline(cls, area_info: Dict) -> List[Tuple[float, float]]:
+        """Контур области в виде списка (lon, lat); круг заменяется многоугольником."""
+        if area_info['type'] == 'polygon':
+            return [(float(lon), float(lat)) for lon, lat in area_info['coordinates']]
+
+        lon, lat = float(area_info['lon']), float(area_info['lat'])
+        radius_m = float(area_info['radius_km']) * 1000
+        dlat = radius_m / cls.METERS_PER_DEGREE
+        dlon = radius_m / (cls.METERS_PER_DEGREE * math.cos(math.radians(lat)))
+        angles = np.linspace(0, 2 * np.pi, cls.CIRCLE_VERTICES, endpoint=False)
+        return list(zip(lon + dlon * np.sin(angles), lat + dlat * np.cos(angles)))
+
+    @classmethod
+    def bbox(cls, area_info: Dict) -> List[float]:
+        """Ограничивающий прямоугольник области [min_lon, min_lat, max_lon, max_lat]."""
+        points = np.asarray(cls.outline(area_info), dtype=np.float64)
+        return [float(points[:, 0].min()), float(points[:, 1].min()),
+                float(points[:, 0].max()), float(points[:, 1].max())]
+
+    @staticmethod
+    def _mercator_y(lat):
+        return np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+
+    @staticmethod
+    def _mercator_lat(y):
+        return np.degrees(2 * np.arctan(np.exp(y)) - np.pi / 2)
+
+    @classmethod
+    def crop_window(cls, bounds: List[List[float]], shape: Tuple[int, int], bbox: List[float]):
+        """
+        Пиксельное окно снимка с границами bounds и размером shape, покрывающее bbox
+        ([min_lon, min_lat, max_lon, max_lat]). Возвращает ((y0, y1, x0, x1), границы окна
+        в формате bounds), где границы - точные края вырезанных пикселей.
+        """
+        (min_lat, min_lon), (max_lat, max_lon) = bounds
+        h, w = shape
+        top, bottom = cls._mercator_y(max_lat), cls._mercator_y(min_lat)
+        lon_per_px = (max_lon - min_lon) / w
+        y_per_px = (top - bottom) / h
+
+        x0 = int(np.clip(np.floor((bbox[0] - min_lon) / lon_per_px), 0, w - 1))
+        x1 = int(np.clip(np.ceil((bbox[2] - min_lon) / lon_per_px), x0 + 1, w))
+        y0 = int(np.clip(np.floor((top - cls._mercator_y(bbox[3])) / y_per_px), 0, h - 1))
+        y1 = int(np.clip(np.ceil((top - cls._mercator_y(bbox[1])) / y_per_px), y0 + 1, h))
+
+        window_bounds = [[float(cls._mercator_lat(top - y1 * y_per_px)), min_lon + x0 * lon_per_px],
+                         [float(cls._mercator_lat(top - y0 * y_per_px)), min_lon + x1 * lon_per_px]]
+        return (y0, y1, x0, x1), window_bounds
+
+    @classmethod
+    def _rasterize(cls, outline: List[Tuple[float, float]], bounds: List[List[float]],
+                   shape: Tuple[int, int]) -> np.ndarray:
+        (min_lat, min_lon), (max_lat, max_lon) = bounds
+        h, w = shape
+        points = np.asarray(outline, dtype=np.float64)
+        top, bottom = cls._mercator_y(max_lat), cls._mercator_y(min_lat)
+
+        # Координаты центров пикселей: пиксель (0, 0) покрывает [0, 1) x [0, 1)
+        x = (points[:, 0] - min_lon) / (max_lon - min_lon) * w - 0.5
+        y = (top - cls._mercator_y(points[:, 1])) / (top - bottom) * h - 0.5
+        vertices = np.round(np.stack([x, y], axis=1) * (1 << cls.SHIFT)).astype(np.int32)
+
+        mask = np.zeros((h, w), dtype=np.uint8)
+        cv2.fillPoly(mask, [vertices], 1, lineType=cv2.LINE_8, shift=cls.SHIFT)
+        return mask.view(bool)
@@ -0,0 +1,47 @@
+# --- START OF FILE app_config.py ---
+
+import os
+import json
+import copy
+import logging
+
+logger = logging.getLogger(__name__)
+
+class AppConfig:
+    """
+    Загружает настройки приложения из JSON-файла (по умолчанию app_config.json).
+    Каждый модуль запрашивает свою секцию и передает значения по умолчанию,
+    поэтому файл конфигурации может быть неполным или вовсе отсутствовать.
+    """
+    CONFIG_PATH = os.environ.get("APP_CONFIG_PATH", "app_config.json")
+    _config = None
+
+    @classmethod
+    def _load(cls) -> dict:
+        if cls._config is not None:
+            return cls._config
+        try:
+            with open(cls.CONFIG_PATH, 'r', encoding='utf-8') as f:
+                cls._config = json.load(f)
+            logger.info(f"Конфигурация загружена из {cls.CONFIG_PATH}")
+        except FileNotFoundError:
+            logger.info(f"Файл конфигурации {cls.CONFIG_PATH} не найден, используются значения по умолчанию.")
+            cls._config = {}
+        except json.JSONDecodeError as e:
+            logger.error(f"Ошибка парсинга файла конфигурации {cls.CONFIG_PATH}: {e}")
+            cls._config = {}
+        return cls._config
+
+    @classmethod
+    def get_section(cls, name: str, defaults: dict = None) -> dict:
+        """Возвращает секцию конфигурации, дополненную значениями по умолчанию."""
+        section = copy.deepcopy(defaults) if defaults else {}
+        overrides = cls._load().get(name, {})
+        if isinstance(overrides, dict):
+            section.update(overrides)
+        return section
+
+    @classmethod
+    def reload(cls):
+        """Сбрасывает кэш, чтобы следующий вызов перечитал файл."""
+        cls._config = None
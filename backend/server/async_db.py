@@ -0,0 +1,68 @@
+# --- START OF FILE async_db.py ---
+
+import asyncio
+import functools
+import threading
+import logging
+from typing import Callable, Dict
+from worker_pool import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+class AsyncDatabaseManager:
+    """
+    Асинхронный фасад над DatabaseManager для обработчиков FastAPI.
+    Повторяет публичные методы DatabaseManager (те же имена и аргументы), но каждый
+    вызов - корутина, а сам запрос к SQLite выполняется в отдельном ограниченном пуле
+    потоков 'database' (см. WorkerPool). Event loop не ждет ни диска, ни блокировок
+    записи, поэтому медленная запись не задерживает другие запросы; число одновременных
+    обращений к БД ограничено размером пула, и у каждого его потока свое постоянное
+    соединение (ConnectionPool).
+        await adb.if_token_exist(token)
+        await adb.run(analysis_manager.list_analyses, user_id)  # любая синхронная работа с БД
+    """
+    POOL_NAME = 'database'
+
+    def __init__(self, db_manager):
+        self.db = db_manager
+        self._lock = threading.Lock()
+        self._stats = {'calls': 0, 'errors': 0, 'in_flight': 0, 'max_in_flight': 0}
+
+    async def run(self, func: Callable, *args, **kwargs):
+        """Выполняет синхронную функцию, работающую с БД, в пуле потоков БД."""
+        with self._lock:
+            self._stats['calls'] += 1
+            self._stats['in_flight'] += 1
+            self._stats['max_in_flight'] = max(self._stats['max_in_flight'], self._stats['in_flight'])
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(WorkerPool.get(self.POOL_NAME), functools.partial(func, *args, **kwargs))
+        except Exception:
+            with self._lock:
+                self._stats['errors'] += 1
+            raise
+        finally:
+            with self._lock:
+                self._stats['in_flight'] -= 1
+
+    def __getattr__(self, name: str):
+        # Вызывается только для имен, которых нет у самого фасада: берем метод DatabaseManager
+        if name.startswith('_'):
+            raise AttributeError(name)
+        method = getattr(self.db, name)
+        if not callable(method):
+            raise AttributeError(f"DatabaseManager.{name} не является методом")
+
+        @functools.wraps(method)
+        async def async_method(*args, **kwargs):
+            return await self.run(method, *args, **kwargs)
+
+        # Обертка создается один раз на имя метода
+        setattr(self, name, async_method)
+        return async_method
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats['max_workers'] = WorkerPool.get(self.POOL_NAME)._max_workers
+        return stats
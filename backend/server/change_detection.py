@@ -0,0 +1,158 @@
+# --- START OF FILE change_detection.py ---
+
+import logging
+from typing import Dict, List, Sequence, Tuple
+import numpy as np
+import cv2
+from aoi_mask import AoiMask
+from renderer import ColormapRegistry
+from app_config import AppConfig
+
+logger = logging.getLogger(__name__)
+
+class ChangeDetector:
+    """
+    Сравнение двух снимков одного поля по сохраненным растрам индексов.
+    Карты индексов каждого снимка складываются в один массив (h, w, индексы),
+    второй снимок приводится к сетке первого одним аффинным преобразованием
+    (растры лежат в Web Mercator), после чего разности и их статистика по всем
+    индексам считаются за один векторный проход.
+    Зоны снижения - связные области, где NDVI упал больше порога.
+    Параметры задаются в секции "change_detection" файла конфигурации, например:
+        {"change_detection": {"decline_threshold": 0.15, "min_zone_pixels": 25}}
+    """
+    DEFAULT_SETTINGS = {
+        # Изменение индекса, которое считается значимым (по модулю)
+        'decline_threshold': 0.1,
+        # Зоны меньше этого числа пикселей считаются шумом
+        'min_zone_pixels': 16,
+        'max_zones': 20,
+        # Диапазон разности NDVI на карте изменений: [-difference_range, difference_range]
+        'difference_range': 0.5,
+        # Индекс, по которому выделяются зоны снижения и строится карта изменений
+        'zone_index': 'ndvi',
+    }
+
+    def __init__(self, settings: Dict = None):
+        self.settings = settings if settings is not None else AppConfig.get_section('change_detection', self.DEFAULT_SETTINGS)
+
+    @staticmethod
+    def stack(index_maps: Dict[str, np.ndarray], index_names: Sequence[str]) -> np.ndarray:
+        return np.stack([index_maps[name] for name in index_names], axis=-1).astype(np.float32)
+
+    @staticmethod
+    def align(stack: np.ndarray, src_bounds: List[List[float]], dst_bounds: List[List[float]],
+              dst_shape: Tuple[int, int]) -> np.ndarray:
+        """
+        Переносит стопку карт с сетки src_bounds на сетку dst_bounds размера dst_shape.
+        Пиксели вне исходного снимка становятся NaN.
+        """
+        if src_bounds == dst_bounds and stack.shape[:2] == tuple(dst_shape):
+            return stack
+        (s_min_lat, s_min_lon), (s_max_lat, s_max_lon) = src_bounds
+        (d_min_lat, d_min_lon), (d_max_lat, d_max_lon) = dst_bounds
+        src_h, src_w = stack.shape[:2]
+        dst_h, dst_w = dst_shape
+        s_top, s_bottom = float(AoiMask._mercator_y(s_max_lat)), float(AoiMask._mercator_y(s_min_lat))
+        d_top, d_bottom = float(AoiMask._mercator_y(d_max_lat)), float(AoiMask._mercator_y(d_min_lat))
+
+        # Обратное отображение центров пикселей целевой сетки в пиксели исходной
+        src_lon_px = (s_max_lon - s_min_lon) / src_w
+        src_y_px = (s_top - s_bottom) / src_h
+        sx = (d_max_lon - d_min_lon) / dst_w / src_lon_px
+        sy = (d_top - d_bottom) / dst_h / src_y_px
+        tx = (d_min_lon - s_min_lon) / src_lon_px + 0.5 * sx - 0.5
+        ty = (s_top - d_top) / src_y_px + 0.5 * sy - 0.5
+        matrix = np.array([[sx, 0.0, tx], [0.0, sy, ty]], dtype=np.float64)
+
+        aligned = cv2.warpAffine(stack, matrix, (dst_w, dst_h), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                                 borderMode=cv2.BORDER_CONSTANT, borderValue=(np.nan,) * 4)
+        return aligned.reshape(dst_h, dst_w, stack.shape[2])
+
+    def compute(self, stack_from: np.ndarray, stack_to: np.ndarray, index_names: Sequence[str],
+                bounds: List[List[float]]) -> Dict:
+        """
+        Разности stack_to - stack_from (стопки на общей сетке с границами bounds).
+        Возвращает статистику по индексам, зоны снижения и карту разности индекса зон.
+        """
+        threshold = float(self.settings['decline_threshold'])
+        delta = stack_to - stack_from
+        valid = np.isfinite(delta)
+        delta_filled = np.where(valid, delta, 0.0)
+
+        # Статистика всех индексов сразу: суммы по осям пикселей дают векторы длины len(index_names)
+        counts = valid.sum(axis=(0, 1))
+        safe_counts = np.maximum(counts, 1)
+        means = delta_filled.sum(axis=(0, 1)) / safe_counts
+        stds = np.sqrt(np.maximum((delta_filled ** 2).sum(axis=(0, 1)) / safe_counts - means ** 2, 0.0))
+        mins = np.where(valid, delta, np.inf).min(axis=(0, 1))
+        maxs = np.where(valid, delta, -np.inf).max(axis=(0, 1))
+        declined = (valid & (delta < -threshold)).sum(axis=(0, 1)) * 100.0 / safe_counts
+        improved = (valid & (delta > threshold)).sum(axis=(0, 1)) * 100.0 / safe_counts
+
+        statistics = {}
+        for i, name in enumerate(index_names):
+            has_data = counts[i] > 0
+            statistics[name] = {
+                'mean': float(means[i]) if has_data else 0.0,
+                'std': float(stds[i]) if has_data else 0.0,
+                'min': float(mins[i]) if has_data else 0.0,
+                'max': float(maxs[i]) if has_data else 0.0,
+                'declined_percent': round(float(declined[i]), 2),
+                'improved_percent': round(float(improved[i]), 2),
+                'valid_pixels': int(counts[i]),
+            }
+
+        zone_index = self.settings['zone_index']
+        zone_i = list(index_names).index(zone_index)
+        zone_delta, zone_valid = delta[:, :, zone_i], valid[:, :, zone_i]
+        value_range = float(self.settings['difference_range'])
+        difference_map = ColormapRegistry.apply('red_white_green', zone_delta, zone_valid, -value_range, value_range)
+
+        return {
+            'statistics': statistics,
+            'decline_zones': self._decline_zones(zone_delta, zone_valid, bounds, threshold),
+            'difference_map': difference_map,
+        }
+
+    def _decline_zones(self, delta: np.ndarray, valid: np.ndarray, bounds: List[List[float]],
+                       threshold: float) -> List[Dict]:
+        """Связные области значимого снижения, от больших к меньшим."""
+        decline = (valid & (delta < -threshold)).astype(np.uint8)
+        n_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(decline, connectivity=8)
+        if n_labels <= 1:
+            return []
+
+        # Средняя разность по каждой зоне за один проход bincount
+        delta_sums = np.bincount(labels.ravel(), weights=np.where(decline, delta, 0.0).ravel(), minlength=n_labels)
+        total_valid = max(int(valid.sum()), 1)
+
+        (min_lat, min_lon), (max_lat, max_lon) = bounds
+        h, w = delta.shape
+        top, bottom = float(AoiMask._mercator_y(max_lat)), float(AoiMask._mercator_y(min_lat))
+        lon_px = (max_lon - min_lon) / w
+        y_px = (top - bottom) / h
+        center_lat = (min_lat + max_lat) / 2
+        pixel_area_ha = (lon_px * AoiMask.METERS_PER_DEGREE * np.cos(np.radians(center_lat))) * \
+                        ((max_lat - min_lat) / h * AoiMask.METERS_PER_DEGREE) / 10000
+
+        def lat_at(row):
+            return float(AoiMask._mercator_lat(top - row * y_px))
+
+        zones = []
+        min_pixels = int(self.settings['min_zone_pixels'])
+        for label in range(1, n_labels):
+            x, y, bw, bh, area = (int(v) for v in stats[label])
+            if area < min_pixels:
+                continue
+            cx, cy = centroids[label]
+            zones.append({
+                'pixels': area,
+                'area_percent': round(area * 100.0 / total_valid, 2),
+                'area_ha': round(float(area * pixel_area_ha), 3),
+                'mean_delta': float(delta_sums[label] / area),
+                'centroid': [lat_at(cy + 0.5), float(min_lon + (cx + 0.5) * lon_px)],
+                'bounds': [[lat_at(y + bh), float(min_lon + x * lon_px)], [lat_at(y), float(min_lon + (x + bw) * lon_px)]],
+            })
+        zones.sort(key=lambda zone: zone['pixels'], reverse=True)
+        return zones[:int(self.settings['max_zones'])]
@@ -9,7 +9,7 @@ import re
 import socket
 import logging
 # <<< --- ИЗМЕНЕНИЕ: Добавляем импорт APIRouter --- >>>
-from fastapi import FastAPI, Query, APIRouter 
+from fastapi import FastAPI, Query, APIRouter, Header
 from fastapi.staticfiles import StaticFiles
 import time
 import os
@@ -144,6 +144,18 @@ class controller():
         async def get_log(password: str = Query(...)):
             return await self.func.get_log(password)
 
+        @api_router.get("/metrics")
+        async def get_metrics(password: str = Query(...)):
+            return await self.func.get_metrics(password)
+
+        @api_router.post("/storage/cleanup")
+        async def run_storage_cleanup(password: str = Query(...), vacuum: bool = Query(False)):
+            return await self.func.run_storage_cleanup(password, vacuum)
+
+        @api_router.get("/storage/usage")
+        async def get_storage_usage(token: str = Query(...)):
+            return await self.func.get_storage_usage(token)
+
         @api_router.get("/get_token")
         async def get_token(login: str = Query(...), password: str = Query(...)):
             return await self.func.get_token(login, password)
@@ -165,12 +177,12 @@ class controller():
             return await self.func.health_check()
 
         @api_router.put("/data/update")
-        async def update_user_data(token: str = Query(...), key_array: str = Query(...)):
-            return await self.func.update_user_data(token, key_array)
+        async def update_user_data(token: str = Query(...), key_array: str = Query(...), version: int = Query(None)):
+            return await self.func.update_user_data(token, key_array, version)
 
         @api_router.patch("/data/edit")
-        async def edit_user_data(token: str = Query(...), new_keys: str = Query(None), keys_to_add: str = Query(None), keys_to_remove: str = Query(None)):
-            return await self.func.edit_user_data(token, new_keys, keys_to_add, keys_to_remove)
+        async def edit_user_data(token: str = Query(...), new_keys: str = Query(None), keys_to_add: str = Query(None), keys_to_remove: str = Query(None), version: int = Query(None)):
+            return await self.func.edit_user_data(token, new_keys, keys_to_add, keys_to_remove, version)
 
         @api_router.delete("/data/delete")
         async def delete_user_data(token: str = Query(...)):
@@ -209,21 +221,37 @@ class controller():
             return await self.func.get_ndvi_image(lon, lat, start_date, end_date, token)
         
         @api_router.post("/analysis/perform")
-        async def perform_analysis(token: str = Query(...), start_date: str = Query(...), end_date: str = Query(...), lon: float = Query(None), lat: float = Query(None), radius_km: float = Query(0.5), polygon_coords: str = Query(None)):
-            return await self.func.perform_analysis(token, start_date, end_date, lon, lat, radius_km, polygon_coords)
+        async def perform_analysis(token: str = Query(...), start_date: str = Query(...), end_date: str = Query(...), lon: float = Query(None), lat: float = Query(None), radius_km: float = Query(0.5), polygon_coords: str = Query(None), inline_images: bool = Query(False), render_mode: str = Query(None), use_cache: bool = Query(True), base_analysis_id: str = Query(None)):
+            return await self.func.perform_analysis(token, start_date, end_date, lon, lat, radius_km, polygon_coords, inline_images, render_mode, use_cache, base_analysis_id)
+
+        @api_router.post("/analysis/perform/stream")
+        async def perform_analysis_stream(token: str = Query(...), start_date: str = Query(...), end_date: str = Query(...), lon: float = Query(None), lat: float = Query(None), radius_km: float = Query(0.5), polygon_coords: str = Query(None), render_mode: str = Query(None), use_cache: bool = Query(True), base_analysis_id: str = Query(None)):
+            return await self.func.perform_analysis_stream(token, start_date, end_date, lon, lat, radius_km, polygon_coords, render_mode, use_cache, base_analysis_id)
+
+        @api_router.post("/analysis/batch")
+        async def perform_batch_analysis(token: str = Query(...), field_ids: str = Query(...), start_date: str = Query(...), end_date: str = Query(...), render_mode: str = Query(None), use_cache: bool = Query(True)):
+            return await self.func.perform_batch_analysis(token, field_ids, start_date, end_date, render_mode, use_cache)
+
+        @api_router.post("/analysis/change")
+        async def perform_change_detection(token: str = Query(...), date_from: str = Query(None), date_to: str = Query(None), lon: float = Query(None), lat: float = Query(None), radius_km: float = Query(0.5), polygon_coords: str = Query(None), analysis_id_from: str = Query(None), analysis_id_to: str = Query(None), scene_from: int = Query(None), scene_to: int = Query(None)):
+            return await self.func.perform_change_detection(token, date_from, date_to, lon, lat, radius_km, polygon_coords, analysis_id_from, analysis_id_to, scene_from, scene_to)
 
         @api_router.get("/analysis/list")
-        async def get_analyses_list(token: str = Query(...)):
-            return await self.func.get_analyses_list(token)
+        async def get_analyses_list(token: str = Query(...), limit: int = Query(None), cursor: str = Query(None), date_from: str = Query(None), date_to: str = Query(None), bbox: str = Query(None), fields: str = Query(None)):
+            return await self.func.get_analyses_list(token, limit, cursor, date_from, date_to, bbox, fields)
 
         @api_router.get("/analysis/{analysis_id}")
-        async def get_analysis(analysis_id: str, token: str = Query(...)):
-            return await self.func.get_analysis(token, analysis_id)
+        async def get_analysis(analysis_id: str, token: str = Query(...), inline_images: bool = Query(False)):
+            return await self.func.get_analysis(token, analysis_id, inline_images)
 
         @api_router.delete("/analysis/{analysis_id}")
         async def delete_analysis(analysis_id: str, token: str = Query(...)):
             return await self.func.delete_analysis(token, analysis_id)
         
+        @api_router.get("/analysis/{analysis_id}/summary")
+        async def get_analysis_summary(analysis_id: str, token: str = Query(...)):
+            return await self.func.get_analysis_summary(token, analysis_id)
+
         @api_router.get("/analysis/{analysis_id}/recommendations")
         async def get_ai_recommendations(analysis_id: str, token: str = Query(...)):
             return await self.func.get_ai_recommendations(token, analysis_id,if_use_token=self.token_use)
@@ -238,6 +266,22 @@ class controller():
         ):
             return await self.func.get_historical_ndvi_data(token, lon, lat, radius_km, polygon_coords)
         
+        @api_router.get("/analysis/{analysis_id}/export/{scene_index}.tif")
+        async def export_scene_geotiff(analysis_id: str, scene_index: int, token: str = Query(...)):
+            return await self.func.export_scene_geotiff(token, analysis_id, scene_index)
+
+        @api_router.get("/analysis/{analysis_id}/scenes/{scene_index}/{layer}")
+        async def get_scene_layer_image(analysis_id: str, scene_index: int, layer: str, token: str = Query(...), format: str = Query(None), if_none_match: str = Header(None)):
+            return await self.func.get_scene_layer_image(token, analysis_id, scene_index, layer, format, if_none_match)
+
+        @api_router.get("/tiles/{analysis_id}/{scene_index}/{layer}/{z}/{x}/{y}.png")
+        async def get_tile(analysis_id: str, scene_index: int, layer: str, z: int, x: int, y: int, token: str = Query(...), if_none_match: str = Header(None)):
+            return await self.func.get_tile(token, analysis_id, scene_index, layer, z, x, y, if_none_match)
+
+        @api_router.get("/images/{blob_id}")
+        async def get_image_blob(blob_id: str, token: str = Query(...), if_none_match: str = Header(None)):
+            return await self.func.get_image_blob(token, blob_id, if_none_match)
+
         @api_router.post("/fields/save")
         async def save_user_field(token: str = Query(...), field_name: str = Query(...), area_of_interest: str = Query(...)):
             return await self.func.save_user_field(token, field_name, area_of_interest)
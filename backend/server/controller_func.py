@@ -2,12 +2,20 @@
 
 import random
 import logging
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response, JSONResponse, StreamingResponse
 import time
 from analysis_manager import AnalysisManager
 import os
 import json
+import base64
+import asyncio
+import functools
 from ImageProvider import ImageProvider
+from worker_pool import WorkerPool
+from async_db import AsyncDatabaseManager
+from recompression import RecompressionJob
+from retention import RetentionJob
+from single_flight import SingleFlight
 import ee # Добавлен импорт
 from gigachat_service import GigaChatService # <<< --- НОВЫЙ ИМПОРТ
 
@@ -17,36 +25,36 @@ class controller_func():
     # --- ИЗМЕНЕНО: Принимаем один объект db_manager ---
     def __init__(self, db_manager):
         self.db = db_manager
+        # Обработчики обращаются к БД только через асинхронный фасад, чтобы не блокировать event loop
+        self.adb = AsyncDatabaseManager(db_manager)
         self.analysis_manager = AnalysisManager(db_manager)
+        # Фоновое сжатие анализов и данных пользователей, сохраненных без сжатия
+        self.recompression = RecompressionJob(db_manager)
+        if self.recompression.settings.get('recompress_on_start', True):
+            self.recompression.start()
+        # Сроки хранения и квоты анализов, сборка мусора и очистка файла БД
+        self.retention = RetentionJob(db_manager)
+        self.retention.start()
         self.ai_service = GigaChatService() # <<< --- ИНИЦИАЛИЗАЦИЯ AI СЕРВИСА
 
-    def _get_user_data_object(self, token: str) -> dict:
-        """Вспомогательная функция для получения и парсинга данных пользователя."""
-        # ИЗМЕНЕНО
-        data_str = self.db.get_user_data(token)
-        if data_str:
-            try:
-                data_obj = json.loads(data_str)
-                # Убедимся, что все ключи существуют
-                if 'analyses' not in data_obj:
-                    data_obj['analyses'] = []
-                if 'saved_fields' not in data_obj:
-                    data_obj['saved_fields'] = []
-                return data_obj
-            except json.JSONDecodeError:
-                logger.warning(f"Не удалось распарсить JSON для токена {token}. Возвращаем пустую структуру.")
-                return {'analyses': [], 'saved_fields': []}
-        return {'analyses': [], 'saved_fields': []}
+    async def _encode_image_base64(self, array, output_type: str):
+        """Кодирует изображение в пуле потоков, не блокируя event loop. Возвращает (base64, формат)."""
+        loop = asyncio.get_running_loop()
+        data, media_type = await loop.run_in_executor(
+            WorkerPool.get('encode'), self.analysis_manager.encoder.encode, array, output_type
+        )
+        return base64.b64encode(data).decode(), media_type.split('/')[-1]
 
-    def _save_user_data_object(self, token: str, data_obj: dict) -> bool:
-        """Вспомогательная функция для сохранения объекта данных пользователя."""
-        try:
-            data_str = json.dumps(data_obj)
-            # ИЗМЕНЕНО
-            return self.db.save_user_data(token, data_str)
-        except Exception as e:
-            logger.error(f"Ошибка при сериализации и сохранении данных для токена {token}: {e}")
-            return False
+    async def _resolve_user_id(self, token: str):
+        """
+        ID пользователя по токену или None для невалидного токена. Обработчик определяет
+        пользователя один раз и дальше передает в БД и анализ только user_id; токен из кэша
+        проверяется без перехода в пул потоков БД.
+        """
+        user = self.db.token_cache.get(token) if token else None
+        if user is None:
+            user = await self.adb.resolve_token(token)
+        return user["user_id"] if user else None
 
     async def health_check(self):
         """Проверка здоровья сервера"""
@@ -64,7 +72,8 @@ class controller_func():
 
         try:
             # ИЗМЕНЕНО
-            if not self.db.if_token_exist(token):
+            user_id = await self._resolve_user_id(token)
+            if user_id is None:
                 logger.warning(f"Попытка сохранения данных для несуществующего токена: {token}")
                 return {
                     "status": "error",
@@ -72,7 +81,7 @@ class controller_func():
                 }
             
             # ИЗМЕНЕНО
-            success = self.db.save_user_data(token, key_array)
+            success = await self.adb.save_user_data(user_id, key_array)
 
             if not success:
                 logger.error(f"Не удалось сохранить данные для токена: {token}")
@@ -95,12 +104,14 @@ class controller_func():
     async def get_field_by_token(self, token: str):
         logger.info(f"Запрос данных для токена: {token}")
         try:
-            # ИЗМЕНЕНО
-            keys = self.db.get_user_data(token)
-            if keys is not None:
+            user_id = await self._resolve_user_id(token)
+            user_data = await self.adb.get_user_data_versioned(user_id) if user_id is not None else None
+            if user_data is not None and user_data[0] is not None:
+                keys, version = user_data
                 return {
                     "status": "success",
-                    "keys": keys
+                    "keys": keys,
+                    "version": version
                 }
             else:
                 return {
@@ -125,15 +136,70 @@ class controller_func():
             logger.error(f"Ошибка при чтении логов: {e}")
             return {"status": "error", "detail": "Файл логов не найден"}
 
+    async def get_metrics(self, password: str):
+        """Счетчики внутренних механизмов сервера (только для администратора)."""
+        logger.info("Запрос метрик сервера")
+        try:
+            if password != "12345":
+                logger.warning("Неудачная попытка доступа к метрикам")
+                return {"status": "error", "detail": "Доступ запрещен"}
+            return {
+                "status": "success",
+                "single_flight": SingleFlight.all_stats(),
+                "database": {**self.db.get_pool_stats(), "async": self.adb.get_stats()},
+                "token_cache": self.db.get_token_cache_stats(),
+                "compression": self.recompression.get_stats(),
+                "write_queue": self.db.get_write_queue_stats(),
+                "retention": await self.adb.run(self.retention.get_stats),
+                "user_data": self.db.get_user_data_stats(),
+                "memory_budget": self.analysis_manager.memory_budget.get_stats()
+            }
+        except Exception as e:
+            logger.error(f"Ошибка при получении метрик: {e}")
+            return {"status": "error", "detail": "Внутренняя ошибка сервера"}
+
+    async def run_storage_cleanup(self, password: str, vacuum: bool = False):
+        """Внеочередной проход очистки хранилища (только для администратора)."""
+        logger.info("Запрос внеочередной очистки хранилища")
+        try:
+            if password != "12345":
+                logger.warning("Неудачная попытка запуска очистки хранилища")
+                return {"status": "error", "detail": "Доступ запрещен"}
+            if not self.retention.trigger(vacuum=vacuum):
+                return {"status": "error", "detail": "Очистка хранилища отключена в настройках"}
+            return {"status": "success", "message": "Очистка хранилища запущена"}
+        except Exception as e:
+            logger.error(f"Ошибка при запуске очистки хранилища: {e}")
+            return {"status": "error", "detail": "Внутренняя ошибка сервера"}
+
+    async def get_storage_usage(self, token: str):
+        """Место, занятое анализами пользователя, и действующие ограничения хранения."""
+        logger.info(f"Запрос занятого места для токена: {token}")
+        try:
+            user_id = await self._resolve_user_id(token)
+            if user_id is None:
+                return {"status": "error", "detail": "Невалидный токен"}
+            usage = await self.adb.get_storage_usage(user_id)
+            if usage is None:
+                return {"status": "error", "detail": "Не удалось получить занятое место"}
+            limits = self.retention.limits() if self.retention.settings.get('enabled', True) else {}
+            return {"status": "success", **usage,
+                    "max_analyses": limits.get('max_analyses'),
+                    "max_age_days": limits.get('max_age_days'),
+                    "quota_bytes": limits.get('quota_bytes')}
+        except Exception as e:
+            logger.error(f"Ошибка при получении занятого места: {e}")
+            return {"status": "error", "detail": "Внутренняя ошибка сервера"}
+
     async def get_token(self, login: str, password: str):
         logger.info(f"Запрос токена для пользователя: {login}")
         try:
             # ИЗМЕНЕНО
-            token = self.db.get_token(login, password)
+            token = await self.adb.get_token(login, password)
 
             if token is None:
                 # ИЗМЕНЕНО
-                if not self.db.user_exists(login):
+                if not await self.adb.user_exists(login):
                     logger.warning(f"Пользователь не найден: {login}")
                     return {
                         "status": "error",
@@ -164,7 +230,7 @@ class controller_func():
 
         try:
             # ИЗМЕНЕНО
-            if self.db.user_exists(login):
+            if await self.adb.user_exists(login):
                 logger.warning(f"Попытка регистрации существующего пользователя: {login}")
                 return {
                     "status": "error",
@@ -174,13 +240,13 @@ class controller_func():
             logger.info(f"Генерация токена для пользователя: {login}")
             token = str(random.randint(10 * 10 ** 20, 10 * 10 ** 21))
             # ИЗМЕНЕНО
-            while self.db.if_token_exist(token):
+            while await self.adb.if_token_exist(token):
                 logger.debug(f"Токен {token} уже существует, генерируем новый")
                 token = str(random.randint(10 * 10 ** 20, 10 * 10 ** 21))
 
             logger.info(f"Добавление пользователя {login} с токеном: {token}")
             # ИЗМЕНЕНО
-            success = self.db.add_new_user(login, password, token, first_name, last_name)
+            success = await self.adb.add_new_user(login, password, token, first_name, last_name)
 
             if not success:
                 logger.error(f"Не удалось добавить пользователя: {login}")
@@ -213,7 +279,7 @@ class controller_func():
                 }
             
             # ИЗМЕНЕНО
-            users_list = self.db.get_all_users()
+            users_list = await self.adb.get_all_users()
             return {
                 "status": "success",
                 "users": users_list
@@ -228,7 +294,7 @@ class controller_func():
         logger.info(f"Запрос профиля пользователя по токену: {token}")
         try:
             # ИЗМЕНЕНО
-            user_info = self.db.get_user_info_by_token(token)
+            user_info = await self.adb.get_user_info_by_token(token)
 
             if user_info:
                 return {
@@ -245,46 +311,73 @@ class controller_func():
             logger.error(f"Ошибка при получении профиля пользователя: {e}")
             return {"status": "error", "detail": "Внутренняя ошибка сервера"}
 
-    # Методы /data/... теперь работают через _get/save_user_data_object, которые уже обновлены
-    async def update_user_data(self, token: str, key_array: str):
+    # Методы /data/... работают с версией данных пользователя: изменение с параметром version
+    # выполняется, только если данные не менялись с момента, когда клиент их прочитал
+    @staticmethod
+    def _user_data_conflict(result):
+        return {"status": "error", "detail": "Данные изменены другим клиентом, перечитайте их и повторите изменение",
+                "keys": result['data'], "version": result['version']}
+
+    async def update_user_data(self, token: str, key_array: str, version: int = None):
         logger.info(f"Запрос на обновление данных для токена: {token}")
         try:
-            success = self.db.save_user_data(token, key_array)
-            if success:
-                return {"status": "success", "message": "Данные успешно обновлены", "token": token}
-            else:
+            user_id = await self._resolve_user_id(token)
+            if user_id is None:
+                return {"status": "error", "detail": "Токен не найден или данные не обновлены"}
+            if version is None:
+                success = await self.adb.save_user_data(user_id, key_array)
+                if success:
+                    return {"status": "success", "message": "Данные успешно обновлены", "token": token}
                 return {"status": "error", "detail": "Токен не найден или данные не обновлены"}
+
+            result = await self.adb.update_user_data(user_id, lambda current: key_array, expected_version=version)
+            if result is None:
+                return {"status": "error", "detail": "Токен не найден или данные не обновлены"}
+            if not result['updated']:
+                return self._user_data_conflict(result)
+            return {"status": "success", "message": "Данные успешно обновлены", "token": token, "version": result['version']}
         except Exception as e:
             logger.error(f"Ошибка при обновлении данных для токена {token}: {e}")
             return {"status": "error", "detail": "Внутренняя ошибка сервера"}
 
-    async def edit_user_data(self, token: str, new_keys: str = None, keys_to_add: str = None, keys_to_remove: str = None):
+    @staticmethod
+    def _edit_key_array(current_key_array, new_keys: str = None, keys_to_add: str = None, keys_to_remove: str = None):
+        """Новая строка ключей для /data/edit; вызывается заново при каждом повторе после конфликта версий."""
+        if new_keys is not None:
+            return new_keys
+        updated_key_array = current_key_array
+        if keys_to_add:
+            current_keys = set(updated_key_array.split(',')) if updated_key_array else set()
+            keys_to_add_set = set(keys_to_add.split(','))
+            updated_key_array = ','.join(current_keys.union(keys_to_add_set))
+        if keys_to_remove:
+            current_keys = set(updated_key_array.split(',')) if updated_key_array else set()
+            keys_to_remove_set = set(keys_to_remove.split(','))
+            updated_key_array = ','.join(current_keys - keys_to_remove_set) if (current_keys - keys_to_remove_set) else ""
+        return updated_key_array
+
+    async def edit_user_data(self, token: str, new_keys: str = None, keys_to_add: str = None, keys_to_remove: str = None,
+                             version: int = None):
         logger.info(f"Запрос на редактирование данных для токена: {token}")
         try:
-            current_data_str = self.db.get_user_data(token)
-            if current_data_str is None:
+            user_id = await self._resolve_user_id(token)
+            user_data = await self.adb.get_user_data_versioned(user_id) if user_id is not None else None
+            if user_data is None or user_data[0] is None:
                 return {"status": "error", "detail": "Токен не найден"}
 
-            # Эта логика редактирования строки очень специфична и оставлена как есть
-            current_key_array = current_data_str
-            if new_keys is not None:
-                updated_key_array = new_keys
-            else:
-                updated_key_array = current_key_array
-                if keys_to_add:
-                    current_keys = set(updated_key_array.split(',')) if updated_key_array else set()
-                    keys_to_add_set = set(keys_to_add.split(','))
-                    updated_key_array = ','.join(current_keys.union(keys_to_add_set))
-                if keys_to_remove:
-                    current_keys = set(updated_key_array.split(',')) if updated_key_array else set()
-                    keys_to_remove_set = set(keys_to_remove.split(','))
-                    updated_key_array = ','.join(current_keys - keys_to_remove_set) if (current_keys - keys_to_remove_set) else ""
-            
-            success = self.db.save_user_data(token, updated_key_array)
-            if success:
-                return {"status": "success", "message": "Данные успешно отредактированы", "token": token}
-            else:
+            # Изменение применяется к актуальным данным: при одновременном изменении другим
+            # запросом оно повторяется на свежих данных, поэтому добавления и удаления ключей не теряются
+            result = await self.adb.update_user_data(
+                user_id, functools.partial(self._edit_key_array, new_keys=new_keys, keys_to_add=keys_to_add,
+                                         keys_to_remove=keys_to_remove),
+                expected_version=version)
+            if result is None:
+                return {"status": "error", "detail": "Не удалось отредактировать данные"}
+            if not result['updated']:
+                if version is not None:
+                    return self._user_data_conflict(result)
                 return {"status": "error", "detail": "Не удалось отредактировать данные"}
+            return {"status": "success", "message": "Данные успешно отредактированы", "token": token, "version": result['version']}
         except Exception as e:
             logger.error(f"Ошибка при редактировании данных для токена {token}: {e}")
             return {"status": "error", "detail": "Внутренняя ошибка сервера"}
@@ -293,8 +386,11 @@ class controller_func():
     async def delete_user_data(self, token: str):
         logger.info(f"Запрос на удаление данных для токена: {token}")
         try:
+            user_id = await self._resolve_user_id(token)
+            if user_id is None:
+                return {"status": "error", "detail": "Токен не найден"}
             # Удаляем, сохраняя пустой объект JSON
-            success = self.db.save_user_data(token, '{}')
+            success = await self.adb.save_user_data(user_id, '{}')
             if success:
                 return {"status": "success", "message": "Данные успешно удалены", "token": token}
             else:
@@ -307,7 +403,8 @@ class controller_func():
     async def check_user_data_exists(self, token: str):
         logger.info(f"Запрос проверки данных для токена: {token}")
         try:
-            data = self.db.get_user_data(token)
+            user_id = await self._resolve_user_id(token)
+            data = await self.adb.get_user_data(user_id) if user_id is not None else None
             exists = data is not None and data != '{}'
             return {"status": "success", "exists": exists, "token": token}
         except Exception as e:
@@ -318,10 +415,11 @@ class controller_func():
     async def set_field_data(self, field: str, data: str, token: str):
         logger.info(f"Запрос на установку данных для поля: {field}")
         try:
-            if not self.db.if_token_exist(token):
+            user_id = await self._resolve_user_id(token)
+            if user_id is None:
                 return {"status": "error", "detail": "Невалидный токен"}
 
-            success = self.db.save_generic_data(field, data)
+            success = await self.adb.save_generic_data(field, data)
             if success:
                 return {"status": "success", "message": "Данные поля успешно сохранены", "field": field}
             else:
@@ -333,10 +431,10 @@ class controller_func():
     async def get_field_data(self, field: str, token: str = None):
         logger.info(f"Запрос данных для поля: {field}")
         try:
-            if token and not self.db.if_token_exist(token):
+            if token and await self._resolve_user_id(token) is None:
                 return {"status": "error", "detail": "Невалидный токен"}
 
-            data = self.db.get_generic_data(field)
+            data = await self.adb.get_generic_data(field)
             if data is not None:
                 return {"status": "success", "field": field, "data": data}
             else:
@@ -348,10 +446,11 @@ class controller_func():
     async def delete_field_data(self, field: str, token: str):
         logger.info(f"Запрос на удаление данных поля: {field}")
         try:
-            if not self.db.if_token_exist(token):
+            user_id = await self._resolve_user_id(token)
+            if user_id is None:
                 return {"status": "error", "detail": "Невалидный токен"}
 
-            success = self.db.delete_generic_data(field)
+            success = await self.adb.delete_generic_data(field)
             if success:
                 return {"status": "success", "message": "Данные поля успешно удалены", "field": field}
             else:
@@ -363,10 +462,10 @@ class controller_func():
     async def check_field_exists(self, field: str, token: str = None):
         logger.info(f"Запрос проверки существования поля: {field}")
         try:
-            if token and not self.db.if_token_exist(token):
+            if token and await self._resolve_user_id(token) is None:
                 return {"status": "error", "detail": "Невалидный токен"}
 
-            exists = self.db.generic_data_exists(field)
+            exists = await self.adb.generic_data_exists(field)
             return {"status": "success", "field": field, "exists": exists}
         except Exception as e:
             logger.error(f"Ошибка при проверке поля {field}: {e}")
@@ -378,7 +477,8 @@ class controller_func():
 
         try:
             # ИЗМЕНЕНО
-            if not self.db.if_token_exist(token):
+            user_id = await self._resolve_user_id(token)
+            if user_id is None:
                 logger.warning(f"Попытка получения изображения с невалидным токеном: {token}")
                 return {
                     "status": "error",
@@ -393,25 +493,14 @@ class controller_func():
                 end_date=end_date
             )
 
-            # Конвертируем RGB изображение в base64
-            import base64
-            from io import BytesIO
-            from PIL import Image
-            
-            # Конвертируем numpy array в PIL Image
-            rgb_image_pil = Image.fromarray(provider.rgb_image.astype('uint8'))
-            
-            # Конвертируем в base64
-            buffered = BytesIO()
-            rgb_image_pil.save(buffered, format="JPEG")
-            img_str = base64.b64encode(buffered.getvalue()).decode()
+            img_str, image_format = await self._encode_image_base64(provider.rgb_image.astype('uint8'), 'rgb')
 
             logger.info(f"RGB изображение успешно получено для координат: {lon}, {lat}")
             return {
                 "status": "success",
                 "image_type": "rgb",
                 "image_data": img_str,
-                "format": "jpeg",
+                "format": image_format,
                 "coordinates": {"lon": lon, "lat": lat},
                 "date_range": {"start": start_date, "end": end_date}
             }
@@ -429,7 +518,8 @@ class controller_func():
 
         try:
             # ИЗМЕНЕНО
-            if not self.db.if_token_exist(token):
+            user_id = await self._resolve_user_id(token)
+            if user_id is None:
                 logger.warning(f"Попытка получения изображения с невалидным токеном: {token}")
                 return {
                     "status": "error",
@@ -448,23 +538,14 @@ class controller_func():
             red_channel_normalized = (provider.red_channel - provider.red_channel.min()) / (provider.red_channel.max() - provider.red_channel.min()) * 255
             red_channel_uint8 = red_channel_normalized.astype('uint8')
 
-            # Конвертируем в base64
-            import base64
-            from io import BytesIO
-            from PIL import Image
-            
-            red_image_pil = Image.fromarray(red_channel_uint8)
-            
-            buffered = BytesIO()
-            red_image_pil.save(buffered, format="JPEG")
-            img_str = base64.b64encode(buffered.getvalue()).decode()
+            img_str, image_format = await self._encode_image_base64(red_channel_uint8, 'channel')
 
             logger.info(f"Красный канал успешно получен для координат: {lon}, {lat}")
             return {
                 "status": "success",
                 "image_type": "red_channel",
                 "image_data": img_str,
-                "format": "jpeg",
+                "format": image_format,
                 "coordinates": {"lon": lon, "lat": lat},
                 "date_range": {"start": start_date, "end": end_date},
                 "statistics": {
@@ -487,7 +568,8 @@ class controller_func():
 
         try:
             # ИЗМЕНЕНО
-            if not self.db.if_token_exist(token):
+            user_id = await self._resolve_user_id(token)
+            if user_id is None:
                 logger.warning(f"Попытка получения NDVI с невалидным токеном: {token}")
                 return {
                     "status": "error",
@@ -508,23 +590,14 @@ class controller_func():
             # Нормализуем NDVI от -1 до 1 для визуализации
             ndvi_normalized = ((ndvi + 1) / 2 * 255).clip(0, 255).astype('uint8')
 
-            # Конвертируем в base64
-            import base64
-            from io import BytesIO
-            from PIL import Image
-            
-            ndvi_image_pil = Image.fromarray(ndvi_normalized)
-            
-            buffered = BytesIO()
-            ndvi_image_pil.save(buffered, format="JPEG")
-            img_str = base64.b64encode(buffered.getvalue()).decode()
+            img_str, image_format = await self._encode_image_base64(ndvi_normalized, 'index')
 
             logger.info(f"NDVI успешно получен для координат: {lon}, {lat}")
             return {
                 "status": "success",
                 "image_type": "ndvi",
                 "image_data": img_str,
-                "format": "jpeg",
+                "format": image_format,
                 "coordinates": {"lon": lon, "lat": lat},
                 "date_range": {"start": start_date, "end": end_date},
                 "statistics": {
@@ -540,34 +613,53 @@ class controller_func():
                 "status": "error",
                 "detail": f"Не удалось вычислить NDVI: {str(e)}"
             }
+    def _parse_polygon_coords(self, polygon_coords: str):
+        """Разбирает JSON-строку полигона [[lon, lat], ...]; None, если полигон не указан."""
+        if not polygon_coords:
+            return None
+        parsed_polygon_coords = json.loads(polygon_coords)
+        if not isinstance(parsed_polygon_coords, list) or not all(
+                isinstance(p, list) and len(p) == 2 and all(
+                    isinstance(coord, (int, float)) for coord in p) for p in parsed_polygon_coords):
+            raise ValueError("polygon_coords должен быть списком списков координат [[lon, lat], ...]")
+        return parsed_polygon_coords
+
     async def perform_analysis(self, token: str, start_date: str, end_date: str,
                              lon: float = None, lat: float = None,
                              radius_km: float = 0.5,
-                             polygon_coords: str = None):
-        """Выполняет полный анализ по координатам точки с радиусом или по полигону."""
+                             polygon_coords: str = None,
+                             inline_images: bool = False,
+                             render_mode: str = None,
+                             use_cache: bool = True,
+                             base_analysis_id: str = None):
+        """Выполняет полный анализ по координатам точки с радиусом или по полигону (или расширяет сохраненный анализ)."""
         logger.info(f"Запрос полного анализа для токена {token}")
 
         try:
             # ИЗМЕНЕНО
-            if not self.db.if_token_exist(token):
+            user_id = await self._resolve_user_id(token)
+            if user_id is None:
                 logger.warning(f"Попытка анализа с невалидным токеном: {token}")
                 return {"status": "error", "detail": "Невалидный токен"}
 
-            parsed_polygon_coords = None
-            if polygon_coords:
-                try:
-                    parsed_polygon_coords = json.loads(polygon_coords)
-                    if not isinstance(parsed_polygon_coords, list) or not all(
-                            isinstance(p, list) and len(p) == 2 and all(
-                                isinstance(coord, (int, float)) for coord in p) for p in parsed_polygon_coords):
-                        raise ValueError("polygon_coords должен быть списком списков координат [[lon, lat], ...]")
-                except (json.JSONDecodeError, ValueError) as e:
-                    logger.error(f"Ошибка парсинга polygon_coords='{polygon_coords}': {e}")
-                    return {"status": "error", "detail": f"Неверный формат polygon_coords: {e}"}
-            
-            result = self.analysis_manager.perform_complete_analysis(
-                token=token, start_date=start_date, end_date=end_date, lon=lon,
-                lat=lat, radius_km=radius_km, polygon_coords=parsed_polygon_coords
+            try:
+                parsed_polygon_coords = self._parse_polygon_coords(polygon_coords)
+            except (json.JSONDecodeError, ValueError) as e:
+                logger.error(f"Ошибка парсинга polygon_coords='{polygon_coords}': {e}")
+                return {"status": "error", "detail": f"Неверный формат polygon_coords: {e}"}
+
+            # Анализ выполняется в отдельном пуле, чтобы не блокировать event loop
+            # и чтобы одновременные одинаковые запросы могли объединиться
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(
+                WorkerPool.get('analysis'),
+                functools.partial(
+                    self.analysis_manager.perform_complete_analysis,
+                    user_id=user_id, start_date=start_date, end_date=end_date, lon=lon,
+                    lat=lat, radius_km=radius_km, polygon_coords=parsed_polygon_coords,
+                    inline_images=inline_images, render_mode=render_mode, use_cache=use_cache,
+                    base_analysis_id=base_analysis_id
+                )
             )
 
             return result
@@ -576,44 +668,294 @@ class controller_func():
             logger.error(f"Ошибка при выполнении анализа: {e}")
             return {"status": "error", "detail": f"Не удалось выполнить анализ: {str(e)}"}
 
-    async def get_analyses_list(self, token: str):
-        """Получает список всех анализов пользователя"""
-        logger.info(f"Запрос списка анализов для токена: {token}")
+    async def perform_batch_analysis(self, token: str, field_ids: str, start_date: str, end_date: str,
+                                     render_mode: str = None, use_cache: bool = True):
+        """Выполняет анализ нескольких сохраненных полей с общей загрузкой снимков."""
+        logger.info(f"Запрос пакетного анализа для токена {token}")
         try:
-            # ИЗМЕНЕНО
-            if not self.db.if_token_exist(token):
+            user_id = await self._resolve_user_id(token)
+            if user_id is None:
+                logger.warning(f"Попытка анализа с невалидным токеном: {token}")
                 return {"status": "error", "detail": "Невалидный токен"}
-            
-            user_data_obj = self._get_user_data_object(token)
-            return {"status": "success", "analyses": user_data_obj.get('analyses', [])}
+
+            try:
+                parsed_field_ids = json.loads(field_ids)
+                if not isinstance(parsed_field_ids, list) or not parsed_field_ids:
+                    raise ValueError("field_ids должен быть непустым списком ID полей")
+                parsed_field_ids = [str(field_id) for field_id in parsed_field_ids]
+            except (json.JSONDecodeError, ValueError) as e:
+                logger.error(f"Ошибка парсинга field_ids='{field_ids}': {e}")
+                return {"status": "error", "detail": f"Неверный формат field_ids: {e}"}
+
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                WorkerPool.get('analysis'),
+                functools.partial(
+                    self.analysis_manager.perform_batch_analysis,
+                    user_id=user_id, field_ids=parsed_field_ids, start_date=start_date, end_date=end_date,
+                    render_mode=render_mode, use_cache=use_cache
+                )
+            )
 
+        except Exception as e:
+            logger.error(f"Ошибка при выполнении пакетного анализа: {e}")
+            return {"status": "error", "detail": f"Не удалось выполнить анализ: {str(e)}"}
+
+    async def perform_change_detection(self, token: str, date_from: str = None, date_to: str = None,
+                                       lon: float = None, lat: float = None, radius_km: float = 0.5,
+                                       polygon_coords: str = None, analysis_id_from: str = None,
+                                       analysis_id_to: str = None, scene_from: int = None, scene_to: int = None):
+        """Сравнивает два снимка одного поля по датам или по сохраненным анализам."""
+        logger.info(f"Запрос сравнения снимков для токена {token}")
+        try:
+            user_id = await self._resolve_user_id(token)
+            if user_id is None:
+                logger.warning(f"Попытка сравнения с невалидным токеном: {token}")
+                return {"status": "error", "detail": "Невалидный токен"}
+
+            try:
+                parsed_polygon_coords = self._parse_polygon_coords(polygon_coords)
+            except (json.JSONDecodeError, ValueError) as e:
+                logger.error(f"Ошибка парсинга polygon_coords='{polygon_coords}': {e}")
+                return {"status": "error", "detail": f"Неверный формат polygon_coords: {e}"}
+
+            # Для сравнения по датам может понадобиться анализ, поэтому используется пул анализа
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                WorkerPool.get('analysis'),
+                functools.partial(
+                    self.analysis_manager.perform_change_detection,
+                    user_id=user_id, date_from=date_from, date_to=date_to, lon=lon, lat=lat,
+                    radius_km=radius_km, polygon_coords=parsed_polygon_coords,
+                    analysis_id_from=analysis_id_from, analysis_id_to=analysis_id_to,
+                    scene_from=scene_from, scene_to=scene_to
+                )
+            )
+
+        except Exception as e:
+            logger.error(f"Ошибка при сравнении снимков: {e}")
+            return {"status": "error", "detail": f"Не удалось выполнить сравнение: {str(e)}"}
+
+    async def perform_analysis_stream(self, token: str, start_date: str, end_date: str,
+                                      lon: float = None, lat: float = None,
+                                      radius_km: float = 0.5,
+                                      polygon_coords: str = None,
+                                      render_mode: str = None,
+                                      use_cache: bool = True,
+                                      base_analysis_id: str = None):
+        """
+        Выполняет анализ, передавая прогресс и готовые снимки потоком NDJSON (одно событие JSON на строку).
+        Анализ выполняется в пуле потоков независимо от соединения: если клиент отключится,
+        анализ все равно будет завершен и сохранен, а результат можно получить по analysis_id.
+        """
+        logger.info(f"Запрос потокового анализа для токена {token}")
+
+        def single_event(event):
+            async def body():
+                yield json.dumps(event, ensure_ascii=False, default=str) + "\n"
+            return StreamingResponse(body(), media_type="application/x-ndjson")
+
+        try:
+            user_id = await self._resolve_user_id(token)
+            if user_id is None:
+                logger.warning(f"Попытка анализа с невалидным токеном: {token}")
+                return single_event({"event": "error", "status": "error", "detail": "Невалидный токен"})
+            try:
+                parsed_polygon_coords = self._parse_polygon_coords(polygon_coords)
+            except (json.JSONDecodeError, ValueError) as e:
+                logger.error(f"Ошибка парсинга polygon_coords='{polygon_coords}': {e}")
+                return single_event({"event": "error", "status": "error", "detail": f"Неверный формат polygon_coords: {e}"})
+
+            loop = asyncio.get_running_loop()
+            queue = asyncio.Queue()
+
+            def run():
+                try:
+                    for event in self.analysis_manager.stream_complete_analysis(
+                            user_id=user_id, start_date=start_date, end_date=end_date, lon=lon,
+                            lat=lat, radius_km=radius_km, polygon_coords=parsed_polygon_coords,
+                            render_mode=render_mode, use_cache=use_cache, base_analysis_id=base_analysis_id):
+                        loop.call_soon_threadsafe(queue.put_nowait, event)
+                finally:
+                    loop.call_soon_threadsafe(queue.put_nowait, None)
+
+            loop.run_in_executor(WorkerPool.get('analysis'), run)
+
+            async def body():
+                while True:
+                    event = await queue.get()
+                    if event is None:
+                        break
+                    yield json.dumps(event, ensure_ascii=False, default=str) + "\n"
+
+            return StreamingResponse(body(), media_type="application/x-ndjson")
+
+        except Exception as e:
+            logger.error(f"Ошибка при запуске потокового анализа: {e}")
+            return single_event({"event": "error", "status": "error", "detail": f"Не удалось выполнить анализ: {str(e)}"})
+
+    async def get_analyses_list(self, token: str, limit: int = None, cursor: str = None,
+                                date_from: str = None, date_to: str = None, bbox: str = None,
+                                fields: str = None):
+        """Получает страницу списка анализов пользователя"""
+        logger.info(f"Запрос списка анализов для токена: {token}")
+        try:
+            user_id = await self._resolve_user_id(token)
+            if user_id is None:
+                return {"status": "error", "detail": "Невалидный токен"}
+            bbox_values = None
+            if bbox:
+                try:
+                    bbox_values = [float(value) for value in bbox.split(',')]
+                except ValueError:
+                    return {"status": "error", "detail": "bbox должен быть задан как min_lon,min_lat,max_lon,max_lat"}
+            return await self.adb.run(self.analysis_manager.list_analyses, user_id, limit=limit, cursor=cursor,
+                                      date_from=date_from, date_to=date_to, bbox=bbox_values,
+                                      projection=fields or 'bounds')
         except Exception as e:
             logger.error(f"Ошибка при получении списка анализов: {e}")
             return {"status": "error", "detail": str(e)}
 
-    async def get_analysis(self, token: str, analysis_id: str):
+    async def get_analysis(self, token: str, analysis_id: str, inline_images: bool = False):
         """Получает конкретный анализ по ID"""
         logger.info(f"Запрос анализа {analysis_id} для токена: {token}")
         try:
             # ИЗМЕНЕНО
-            if not self.db.if_token_exist(token):
+            user_id = await self._resolve_user_id(token)
+            if user_id is None:
                 return {"status": "error", "detail": "Невалидный токен"}
 
-            result = self.analysis_manager.get_analysis_by_id(token, analysis_id)
+            result = await self.adb.run(self.analysis_manager.get_analysis_by_id, user_id, analysis_id, inline_images=inline_images)
             return result
         except Exception as e:
             logger.error(f"Ошибка при получении анализа: {e}")
             return {"status": "error", "detail": str(e)}
 
+    async def _blob_response(self, blob_id: str, if_none_match: str = None, media_type: str = None, data: bytes = None):
+        """
+        Бинарный ответ с изображением из хранилища; поддерживает ETag/If-None-Match.
+        Готовые данные (data) отдаются без чтения хранилища.
+        """
+        # Содержимое адресуется хэшем, поэтому blob_id сам по себе является сильным ETag
+        etag = f'"{blob_id}"'
+        headers = {"ETag": etag, "Cache-Control": "private, max-age=31536000, immutable"}
+        if if_none_match and etag in [tag.strip() for tag in if_none_match.split(',')]:
+            return Response(status_code=304, headers=headers)
+
+        if data is not None:
+            return Response(content=data, media_type=media_type, headers=headers)
+        blob = await self.adb.get_blob(blob_id)
+        if blob is None:
+            return JSONResponse(status_code=404, content={"status": "error", "detail": "Изображение не найдено"})
+
+        data, stored_media_type = blob
+        return Response(content=data, media_type=media_type or stored_media_type, headers=headers)
+
+    async def get_image_blob(self, token: str, blob_id: str, if_none_match: str = None):
+        """
+        Отдает сохраненное изображение анализа в бинарном виде с ETag. Изображение доступно только
+        владельцу анализа, который на него ссылается (или пользователю, за которым оно закреплено);
+        доступ проверяется и перед ответом 304.
+        """
+        try:
+            user_id = await self._resolve_user_id(token)
+            if user_id is None:
+                return JSONResponse(status_code=403, content={"status": "error", "detail": "Невалидный токен"})
+            if not await self.adb.user_owns_blob(user_id, blob_id):
+                return JSONResponse(status_code=404, content={"status": "error", "detail": "Изображение не найдено"})
+            return await self._blob_response(blob_id, if_none_match)
+        except Exception as e:
+            logger.error(f"Ошибка при получении изображения {blob_id}: {e}")
+            return JSONResponse(status_code=500, content={"status": "error", "detail": "Внутренняя ошибка сервера"})
+
+    async def get_scene_layer_image(self, token: str, analysis_id: str, scene_index: int, layer: str,
+                                    image_format: str = None, if_none_match: str = None):
+        """Отдает изображение слоя снимка анализа, строя его по сохраненному растру при первом запросе."""
+        logger.info(f"Запрос слоя {layer} снимка {scene_index} анализа {analysis_id}")
+        try:
+            user_id = await self._resolve_user_id(token)
+            if user_id is None:
+                return JSONResponse(status_code=403, content={"status": "error", "detail": "Невалидный токен"})
+
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(
+                WorkerPool.get('render'), self.analysis_manager.render_scene_layer,
+                user_id, analysis_id, scene_index, layer, image_format
+            )
+            if result.get('status') != 'success':
+                return JSONResponse(status_code=404, content=result)
+            return await self._blob_response(result['blob_id'], if_none_match, result['media_type'])
+        except Exception as e:
+            logger.error(f"Ошибка при получении слоя {layer} анализа {analysis_id}: {e}")
+            return JSONResponse(status_code=500, content={"status": "error", "detail": "Внутренняя ошибка сервера"})
+
+    async def get_tile(self, token: str, analysis_id: str, scene_index: int, layer: str,
+                       z: int, x: int, y: int, if_none_match: str = None):
+        """Отдает тайл карты z/x/y слоя снимка анализа, нарезая его из сохраненного растра при первом запросе."""
+        try:
+            user_id = await self._resolve_user_id(token)
+            if user_id is None:
+                return JSONResponse(status_code=403, content={"status": "error", "detail": "Невалидный токен"})
+
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(
+                WorkerPool.get('render'), self.analysis_manager.render_tile,
+                user_id, analysis_id, scene_index, layer, z, x, y
+            )
+            if result.get('status') != 'success':
+                return JSONResponse(status_code=404, content=result)
+            return await self._blob_response(result['blob_id'], if_none_match, result['media_type'], result.get('data'))
+        except Exception as e:
+            logger.error(f"Ошибка при получении тайла {z}/{x}/{y} слоя {layer} анализа {analysis_id}: {e}")
+            return JSONResponse(status_code=500, content={"status": "error", "detail": "Внутренняя ошибка сервера"})
+
+    async def export_scene_geotiff(self, token: str, analysis_id: str, scene_index: int):
+        """Отдает карты индексов снимка в виде Cloud-Optimized GeoTIFF, передавая файл по частям."""
+        logger.info(f"Запрос экспорта GeoTIFF снимка {scene_index} анализа {analysis_id}")
+        try:
+            user_id = await self._resolve_user_id(token)
+            if user_id is None:
+                return JSONResponse(status_code=403, content={"status": "error", "detail": "Невалидный токен"})
+
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(
+                WorkerPool.get('render'), self.analysis_manager.prepare_geotiff_export,
+                user_id, analysis_id, scene_index
+            )
+            if result.get('status') != 'success':
+                return JSONResponse(status_code=404, content=result)
+            headers = {
+                "Content-Length": str(result['content_length']),
+                "Content-Disposition": f'attachment; filename="{result["filename"]}"',
+            }
+            return StreamingResponse(result['writer'].iter_bytes(), media_type="image/tiff", headers=headers)
+        except Exception as e:
+            logger.error(f"Ошибка экспорта GeoTIFF снимка {scene_index} анализа {analysis_id}: {e}")
+            return JSONResponse(status_code=500, content={"status": "error", "detail": "Внутренняя ошибка сервера"})
+
+    async def get_analysis_summary(self, token: str, analysis_id: str):
+        """Возвращает краткую сводку анализа: средние индексов и статистику снимков без изображений."""
+        logger.info(f"Запрос сводки анализа {analysis_id} для токена: {token}")
+        try:
+            user_id = await self._resolve_user_id(token)
+            if user_id is None:
+                return {"status": "error", "detail": "Невалидный токен"}
+
+            return await self.adb.run(self.analysis_manager.get_analysis_summary, user_id, analysis_id)
+        except Exception as e:
+            logger.error(f"Ошибка при получении сводки анализа: {e}")
+            return {"status": "error", "detail": str(e)}
+
     async def delete_analysis(self, token: str, analysis_id: str):
         """Удаляет анализ"""
         logger.info(f"Запрос удаления анализа {analysis_id} для токена: {token}")
         try:
             # ИЗМЕНЕНО
-            if not self.db.if_token_exist(token):
+            user_id = await self._resolve_user_id(token)
+            if user_id is None:
                 return {"status": "error", "detail": "Невалидный токен"}
 
-            result = self.analysis_manager.delete_analysis(token, analysis_id)
+            result = await self.adb.run(self.analysis_manager.delete_analysis, user_id, analysis_id)
             return result
         except Exception as e:
             logger.error(f"Ошибка при удалении анализа: {e}")
@@ -624,34 +966,16 @@ class controller_func():
         if if_use_token:
             logger.info(f"Запрос AI-рекомендаций для анализа {analysis_id}")
             try:
-                if not self.db.if_token_exist(token):
+                user_id = await self._resolve_user_id(token)
+                if user_id is None:
                     return {"status": "error", "detail": "Невалидный токен"}
 
-                analysis_result = self.analysis_manager.get_analysis_by_id(token, analysis_id)
-                if analysis_result.get('status') != 'success':
-                    return analysis_result
-
-                analysis_data = analysis_result['data']
-
-                # Вычисляем средние значения для ВСЕХ индексов за весь период
-                average_indices = {}
-                results_per_image = analysis_data.get('results_per_image', [])
-                image_count = len(results_per_image)
+                # Средние значения всех индексов за период берутся из сводки, без загрузки данных анализа
+                summary_result = await self.adb.run(self.analysis_manager.get_analysis_summary, user_id, analysis_id)
+                if summary_result.get('status') != 'success':
+                    return summary_result
 
-                if image_count > 0:
-                    # Список индексов, для которых нужно посчитать среднее
-                    indices_to_process = ['ndvi', 'savi', 'evi', 'vari']
-
-                    for index_name in indices_to_process:
-                        # Собираем все средние значения для текущего индекса по всем снимкам
-                        all_means = [
-                            r['statistics'][index_name]['mean']
-                            for r in results_per_image
-                            if index_name in r.get('statistics', {})
-                        ]
-                        # Считаем среднее арифметическое и сохраняем, если есть данные
-                        if all_means:
-                            average_indices[index_name] = sum(all_means) / len(all_means)
+                average_indices = summary_result['summary']['averages']
 
                 if not average_indices:
                     return {"status": "error", "detail": "В данных анализа отсутствуют статистики для расчета средних значений индексов."}
@@ -680,7 +1004,8 @@ class controller_func():
         logger.info(f"Запрос сохранения поля '{field_name}' для токена {token}")
         try:
             # ИЗМЕНЕНО
-            if not self.db.if_token_exist(token):
+            user_id = await self._resolve_user_id(token)
+            if user_id is None:
                 return {"status": "error", "detail": "Невалидный токен"}
 
             try:
@@ -688,17 +1013,15 @@ class controller_func():
             except json.JSONDecodeError:
                 return {"status": "error", "detail": "Неверный формат area_of_interest"}
 
-            user_data_obj = self._get_user_data_object(token)
-            
+            created_at = time.time()
             new_field = {
-                "id": str(int(time.time())),
+                # Миллисекунды: два поля, сохраненные в одну секунду, получают разные ID
+                "id": str(int(created_at * 1000)),
                 "name": field_name,
                 "area_of_interest": aoi_data
             }
-            
-            user_data_obj['saved_fields'].insert(0, new_field)
 
-            if self._save_user_data_object(token, user_data_obj):
+            if await self.adb.add_field(user_id, new_field["id"], field_name, json.dumps(aoi_data), created_at):
                 return {"status": "success", "message": "Поле успешно сохранено", "field": new_field}
             else:
                 return {"status": "error", "detail": "Не удалось сохранить данные"}
@@ -719,7 +1042,8 @@ class controller_func():
         """Возвращает историю среднего NDVI для области."""
         logger.info(f"Запрос истории NDVI для токена {token}")
         
-        if not self.db.if_token_exist(token):
+        user_id = await self._resolve_user_id(token)
+        if user_id is None:
             return {"status": "error", "detail": "Невалидный токен"}
 
         try:
@@ -764,11 +1088,15 @@ class controller_func():
         logger.info(f"Запрос списка полей для токена {token}")
         try:
             # ИЗМЕНЕНО
-            if not self.db.if_token_exist(token):
+            user_id = await self._resolve_user_id(token)
+            if user_id is None:
                 return {"status": "error", "detail": "Невалидный токен"}
 
-            user_data_obj = self._get_user_data_object(token)
-            return {"status": "success", "fields": user_data_obj.get('saved_fields', [])}
+            fields = await self.adb.get_fields(user_id) or []
+            return {"status": "success", "fields": [
+                {"id": field["id"], "name": field["name"], "area_of_interest": json.loads(field["area_of_interest"])}
+                for field in fields
+            ]}
 
         except Exception as e:
             logger.error(f"Ошибка при получении списка полей: {e}")
@@ -779,23 +1107,13 @@ class controller_func():
         logger.info(f"Запрос удаления поля ID {field_id} для токена {token}")
         try:
             # ИЗМЕНЕНО
-            if not self.db.if_token_exist(token):
+            user_id = await self._resolve_user_id(token)
+            if user_id is None:
                 return {"status": "error", "detail": "Невалидный токен"}
 
-            user_data_obj = self._get_user_data_object(token)
-            
-            initial_count = len(user_data_obj['saved_fields'])
-            user_data_obj['saved_fields'] = [
-                field for field in user_data_obj['saved_fields'] if field.get('id') != field_id
-            ]
-            
-            if len(user_data_obj['saved_fields']) == initial_count:
+            if not await self.adb.delete_field(user_id, field_id):
                 return {"status": "error", "detail": "Поле с таким ID не найдено"}
-
-            if self._save_user_data_object(token, user_data_obj):
-                return {"status": "success", "message": "Поле успешно удалено"}
-            else:
-                return {"status": "error", "detail": "Не удалось сохранить изменения"}
+            return {"status": "success", "message": "Поле успешно удалено"}
 
         except Exception as e:
             logger.error(f"Ошибка при удалении поля: {e}")
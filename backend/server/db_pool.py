@@ -0,0 +1,108 @@
+# --- START OF FILE db_pool.py ---
+
+import sqlite3
+import threading
+import logging
+from typing import Dict
+from app_config import AppConfig
+
+logger = logging.getLogger(__name__)
+
+class ConnectionPool:
+    """
+    Пул постоянных соединений SQLite: у каждого потока свое соединение, которое
+    открывается и настраивается один раз и дальше переиспользуется всеми запросами
+    этого потока. Соединения не передаются между потоками, поэтому блокировки
+    на уровне пула нужны только для учета соединений.
+    Соединение работает в режиме WAL: запись не блокирует читателей. Подготовленные
+    выражения кэшируются самим sqlite3 (параметр cached_statements) и тоже
+    переиспользуются между запросами потока.
+    Параметры задаются в секции "database" файла конфигурации, например:
+        {"database": {"synchronous": "FULL", "cache_size_mb": 128}}
+    """
+    DEFAULT_SETTINGS = {
+        'journal_mode': 'WAL',
+        # NORMAL в режиме WAL не теряет целостность при сбое, но последние транзакции
+        # могут откатиться при отключении питания; FULL - fsync на каждый коммит
+        'synchronous': 'NORMAL',
+        'mmap_size_mb': 256,
+        'cache_size_mb': 64,
+        'busy_timeout_ms': 5000,
+        'cached_statements': 256,
+    }
+    SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+    def __init__(self, db_path: str, settings: Dict = None):
+        self.db_path = db_path
+        self.settings = settings if settings is not None else AppConfig.get_section('database', self.DEFAULT_SETTINGS)
+        synchronous = str(self.settings['synchronous']).upper()
+        if synchronous not in self.SYNCHRONOUS_LEVELS:
+            raise ValueError(f"Неизвестный уровень synchronous: {synchronous}")
+        self.settings['synchronous'] = synchronous
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Соединения всех потоков: поток -> соединение; нужно для метрик и закрытия соединений завершившихся потоков
+        self._connections = {}
+        self._stats = {'created': 0, 'acquired': 0, 'closed': 0}
+
+    def _connect(self) -> sqlite3.Connection:
+        # check_same_thread=False только для закрытия соединения из другого потока;
+        # запросы к соединению выполняет лишь поток-владелец
+        conn = sqlite3.connect(self.db_path, timeout=self.settings['busy_timeout_ms'] / 1000,
+                               cached_statements=int(self.settings['cached_statements']),
+                               check_same_thread=False)
+        conn.execute(f"PRAGMA journal_mode = {self.settings['journal_mode']};")
+        conn.execute(f"PRAGMA synchronous = {self.settings['synchronous']};")
+        conn.execute(f"PRAGMA mmap_size = {int(self.settings['mmap_size_mb']) * 1024 * 1024};")
+        # Отрицательное значение cache_size - размер в КиБ, а не в страницах
+        conn.execute(f"PRAGMA cache_size = {-int(self.settings['cache_size_mb']) * 1024};")
+        conn.execute(f"PRAGMA busy_timeout = {int(self.settings['busy_timeout_ms'])};")
+        conn.execute("PRAGMA foreign_keys = ON;")
+        return conn
+
+    def _close_dead_threads(self):
+        """Закрывает соединения потоков, которые уже завершились. Вызывается под self._lock."""
+        for thread in [t for t in self._connections if not t.is_alive()]:
+            try:
+                self._connections.pop(thread).close()
+            except sqlite3.Error as e:
+                logger.warning(f"Ошибка закрытия соединения завершившегося потока {thread.name}: {e}")
+            self._stats['closed'] += 1
+
+    def get(self) -> sqlite3.Connection:
+        """Соединение текущего потока; создается при первом обращении потока."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._lock:
+                self._close_dead_threads()
+                self._connections[threading.current_thread()] = conn
+                self._stats['created'] += 1
+                self._stats['acquired'] += 1
+            logger.info(f"Открыто соединение с {self.db_path} для потока {threading.current_thread().name}")
+            return conn
+        with self._lock:
+            self._stats['acquired'] += 1
+        return conn
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['open'] = len(self._connections)
+        stats['reused'] = stats['acquired'] - stats['created']
+        stats['settings'] = dict(self.settings)
+        return stats
+
+    def close(self):
+        """Закрывает все соединения пула (при остановке сервера)."""
+        with self._lock:
+            for conn in self._connections.values():
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+            self._stats['closed'] += len(self._connections)
+            self._connections.clear()
+        self._local = threading.local()
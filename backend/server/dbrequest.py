@@ -2,7 +2,16 @@
 
 import sqlite3
 import os
+import hashlib
+import time
+import re
+import json
+import threading
 import logging
+from db_pool import ConnectionPool
+from token_cache import TokenCache
+from payload_codec import PayloadCodec
+from write_queue import GroupCommitWriter
 
 logger = logging.getLogger(__name__)
 
@@ -15,13 +24,39 @@ class DatabaseManager:
         self.db_path = db_path
         os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
         logger.info(f"Инициализация единой базы данных: {self.db_path}")
+        self.pool = ConnectionPool(self.db_path)
+        self.token_cache = TokenCache()
+        # Сжатие analyses.data и больших user_data; старые несжатые строки читаются как есть
+        self.codec = PayloadCodec()
+        # Сохранения user_data и анализов фиксируются группами в отдельном потоке-писателе
+        self.writer = GroupCommitWriter(self.pool)
+        self._user_data_lock = threading.Lock()
+        self._user_data_stats = {'updates': 0, 'conflicts': 0, 'retries_exhausted': 0, 'version_mismatches': 0}
         self._create_tables()
 
     def _get_connection(self):
-        """Возвращает соединение с базой данных с включенными внешними ключами."""
-        conn = sqlite3.connect(self.db_path)
-        conn.execute("PRAGMA foreign_keys = ON;")
-        return conn
+        """
+        Возвращает постоянное соединение текущего потока из пула (WAL, внешние ключи включены).
+        Соединение не закрывается: `with` только фиксирует или откатывает транзакцию.
+        """
+        return self.pool.get()
+
+    def get_pool_stats(self):
+        return self.pool.get_stats()
+
+    def get_token_cache_stats(self):
+        return self.token_cache.get_stats()
+
+    def get_write_queue_stats(self):
+        return self.writer.get_stats()
+
+    def get_user_data_stats(self):
+        with self._user_data_lock:
+            return dict(self._user_data_stats)
+
+    def close(self):
+        self.writer.close()
+        self.pool.close()
 
     def _create_tables(self):
         """Создает все необходимые таблицы в базе данных, если они не существуют."""
@@ -44,6 +79,7 @@ class DatabaseManager:
                     CREATE TABLE IF NOT EXISTS user_data (
                         user_id INTEGER PRIMARY KEY,
                         data TEXT,
+                        version INTEGER NOT NULL DEFAULT 0,
                         FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
                     )
                 ''')
@@ -57,25 +93,273 @@ class DatabaseManager:
                         FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
                     )
                 ''')
-                # 4. Таблица для общего хранения ключ-значение (для эндпоинтов /field/...)
+                # 4. Контентно-адресуемое хранилище изображений анализов (ключ - sha256 содержимого)
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS image_blobs (
+                        blob_id TEXT PRIMARY KEY,
+                        media_type TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        data BLOB NOT NULL,
+                        created_at REAL NOT NULL DEFAULT 0
+                    )
+                ''')
+                # 5. Кэш изображений, построенных по запросу: (растр, слой, формат) -> blob_id
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS rendered_images (
+                        cache_key TEXT PRIMARY KEY,
+                        blob_id TEXT NOT NULL
+                    )
+                ''')
+                cursor.execute('CREATE INDEX IF NOT EXISTS idx_rendered_images_blob ON rendered_images (blob_id)')
+                # 6. Мемоизация анализов: канонический хэш входных данных -> готовый анализ
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS analysis_memo (
+                        memo_key TEXT PRIMARY KEY,
+                        analysis_id TEXT NOT NULL,
+                        scene_ids TEXT NOT NULL,
+                        created_at REAL NOT NULL
+                    )
+                ''')
+                cursor.execute('CREATE INDEX IF NOT EXISTS idx_analysis_memo_analysis ON analysis_memo (analysis_id)')
+                # 7. Краткие сводки анализов: средние индексов и статистика снимков без изображений и растров
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS analysis_summaries (
+                        analysis_id TEXT PRIMARY KEY,
+                        user_id INTEGER NOT NULL,
+                        created_at REAL,
+                        date_start TEXT,
+                        date_end TEXT,
+                        image_count INTEGER NOT NULL DEFAULT 0,
+                        status TEXT,
+                        ndvi_mean REAL,
+                        savi_mean REAL,
+                        vari_mean REAL,
+                        evi_mean REAL,
+                        area_of_interest TEXT,
+                        scene_stats TEXT,
+                        min_lon REAL,
+                        min_lat REAL,
+                        max_lon REAL,
+                        max_lat REAL,
+                        size_bytes INTEGER NOT NULL DEFAULT 0,
+                        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+                    )
+                ''')
+                # 8. Сохраненные поля пользователей
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS fields (
+                        user_id INTEGER NOT NULL,
+                        field_id TEXT NOT NULL,
+                        name TEXT NOT NULL,
+                        area_of_interest TEXT NOT NULL,
+                        created_at REAL NOT NULL,
+                        PRIMARY KEY (user_id, field_id),
+                        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+                    )
+                ''')
+                cursor.execute('CREATE INDEX IF NOT EXISTS idx_fields_user ON fields (user_id, created_at)')
+                # 9. Таблица для общего хранения ключ-значение (для эндпоинтов /field/...)
                 cursor.execute('''
                     CREATE TABLE IF NOT EXISTS generic_data (
                         key TEXT PRIMARY KEY,
                         value TEXT NOT NULL
                     )
                 ''')
+                # 10. Изображения, на которые ссылаются анализы (для сборки неиспользуемых изображений)
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS analysis_blobs (
+                        analysis_id TEXT NOT NULL,
+                        blob_id TEXT NOT NULL,
+                        PRIMARY KEY (analysis_id, blob_id),
+                        FOREIGN KEY (analysis_id) REFERENCES analyses(analysis_id) ON DELETE CASCADE
+                    ) WITHOUT ROWID
+                ''')
+                cursor.execute('CREATE INDEX IF NOT EXISTS idx_analysis_blobs_blob ON analysis_blobs (blob_id)')
+                # 11. Изображения, сохраненные для пользователя вне анализов (например, карта изменений)
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS user_blobs (
+                        user_id INTEGER NOT NULL,
+                        blob_id TEXT NOT NULL,
+                        created_at REAL NOT NULL,
+                        PRIMARY KEY (user_id, blob_id),
+                        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+                    ) WITHOUT ROWID
+                ''')
+                cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_blobs_blob ON user_blobs (blob_id)')
+                cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_blobs_created ON user_blobs (created_at)')
+                cursor.execute('PRAGMA user_version')
+                version = cursor.fetchone()[0]
+                if version < 1:
+                    self._migrate_user_data_blobs(cursor)
+                if version < 2:
+                    self._migrate_summary_bounds(cursor)
+                if version < 3:
+                    self._migrate_storage_accounting(cursor)
+                if version < 4:
+                    self._migrate_user_data_version(cursor)
+                if version < self.SCHEMA_VERSION:
+                    cursor.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+                # Постраничный список анализов: порядок (created_at, analysis_id) целиком берется из индекса;
+                # размер в индексе - чтобы квоты и сроки хранения считались без чтения самих сводок
+                cursor.execute('DROP INDEX IF EXISTS idx_analysis_summaries_user')
+                cursor.execute('DROP INDEX IF EXISTS idx_analysis_summaries_page')
+                cursor.execute('''CREATE INDEX IF NOT EXISTS idx_analysis_summaries_storage
+                                  ON analysis_summaries (user_id, created_at, analysis_id, size_bytes)''')
                 conn.commit()
                 logger.info(f"Все таблицы в {self.db_path} созданы/проверены.")
         except Exception as e:
             logger.error(f"Ошибка при создании таблиц: {e}")
             raise
 
+    # Версия схемы (PRAGMA user_version): 1 - поля и список анализов в таблицах, 2 - границы областей в сводках,
+    # 3 - учет изображений анализов и размеров анализов, 4 - версия user_data для оптимистичных блокировок,
+    # 5 - изображения пользователей вне анализов (user_blobs; таблица создается выше, переноса данных нет)
+    SCHEMA_VERSION = 5
+
+    def _migrate_user_data_blobs(self, cursor):
+        """
+        Перенос сохраненных полей и списка анализов из JSON в user_data в таблицы
+        fields и analysis_summaries (версия схемы 1). Ключи saved_fields и analyses
+        удаляются из JSON, остальное содержимое user_data не меняется. Строки
+        user_data, которые не являются JSON-объектом (массивы ключей), пропускаются.
+        """
+        cursor.execute('SELECT user_id, data FROM user_data')
+        migrated_fields = migrated_analyses = 0
+        for user_id, data_str in cursor.fetchall():
+            try:
+                data_obj = json.loads(PayloadCodec.decode(data_str)) if data_str else None
+            except (TypeError, ValueError):
+                continue
+            if not isinstance(data_obj, dict) or not ({'saved_fields', 'analyses'} & data_obj.keys()):
+                continue
+
+            fields = data_obj.pop('saved_fields', None) or []
+            # Поля хранились от новых к старым; ID поля - время создания в секундах
+            for position, field in enumerate(fields):
+                if not isinstance(field, dict) or field.get('id') is None:
+                    continue
+                field_id = str(field['id'])
+                created_at = float(field_id) if field_id.isdigit() else -position
+                cursor.execute(
+                    'INSERT OR IGNORE INTO fields (user_id, field_id, name, area_of_interest, created_at) VALUES (?, ?, ?, ?, ?)',
+                    (user_id, field_id, field.get('name') or '', json.dumps(field.get('area_of_interest')), created_at)
+                )
+                migrated_fields += cursor.rowcount
+
+            # Элементы списка анализов становятся сводками, если самой сводки еще нет;
+            # статистика снимков у таких сводок пустая и достраивается при первом запросе сводки
+            for entry in data_obj.pop('analyses', None) or []:
+                if not isinstance(entry, dict) or not entry.get('analysis_id'):
+                    continue
+                cursor.execute('SELECT 1 FROM analyses WHERE user_id = ? AND analysis_id = ?', (user_id, entry['analysis_id']))
+                if not cursor.fetchone():
+                    continue
+                stats = entry.get('statistics_summary') or {}
+                date_range = entry.get('date_range') or {}
+                cursor.execute(
+                    '''INSERT OR IGNORE INTO analysis_summaries
+                       (analysis_id, user_id, created_at, date_start, date_end, image_count, status,
+                        ndvi_mean, savi_mean, vari_mean, evi_mean, area_of_interest, scene_stats)
+                       VALUES (?, ?, ?, ?, ?, ?, 'completed', ?, ?, ?, ?, ?, NULL)''',
+                    (entry['analysis_id'], user_id, entry.get('timestamp') or 0, date_range.get('start'), date_range.get('end'),
+                     entry.get('image_count', 0), *(stats.get(f'{name}_mean') for name in self.SUMMARY_INDEX_NAMES),
+                     json.dumps(entry.get('area_of_interest')))
+                )
+                migrated_analyses += cursor.rowcount
+
+            cursor.execute('UPDATE user_data SET data = ? WHERE user_id = ?', (json.dumps(data_obj), user_id))
+        logger.info(f"Миграция user_data: перенесено полей {migrated_fields}, анализов {migrated_analyses}")
+
+    def _migrate_summary_bounds(self, cursor):
+        """
+        Версия схемы 2: ограничивающий прямоугольник области анализа в сводке (для фильтра
+        списка анализов по области) и обязательное время создания (для постраничного списка).
+        """
+        from aoi_mask import AoiMask
+        cursor.execute('PRAGMA table_info(analysis_summaries)')
+        columns = {row[1] for row in cursor.fetchall()}
+        for column in self.SUMMARY_BOUNDS_COLUMNS:
+            if column not in columns:
+                cursor.execute(f'ALTER TABLE analysis_summaries ADD COLUMN {column} REAL')
+        cursor.execute('UPDATE analysis_summaries SET created_at = 0 WHERE created_at IS NULL')
+
+        cursor.execute('SELECT analysis_id, area_of_interest FROM analysis_summaries WHERE min_lon IS NULL AND area_of_interest IS NOT NULL')
+        updated = 0
+        for analysis_id, area_str in cursor.fetchall():
+            try:
+                bbox = AoiMask.bbox(json.loads(area_str))
+            except (TypeError, ValueError, KeyError, IndexError):
+                continue
+            cursor.execute('UPDATE analysis_summaries SET min_lon = ?, min_lat = ?, max_lon = ?, max_lat = ? WHERE analysis_id = ?',
+                           (*bbox, analysis_id))
+            updated += 1
+        logger.info(f"Миграция сводок анализов: границы областей рассчитаны для {updated} анализов")
+
+    def _migrate_storage_accounting(self, cursor):
+        """
+        Версия схемы 3: ссылки анализов на изображения (analysis_blobs), время сохранения
+        изображений и размер анализа в сводке - для сроков хранения, квот и сборки мусора.
+        Изображения, сохраненные до миграции, считаются старыми (created_at = 0).
+        """
+        for table, column, definition in (('image_blobs', 'created_at', 'REAL NOT NULL DEFAULT 0'),
+                                          ('analysis_summaries', 'size_bytes', 'INTEGER NOT NULL DEFAULT 0')):
+            cursor.execute(f'PRAGMA table_info({table})')
+            if column not in {row[1] for row in cursor.fetchall()}:
+                cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+        cursor.execute('SELECT analysis_id, data FROM analyses')
+        indexed = 0
+        for analysis_id, data in cursor.fetchall():
+            try:
+                self._index_analysis_blobs(cursor, analysis_id, PayloadCodec.decode(data))
+            except (ValueError, UnicodeDecodeError) as e:
+                logger.warning(f"Миграция: не удалось прочитать анализ {analysis_id}: {e}")
+                continue
+            indexed += 1
+        cursor.execute(f'UPDATE analysis_summaries SET size_bytes = ({self.ANALYSIS_SIZE_SQL})')
+        logger.info(f"Миграция учета хранения: ссылки на изображения построены для {indexed} анализов")
+
+    def _migrate_user_data_version(self, cursor):
+        """Версия схемы 4: номер версии данных пользователя (см. update_user_data)."""
+        cursor.execute('PRAGMA table_info(user_data)')
+        if 'version' not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute('ALTER TABLE user_data ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+
     # --- Вспомогательные методы ---
-    def _get_user_id_by_token(self, token, cursor):
-        """Вспомогательная функция для получения ID пользователя по токену."""
-        cursor.execute('SELECT id FROM users WHERE token = ?', (token,))
+    def _fetch_user_by_token(self, token, cursor):
+        cursor.execute('SELECT id, login, first_name, last_name FROM users WHERE token = ?', (token,))
         result = cursor.fetchone()
-        return result[0] if result else None
+        if not result:
+            return None
+        user = {"user_id": result[0], "login": result[1], "first_name": result[2], "last_name": result[3]}
+        self.token_cache.put(token, user)
+        return user
+
+    def resolve_token(self, token):
+        """
+        Возвращает {'user_id', 'login', 'first_name', 'last_name'} или None для невалидного токена.
+        Для токена из кэша обращения к БД нет.
+        """
+        user = self.token_cache.get(token) if token else None
+        if user is not None:
+            return user
+        try:
+            with self._get_connection() as conn:
+                return self._fetch_user_by_token(token, conn.cursor())
+        except Exception as e:
+            logger.error(f"Ошибка при получении пользователя по токену {token}: {e}")
+            return None
+
+    def get_user_id(self, token):
+        user = self.resolve_token(token)
+        return user["user_id"] if user else None
+
+    def invalidate_token(self, token):
+        """Сбрасывает кэш для токена; вызывать после изменения пользователя или его токена."""
+        self.token_cache.invalidate(token)
+
+    def invalidate_user(self, user_id):
+        self.token_cache.invalidate_user(user_id)
 
     # --- Методы для работы с пользователями (users) ---
     def add_new_user(self, login, password, token, first_name, last_name):
@@ -90,6 +374,7 @@ class DatabaseManager:
                 # Сразу создаем пустую запись в user_data
                 cursor.execute('INSERT INTO user_data (user_id, data) VALUES (?, ?)', (user_id, '{}'))
                 conn.commit()
+                self.invalidate_token(token)
                 logger.info(f"Пользователь {login} (ID: {user_id}) успешно добавлен.")
                 return True
         except sqlite3.IntegrityError:
@@ -121,27 +406,13 @@ class DatabaseManager:
             return False
 
     def if_token_exist(self, token):
-        try:
-            with self._get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute('SELECT 1 FROM users WHERE token = ?', (token,))
-                return cursor.fetchone() is not None
-        except Exception as e:
-            logger.error(f"Ошибка при проверке токена {token}: {e}")
-            return False
+        return self.resolve_token(token) is not None
             
     def get_user_info_by_token(self, token):
-        try:
-            with self._get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute('SELECT login, first_name, last_name FROM users WHERE token = ?', (token,))
-                result = cursor.fetchone()
-                if result:
-                    return {"login": result[0], "first_name": result[1], "last_name": result[2]}
-                return None
-        except Exception as e:
-            logger.error(f"Ошибка при получении информации по токену {token}: {e}")
-            return None
+        user = self.resolve_token(token)
+        if user:
+            return {"login": user["login"], "first_name": user["first_name"], "last_name": user["last_name"]}
+        return None
             
     def get_all_users(self):
         try:
@@ -155,78 +426,736 @@ class DatabaseManager:
             return []
 
     # --- Методы для данных пользователя (user_data) ---
-    def get_user_data(self, token):
+    def get_user_data(self, user_id):
         try:
             with self._get_connection() as conn:
                 cursor = conn.cursor()
-                user_id = self._get_user_id_by_token(token, cursor)
                 if not user_id: return None
                 cursor.execute('SELECT data FROM user_data WHERE user_id = ?', (user_id,))
                 result = cursor.fetchone()
-                return result[0] if result else None
+                return PayloadCodec.decode(result[0]) if result else None
         except Exception as e:
-            logger.error(f"Ошибка получения данных для токена {token}: {e}")
+            logger.error(f"Ошибка получения данных пользователя {user_id}: {e}")
             return None
 
-    def save_user_data(self, token, data_str):
+    def get_user_data_versioned(self, user_id):
+        """Возвращает (данные или None, версия). Версия отсутствующих данных - 0."""
         try:
             with self._get_connection() as conn:
                 cursor = conn.cursor()
-                user_id = self._get_user_id_by_token(token, cursor)
-                if not user_id: return False
-                cursor.execute(
-                    'INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)',
-                    (user_id, data_str)
-                )
-                conn.commit()
-                return True
+                if not user_id: return None
+                cursor.execute('SELECT data, version FROM user_data WHERE user_id = ?', (user_id,))
+                result = cursor.fetchone()
+                return (PayloadCodec.decode(result[0]), result[1]) if result else (None, 0)
+        except Exception as e:
+            logger.error(f"Ошибка получения данных пользователя {user_id}: {e}")
+            return None
+
+    def save_user_data(self, user_id, data_str):
+        """
+        Безусловная запись (последняя запись побеждает); версия данных увеличивается, поэтому
+        одновременные update_user_data увидят конфликт. Запись идет через очередь групповой
+        фиксации; возврат - после фиксации транзакции.
+        """
+        try:
+            payload = self.codec.encode(data_str)
+            if not user_id: return False
+            self.writer.execute(lambda cursor: cursor.execute(
+                '''INSERT INTO user_data (user_id, data, version) VALUES (?, ?, 1)
+                   ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, version = user_data.version + 1''',
+                (user_id, payload)
+            ))
+            return True
         except Exception as e:
-            logger.error(f"Ошибка сохранения данных для токена {token}: {e}")
+            logger.error(f"Ошибка сохранения данных пользователя {user_id}: {e}")
             return False
 
+    # Повторы update_user_data при гонке версий без очереди записи (write_queue.enabled = false)
+    USER_DATA_MAX_ATTEMPTS = 5
+
+    def update_user_data(self, user_id, merge, expected_version=None):
+        """
+        Изменение данных пользователя без глобальной блокировки (оптимистичная блокировка):
+        данные и их версия читаются без блокировки, новые данные вычисляются функцией
+        merge(текущие данные или None) и записываются, только если версия за это время
+        не изменилась (сравнение с обменом по колонке version). Если данные успел изменить
+        другой запрос, merge повторяется на свежих данных внутри транзакции записи, где
+        конфликт уже невозможен, поэтому изменения одновременных запросов не теряются.
+        merge должна быть быстрой чистой функцией от текущих данных: при конфликте она
+        выполняется в потоке-писателе.
+        expected_version - версия, которую видел клиент: при расхождении изменение не
+        выполняется и merge не повторяется.
+        Возвращает {'updated', 'data', 'version', 'merged_on_conflict'} (updated == False -
+        версия клиента устарела; data и version - текущие данные) или None при ошибке.
+        """
+        try:
+            if not user_id: return None
+            conn = self._get_connection()
+            for _ in range(self.USER_DATA_MAX_ATTEMPTS):
+                row = conn.execute('SELECT data, version FROM user_data WHERE user_id = ?', (user_id,)).fetchone()
+                read_version = row[1] if row else 0
+                if expected_version is not None and read_version != expected_version:
+                    with self._user_data_lock:
+                        self._user_data_stats['version_mismatches'] += 1
+                    return {'updated': False, 'data': PayloadCodec.decode(row[0]) if row else None,
+                            'version': read_version, 'merged_on_conflict': False}
+                data_str = merge(PayloadCodec.decode(row[0]) if row else None)
+                payload = self.codec.encode(data_str)
+
+                def write(cursor):
+                    current = cursor.execute('SELECT data, version FROM user_data WHERE user_id = ?', (user_id,)).fetchone()
+                    version = current[1] if current else 0
+                    new_str, new_payload, merged = data_str, payload, False
+                    if version != read_version:
+                        if expected_version is not None:
+                            return {'updated': False, 'data': PayloadCodec.decode(current[0]) if current else None,
+                                    'version': version, 'merged_on_conflict': False}
+                        new_str = merge(PayloadCodec.decode(current[0]) if current else None)
+                        new_payload, merged = self.codec.encode(new_str), True
+                    if current is None:
+                        cursor.execute('INSERT OR IGNORE INTO user_data (user_id, data, version) VALUES (?, ?, 1)',
+                                       (user_id, new_payload))
+                    else:
+                        cursor.execute('UPDATE user_data SET data = ?, version = version + 1 WHERE user_id = ? AND version = ?',
+                                       (new_payload, user_id, version))
+                    if cursor.rowcount == 0:
+                        # Без очереди записи транзакции не упорядочены: другой запрос успел записать раньше
+                        return None
+                    return {'updated': True, 'data': new_str, 'version': version + 1, 'merged_on_conflict': merged}
+
+                result = self.writer.execute(write)
+                if result is None:
+                    continue
+                with self._user_data_lock:
+                    if not result['updated']:
+                        self._user_data_stats['version_mismatches'] += 1
+                    else:
+                        self._user_data_stats['updates'] += 1
+                        if result['merged_on_conflict']:
+                            self._user_data_stats['conflicts'] += 1
+                return result
+            with self._user_data_lock:
+                self._user_data_stats['retries_exhausted'] += 1
+            logger.warning(f"Данные пользователя {user_id} не обновлены: конфликт версий после {self.USER_DATA_MAX_ATTEMPTS} попыток")
+            return None
+        except Exception as e:
+            logger.error(f"Ошибка изменения данных пользователя {user_id}: {e}")
+            return None
+
     # --- Методы для данных анализов (analyses) ---
-    def save_analysis_data(self, token, analysis_id, data_str):
+    SUMMARY_INDEX_NAMES = ('ndvi', 'savi', 'vari', 'evi')
+
+    def save_analysis_data(self, user_id, analysis_id, data_str, summary=None):
+        """
+        Сохраняет анализ; если передана сводка (см. save_analysis_summary), она записывается
+        вместе с ним атомарно. Запись идет через очередь групповой фиксации.
+        """
         try:
-            with self._get_connection() as conn:
-                cursor = conn.cursor()
-                user_id = self._get_user_id_by_token(token, cursor)
-                if not user_id: return False
+            # Сжатие до постановки в очередь, чтобы не держать блокировку записи на время работы zlib
+            payload = self.codec.encode(data_str)
+            if not user_id: return False
+
+            def write(cursor):
                 cursor.execute(
                     'INSERT OR REPLACE INTO analyses (user_id, analysis_id, data) VALUES (?, ?, ?)',
-                    (user_id, analysis_id, data_str)
+                    (user_id, analysis_id, payload)
                 )
-                conn.commit()
-                return True
+                self._index_analysis_blobs(cursor, analysis_id, data_str)
+                if summary is not None:
+                    self._upsert_analysis_summary(cursor, user_id, analysis_id, summary)
+
+            self.writer.execute(write)
+            return True
         except Exception as e:
             logger.error(f"Ошибка сохранения анализа {analysis_id}: {e}")
             return False
             
-    def get_analysis_data(self, token, analysis_id):
+    def get_analysis_data(self, user_id, analysis_id):
         try:
             with self._get_connection() as conn:
                 cursor = conn.cursor()
-                user_id = self._get_user_id_by_token(token, cursor)
                 if not user_id: return None
                 cursor.execute('SELECT data FROM analyses WHERE user_id = ? AND analysis_id = ?', (user_id, analysis_id))
                 result = cursor.fetchone()
-                return result[0] if result else None
+                return PayloadCodec.decode(result[0]) if result else None
         except Exception as e:
             logger.error(f"Ошибка получения анализа {analysis_id}: {e}")
             return None
 
-    def delete_analysis_data(self, token, analysis_id):
+    def delete_analysis_data(self, user_id, analysis_id):
+        """Удаляет анализ пользователя (через очередь групповой фиксации). True, если данные анализа были."""
+        try:
+            if not user_id: return False
+
+            def write(cursor):
+                cursor.execute('SELECT 1 FROM analyses WHERE user_id = ? AND analysis_id = ?', (user_id, analysis_id))
+                exists = cursor.fetchone() is not None
+                cursor.execute('SELECT 1 FROM analysis_summaries WHERE user_id = ? AND analysis_id = ?', (user_id, analysis_id))
+                if not exists and cursor.fetchone() is None:
+                    return False
+                self._delete_analyses(cursor, [analysis_id])
+                return exists
+
+            return self.writer.execute(write)
+        except Exception as e:
+            logger.error(f"Ошибка удаления анализа {analysis_id}: {e}")
+            return False
+
+    # --- Методы для сводок анализов (analysis_summaries) ---
+    SUMMARY_BOUNDS_COLUMNS = ('min_lon', 'min_lat', 'max_lon', 'max_lat')
+    SUMMARY_COLUMNS = '''created_at, date_start, date_end, image_count, status, ndvi_mean, savi_mean, vari_mean, evi_mean,
+                         area_of_interest, scene_stats, min_lon, min_lat, max_lon, max_lat'''
+
+    # Размер анализа для квот: его данные и все изображения, на которые он ссылается
+    # (изображение, общее для нескольких анализов, учитывается в каждом из них)
+    ANALYSIS_SIZE_SQL = '''COALESCE((SELECT length(CAST(a.data AS BLOB)) FROM analyses a
+                                     WHERE a.analysis_id = analysis_summaries.analysis_id), 0)
+                         + COALESCE((SELECT SUM(b.size) FROM analysis_blobs ab JOIN image_blobs b ON b.blob_id = ab.blob_id
+                                     WHERE ab.analysis_id = analysis_summaries.analysis_id), 0)'''
+
+    def _upsert_analysis_summary(self, cursor, user_id, analysis_id, summary):
+        """
+        summary: {'created_at', 'date_start', 'date_end', 'image_count', 'status',
+        'averages': {индекс: среднее}, 'area_of_interest': JSON-строка, 'scene_stats': JSON-строка,
+        'bbox': [min_lon, min_lat, max_lon, max_lat] или None}.
+        """
+        averages = summary.get('averages', {})
+        bbox = summary.get('bbox') or (None,) * 4
+        cursor.execute(
+            f'''INSERT OR REPLACE INTO analysis_summaries (analysis_id, user_id, {self.SUMMARY_COLUMNS})
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            (analysis_id, user_id, summary.get('created_at') or 0, summary.get('date_start'), summary.get('date_end'),
+             summary.get('image_count', 0), summary.get('status'),
+             *(averages.get(name) for name in self.SUMMARY_INDEX_NAMES),
+             summary.get('area_of_interest'), summary.get('scene_stats'), *bbox)
+        )
+        cursor.execute(f'UPDATE analysis_summaries SET size_bytes = ({self.ANALYSIS_SIZE_SQL}) WHERE analysis_id = ?',
+                       (analysis_id,))
+
+    def save_analysis_summary(self, user_id, analysis_id, summary):
         try:
             with self._get_connection() as conn:
                 cursor = conn.cursor()
-                user_id = self._get_user_id_by_token(token, cursor)
                 if not user_id: return False
-                cursor.execute('DELETE FROM analyses WHERE user_id = ? AND analysis_id = ?', (user_id, analysis_id))
+                self._upsert_analysis_summary(cursor, user_id, analysis_id, summary)
                 conn.commit()
-                return cursor.rowcount > 0
+                return True
         except Exception as e:
-            logger.error(f"Ошибка удаления анализа {analysis_id}: {e}")
+            logger.error(f"Ошибка сохранения сводки анализа {analysis_id}: {e}")
+            return False
+
+    def get_analysis_summary(self, user_id, analysis_id):
+        """Возвращает сводку анализа в формате save_analysis_summary или None."""
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                if not user_id: return None
+                cursor.execute(f'SELECT {self.SUMMARY_COLUMNS} FROM analysis_summaries WHERE user_id = ? AND analysis_id = ?',
+                               (user_id, analysis_id))
+                result = cursor.fetchone()
+                return self._summary_from_result(analysis_id, result) if result else None
+        except Exception as e:
+            logger.error(f"Ошибка получения сводки анализа {analysis_id}: {e}")
+            return None
+
+    def _summary_from_result(self, analysis_id, result):
+        return {
+            "analysis_id": analysis_id, "created_at": result[0], "date_start": result[1], "date_end": result[2],
+            "image_count": result[3], "status": result[4],
+            "averages": {name: value for name, value in zip(self.SUMMARY_INDEX_NAMES, result[5:9]) if value is not None},
+            "area_of_interest": result[9], "scene_stats": result[10],
+            "bbox": list(result[11:15]) if result[11] is not None else None,
+        }
+
+    def list_analysis_summaries(self, user_id, limit=None, covering_date=None, after=None,
+                                date_from=None, date_to=None, bbox=None, statuses=('completed',)):
+        """
+        Сводки анализов пользователя со статусом из statuses (по умолчанию - завершенные, то есть
+        список пользователя) от новых к старым, в формате get_analysis_summary.
+        Постраничный обход по ключу: after=(created_at, analysis_id) последней строки предыдущей
+        страницы; порядок и выборка страницы идут по индексу (user_id, created_at, analysis_id),
+        поэтому стоимость страницы не зависит от длины истории.
+        Фильтры: covering_date - период анализа включает дату; date_from/date_to - период
+        пересекается с интервалом; bbox [min_lon, min_lat, max_lon, max_lat] - область анализа
+        пересекается с прямоугольником. None при ошибке.
+        """
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                if not user_id: return None
+                query = (f"SELECT analysis_id, {self.SUMMARY_COLUMNS} FROM analysis_summaries "
+                         f"WHERE user_id = ? AND status IN ({','.join('?' * len(statuses))})")
+                params = [user_id, *statuses]
+                if after is not None:
+                    query += ' AND (created_at < ? OR (created_at = ? AND analysis_id < ?))'
+                    params += [after[0], after[0], after[1]]
+                if covering_date is not None:
+                    query += ' AND date_start <= ? AND date_end >= ?'
+                    params += [covering_date, covering_date]
+                if date_from is not None:
+                    query += ' AND date_end >= ?'
+                    params.append(date_from)
+                if date_to is not None:
+                    query += ' AND date_start <= ?'
+                    params.append(date_to)
+                if bbox is not None:
+                    query += ' AND max_lon >= ? AND min_lon <= ? AND max_lat >= ? AND min_lat <= ?'
+                    params += [bbox[0], bbox[2], bbox[1], bbox[3]]
+                query += ' ORDER BY created_at DESC, analysis_id DESC'
+                if limit is not None:
+                    query += ' LIMIT ?'
+                    params.append(int(limit))
+                cursor.execute(query, params)
+                return [self._summary_from_result(row[0], row[1:]) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"Ошибка получения списка сводок анализов: {e}")
+            return None
+
+    # --- Методы для сохраненных полей (fields) ---
+    def add_field(self, user_id, field_id, name, area_of_interest_str, created_at):
+        try:
+            if not user_id: return False
+            self.writer.execute(lambda cursor: cursor.execute(
+                'INSERT INTO fields (user_id, field_id, name, area_of_interest, created_at) VALUES (?, ?, ?, ?, ?)',
+                (user_id, field_id, name, area_of_interest_str, created_at)
+            ))
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка сохранения поля {field_id}: {e}")
+            return False
+
+    def get_fields(self, user_id, field_ids=None):
+        """
+        Поля пользователя от новых к старым: [{'id', 'name', 'area_of_interest' (JSON-строка), 'created_at'}].
+        field_ids - выбрать только эти поля. None при ошибке.
+        """
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                if not user_id: return None
+                query = 'SELECT field_id, name, area_of_interest, created_at FROM fields WHERE user_id = ?'
+                params = [user_id]
+                if field_ids is not None:
+                    field_ids = list(field_ids)
+                    if not field_ids:
+                        return []
+                    query += f" AND field_id IN ({','.join('?' * len(field_ids))})"
+                    params += field_ids
+                cursor.execute(query + ' ORDER BY created_at DESC', params)
+                return [{"id": row[0], "name": row[1], "area_of_interest": row[2], "created_at": row[3]}
+                        for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"Ошибка получения полей пользователя: {e}")
+            return None
+
+    def delete_field(self, user_id, field_id):
+        try:
+            if not user_id: return False
+            return self.writer.execute(lambda cursor: cursor.execute(
+                'DELETE FROM fields WHERE user_id = ? AND field_id = ?', (user_id, field_id)
+            ).rowcount > 0)
+        except Exception as e:
+            logger.error(f"Ошибка удаления поля {field_id}: {e}")
             return False
     
+    # --- Сжатие ранее сохраненных данных ---
+    # Таблица -> колонка ключа строки; сжимается колонка data
+    COMPRESSIBLE_TABLES = {'analyses': 'id', 'user_data': 'user_id'}
+
+    def recompress_payloads(self, table, batch_size):
+        """
+        Сжимает очередную порцию строк таблицы, сохраненных текстом. Данные читаются и сжимаются
+        вне транзакции записи; строка обновляется, только если не изменилась за это время.
+        Возвращает {'scanned', 'rows', 'bytes_before', 'bytes_after'} (scanned == 0 - сжимать больше
+        нечего; строки, измененные между чтением и записью, сожмутся в следующей порции) или None при ошибке.
+        """
+        key = self.COMPRESSIBLE_TABLES[table]
+        try:
+            conn = self._get_connection()
+            rows = conn.execute(
+                f"SELECT {key}, data FROM {table} WHERE typeof(data) = 'text' AND length(data) >= ? LIMIT ?",
+                (self.codec.min_size, int(batch_size))
+            ).fetchall()
+            stats = {'scanned': len(rows), 'rows': 0, 'bytes_before': 0, 'bytes_after': 0}
+            updates = []
+            for row_key, text in rows:
+                payload = self.codec.encode(text)
+                if isinstance(payload, bytes):
+                    updates.append((payload, row_key, text, len(text.encode('utf-8'))))
+            if not updates:
+                return stats
+            with conn:
+                for payload, row_key, text, size in updates:
+                    cursor = conn.execute(f"UPDATE {table} SET data = ? WHERE {key} = ? AND data = ?", (payload, row_key, text))
+                    if cursor.rowcount:
+                        stats['rows'] += 1
+                        stats['bytes_before'] += size
+                        stats['bytes_after'] += len(payload)
+                        if table == 'analyses':
+                            conn.execute(f'''UPDATE analysis_summaries SET size_bytes = ({self.ANALYSIS_SIZE_SQL})
+                                             WHERE analysis_id = (SELECT analysis_id FROM analyses WHERE id = ?)''', (row_key,))
+            return stats
+        except Exception as e:
+            logger.error(f"Ошибка сжатия строк таблицы {table}: {e}")
+            return None
+
+    # --- Хранение: сроки хранения, квоты, сборка мусора, освобождение места ---
+    # Ссылки на изображения в JSON анализа: {"blob_id": "<sha256>", ...}
+    BLOB_ID_PATTERN = re.compile(r'"blob_id":\s*"([0-9a-f]{64})"')
+    AUTO_VACUUM_MODES = {0: 'none', 1: 'full', 2: 'incremental'}
+
+    def _index_analysis_blobs(self, cursor, analysis_id, data_str):
+        """Перестраивает ссылки анализа на изображения по его JSON."""
+        cursor.execute('DELETE FROM analysis_blobs WHERE analysis_id = ?', (analysis_id,))
+        blob_ids = set(self.BLOB_ID_PATTERN.findall(data_str or ''))
+        cursor.executemany('INSERT OR IGNORE INTO analysis_blobs (analysis_id, blob_id) VALUES (?, ?)',
+                           [(analysis_id, blob_id) for blob_id in blob_ids])
+
+    def _delete_analyses(self, cursor, analysis_ids):
+        """Удаляет анализы со сводками, ссылками на изображения и мемоизацией. Возвращает число удаленных анализов."""
+        placeholders = ', '.join('?' * len(analysis_ids))
+        cursor.execute(f'DELETE FROM analysis_blobs WHERE analysis_id IN ({placeholders})', analysis_ids)
+        cursor.execute(f'DELETE FROM analysis_memo WHERE analysis_id IN ({placeholders})', analysis_ids)
+        cursor.execute(f'DELETE FROM analysis_summaries WHERE analysis_id IN ({placeholders})', analysis_ids)
+        cursor.execute(f'DELETE FROM analyses WHERE analysis_id IN ({placeholders})', analysis_ids)
+        return cursor.rowcount
+
+    def delete_analyses(self, analysis_ids):
+        """Удаление анализов фоновыми задачами (без проверки владельца). Возвращает число удаленных или None."""
+        if not analysis_ids:
+            return 0
+        try:
+            with self._get_connection() as conn:
+                return self._delete_analyses(conn.cursor(), list(analysis_ids))
+        except Exception as e:
+            logger.error(f"Ошибка удаления {len(analysis_ids)} анализов: {e}")
+            return None
+
+    def get_storage_usage(self, user_id):
+        """
+        Занятое анализами пользователя место: {'analyses', 'bytes', 'oldest_created_at'} или None при ошибке.
+        Служебные анализы не учитываются, как и в квоте (см. find_expired_analyses).
+        """
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                if not user_id: return None
+                cursor.execute("SELECT COUNT(*), COALESCE(SUM(size_bytes), 0), MIN(created_at) FROM analysis_summaries "
+                               "WHERE user_id = ? AND status IS NOT 'internal'", (user_id,))
+                count, size, oldest = cursor.fetchone()
+                return {'analyses': count, 'bytes': size, 'oldest_created_at': oldest}
+        except Exception as e:
+            logger.error(f"Ошибка получения занятого места пользователя {user_id}: {e}")
+            return None
+
+    def find_expired_analyses(self, max_analyses=None, created_before=None, quota_bytes=None, limit=100):
+        """
+        Анализы, выходящие за ограничения хранения, от самых старых: сверх max_analyses
+        новейших анализов пользователя, созданные раньше created_before, и старые анализы,
+        не помещающиеся в квоту quota_bytes вместе с более новыми (самый новый анализ
+        пользователя квотой не удаляется). None - ограничение не действует.
+        Служебные анализы (статус 'internal') не учитываются: их срок задает find_orphan_analyses.
+        Возвращает [(analysis_id, причина 'count' | 'age' | 'quota', size_bytes)] или None при ошибке.
+        """
+        if max_analyses is None and created_before is None and quota_bytes is None:
+            return []
+        try:
+            conditions, params = [], []
+            if max_analyses is not None:
+                conditions.append('position > ?')
+                params.append(int(max_analyses))
+            if created_before is not None:
+                conditions.append('created_at < ?')
+                params.append(created_before)
+            if quota_bytes is not None:
+                conditions.append('(position > 1 AND retained_bytes > ?)')
+                params.append(int(quota_bytes))
+            conn = self._get_connection()
+            rows = conn.execute(f'''
+                SELECT analysis_id, created_at, size_bytes, position FROM (
+                    SELECT analysis_id, created_at, size_bytes,
+                           ROW_NUMBER() OVER newest_first AS position,
+                           SUM(size_bytes) OVER newest_first AS retained_bytes
+                    FROM analysis_summaries
+                    WHERE status IS NOT 'internal'
+                    WINDOW newest_first AS (PARTITION BY user_id ORDER BY created_at DESC, analysis_id DESC
+                                            ROWS UNBOUNDED PRECEDING)
+                )
+                WHERE {' OR '.join(conditions)}
+                ORDER BY created_at
+                LIMIT ?
+            ''', (*params, int(limit))).fetchall()
+            expired = []
+            for analysis_id, created_at, size, position in rows:
+                if max_analyses is not None and position > max_analyses:
+                    reason = 'count'
+                elif created_before is not None and created_at < created_before:
+                    reason = 'age'
+                else:
+                    reason = 'quota'
+                expired.append((analysis_id, reason, size))
+            return expired
+        except Exception as e:
+            logger.error(f"Ошибка поиска анализов с истекшим сроком хранения: {e}")
+            return None
+
+    def find_orphan_analyses(self, stale_before, limit=100, internal_before=None):
+        """
+        Анализы, которых нет в списке ни одного пользователя: строки analyses без сводки
+        (например, анализы, вытесненные из прежнего списка из 50 элементов), сводки без
+        данных анализа, незавершенные анализы, начатые раньше stale_before (прерванные
+        перезапуском сервера), и служебные анализы (статус 'internal'), созданные раньше
+        internal_before (None - не удалять). Возвращает список ID или None при ошибке.
+        """
+        try:
+            conn = self._get_connection()
+            rows = conn.execute('''
+                SELECT a.analysis_id FROM analyses a
+                WHERE NOT EXISTS (SELECT 1 FROM analysis_summaries s WHERE s.analysis_id = a.analysis_id)
+                UNION ALL
+                SELECT s.analysis_id FROM analysis_summaries s
+                WHERE NOT EXISTS (SELECT 1 FROM analyses a WHERE a.analysis_id = s.analysis_id)
+                   OR (s.status IS NOT 'completed' AND s.status IS NOT 'internal' AND s.created_at < ?)
+                   OR (s.status = 'internal' AND s.created_at < ?)
+                LIMIT ?
+            ''', (stale_before, internal_before, int(limit))).fetchall()
+            return [row[0] for row in rows]
+        except Exception as e:
+            logger.error(f"Ошибка поиска осиротевших анализов: {e}")
+            return None
+
+    def expire_user_blobs(self, created_before, limit=100):
+        """
+        Снимает порцию устаревших (сохраненных раньше created_before) ссылок пользователей на
+        изображения вне анализов; сами изображения затем удаляет collect_unused_blobs.
+        Возвращает число снятых ссылок или None при ошибке.
+        """
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    DELETE FROM user_blobs WHERE (user_id, blob_id) IN (
+                        SELECT user_id, blob_id FROM user_blobs WHERE created_at < ? LIMIT ?)
+                ''', (created_before, int(limit)))
+                return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Ошибка снятия устаревших изображений пользователей: {e}")
+            return None
+
+    def collect_unused_blobs(self, created_before, limit=100):
+        """
+        Удаляет порцию изображений, на которые не ссылается ни один анализ и ни один пользователь
+        (user_blobs), и кэш изображений, построенных по растрам удаленных анализов. Изображения,
+        сохраненные позже created_before, не трогаются: ссылающийся на них анализ может быть еще не сохранен.
+        Возвращает {'rendered', 'blobs', 'bytes'} (blobs == 0 - удалять больше нечего) или None при ошибке.
+        """
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                # Ключ кэша начинается с blob_id исходного растра (см. AnalysisManager._render_layer_blob)
+                cursor.execute('''
+                    DELETE FROM rendered_images WHERE cache_key IN (
+                        SELECT r.cache_key FROM rendered_images r
+                        WHERE NOT EXISTS (SELECT 1 FROM analysis_blobs ab WHERE ab.blob_id = substr(r.cache_key, 1, 64))
+                        LIMIT ?)
+                ''', (int(limit),))
+                rendered = cursor.rowcount
+                cursor.execute('''
+                    SELECT b.blob_id, b.size FROM image_blobs b
+                    WHERE b.created_at < ?
+                      AND NOT EXISTS (SELECT 1 FROM analysis_blobs ab WHERE ab.blob_id = b.blob_id)
+                      AND NOT EXISTS (SELECT 1 FROM rendered_images r WHERE r.blob_id = b.blob_id)
+                      AND NOT EXISTS (SELECT 1 FROM user_blobs ub WHERE ub.blob_id = b.blob_id)
+                    LIMIT ?
+                ''', (created_before, int(limit)))
+                unused = cursor.fetchall()
+                cursor.executemany('DELETE FROM image_blobs WHERE blob_id = ?', [(blob_id,) for blob_id, _ in unused])
+                return {'rendered': rendered, 'blobs': len(unused), 'bytes': sum(size for _, size in unused)}
+        except Exception as e:
+            logger.error(f"Ошибка сборки неиспользуемых изображений: {e}")
+            return None
+
+    def get_file_stats(self):
+        """Состояние файла БД: режим auto_vacuum, размер страницы, число страниц и свободных страниц."""
+        try:
+            conn = self._get_connection()
+            auto_vacuum = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+            page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+            page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+            freelist = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            return {'auto_vacuum': self.AUTO_VACUUM_MODES.get(auto_vacuum, auto_vacuum), 'page_size': page_size,
+                    'page_count': page_count, 'freelist_pages': freelist, 'file_bytes': page_size * page_count}
+        except Exception as e:
+            logger.error(f"Ошибка получения состояния файла БД: {e}")
+            return None
+
+    def enable_incremental_vacuum(self):
+        """
+        Переводит БД в режим auto_vacuum = INCREMENTAL. Для существующего файла режим
+        меняется только полным VACUUM: он переписывает весь файл и на это время блокирует
+        запись, поэтому вызывается один раз и вне часов нагрузки. Возвращает True при успехе.
+        """
+        try:
+            conn = self._get_connection()
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            return conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+        except Exception as e:
+            logger.error(f"Ошибка перевода БД в режим инкрементальной очистки: {e}")
+            return False
+
+    def incremental_vacuum(self, pages):
+        """
+        Возвращает файловой системе до pages свободных страниц (нужен режим INCREMENTAL).
+        Короткая операция: блокировка записи держится только на время переноса этих страниц.
+        Возвращает число освобожденных страниц или None при ошибке.
+        """
+        try:
+            conn = self._get_connection()
+            before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            # execute выполняет PRAGMA incremental_vacuum только на одну страницу; executescript - целиком
+            conn.executescript(f'PRAGMA incremental_vacuum({int(pages)});')
+            freed = before - conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if freed:
+                # В режиме WAL файл БД уменьшается при контрольной точке
+                conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            return freed
+        except Exception as e:
+            logger.error(f"Ошибка инкрементальной очистки БД: {e}")
+            return None
+
+    # --- Методы для мемоизации анализов (analysis_memo) ---
+    def save_analysis_memo(self, memo_key, analysis_id, scene_ids_str):
+        try:
+            created_at = time.time()
+            self.writer.execute(lambda cursor: cursor.execute(
+                'INSERT OR REPLACE INTO analysis_memo (memo_key, analysis_id, scene_ids, created_at) VALUES (?, ?, ?, ?)',
+                (memo_key, analysis_id, scene_ids_str, created_at)
+            ))
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка сохранения мемоизации анализа {analysis_id}: {e}")
+            return False
+
+    def get_analysis_memo(self, memo_key):
+        """Возвращает запомненный анализ вместе с его данными, если исходный анализ еще существует."""
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT m.analysis_id, m.scene_ids, a.user_id, a.data
+                    FROM analysis_memo m JOIN analyses a ON a.analysis_id = m.analysis_id
+                    WHERE m.memo_key = ?
+                ''', (memo_key,))
+                result = cursor.fetchone()
+                if not result:
+                    return None
+                return {"analysis_id": result[0], "scene_ids": result[1], "user_id": result[2],
+                        "data": PayloadCodec.decode(result[3])}
+        except Exception as e:
+            logger.error(f"Ошибка получения мемоизации для ключа {memo_key}: {e}")
+            return None
+
+    # --- Методы для бинарных изображений (image_blobs) ---
+    BLOB_TOUCH_SECONDS = 3600
+
+    def save_blob(self, data: bytes, media_type: str):
+        """
+        Сохраняет изображение один раз по хэшу содержимого и возвращает его blob_id.
+        Запись идет через очередь групповой фиксации.
+        """
+        try:
+            blob_id = hashlib.sha256(data).hexdigest()
+            now = time.time()
+
+            def write(cursor):
+                cursor.execute(
+                    'INSERT OR IGNORE INTO image_blobs (blob_id, media_type, size, data, created_at) VALUES (?, ?, ?, ?, ?)',
+                    (blob_id, media_type, len(data), sqlite3.Binary(data), now)
+                )
+                if cursor.rowcount == 0:
+                    # Уже сохраненное изображение снова используется: обновляем время, чтобы сборка мусора
+                    # не удалила его до сохранения ссылающегося анализа (строка перезаписывается не чаще BLOB_TOUCH_SECONDS)
+                    cursor.execute('UPDATE image_blobs SET created_at = ? WHERE blob_id = ? AND created_at < ?',
+                                   (now, blob_id, now - self.BLOB_TOUCH_SECONDS))
+
+            self.writer.execute(write)
+            return blob_id
+        except Exception as e:
+            logger.error(f"Ошибка сохранения изображения: {e}")
+            return None
+
+    def link_user_blob(self, user_id, blob_id):
+        """
+        Закрепляет изображение за пользователем, если на него не будет ссылаться анализ:
+        сборка мусора не удалит его, пока ссылка не устареет (см. expire_user_blobs).
+        Повторное закрепление продлевает срок. Возвращает True при успехе.
+        """
+        try:
+            created_at = time.time()
+            self.writer.execute(lambda cursor: cursor.execute(
+                '''INSERT INTO user_blobs (user_id, blob_id, created_at) VALUES (?, ?, ?)
+                   ON CONFLICT(user_id, blob_id) DO UPDATE SET created_at = excluded.created_at''',
+                (user_id, blob_id, created_at)
+            ))
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка закрепления изображения {blob_id} за пользователем {user_id}: {e}")
+            return False
+
+    def user_owns_blob(self, user_id, blob_id):
+        """
+        True, если изображение доступно пользователю: на него ссылается один из его анализов
+        (analysis_blobs) или оно закреплено за ним вне анализов (user_blobs).
+        """
+        try:
+            conn = self._get_connection()
+            row = conn.execute('''
+                SELECT 1 FROM analysis_blobs ab JOIN analyses a ON a.analysis_id = ab.analysis_id
+                WHERE ab.blob_id = ? AND a.user_id = ?
+                UNION ALL
+                SELECT 1 FROM user_blobs WHERE user_id = ? AND blob_id = ?
+                LIMIT 1
+            ''', (blob_id, user_id, user_id, blob_id)).fetchone()
+            return row is not None
+        except Exception as e:
+            logger.error(f"Ошибка проверки доступа к изображению {blob_id}: {e}")
+            return False
+
+    def get_blob(self, blob_id):
+        """Возвращает кортеж (data, media_type) или None."""
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT data, media_type FROM image_blobs WHERE blob_id = ?', (blob_id,))
+                result = cursor.fetchone()
+                return (bytes(result[0]), result[1]) if result else None
+        except Exception as e:
+            logger.error(f"Ошибка получения изображения {blob_id}: {e}")
+            return None
+
+    def get_rendered_blob_id(self, cache_key):
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT blob_id FROM rendered_images WHERE cache_key = ?', (cache_key,))
+                result = cursor.fetchone()
+                return result[0] if result else None
+        except Exception as e:
+            logger.error(f"Ошибка чтения кэша изображений для {cache_key}: {e}")
+            return None
+
+    def save_rendered_blob_id(self, cache_key, blob_id):
+        try:
+            self.writer.execute(lambda cursor: cursor.execute(
+                'INSERT OR REPLACE INTO rendered_images (cache_key, blob_id) VALUES (?, ?)', (cache_key, blob_id)
+            ))
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка записи кэша изображений для {cache_key}: {e}")
+            return False
+
     # --- Методы для общих данных (generic_data, бывший field_data) ---
     def save_generic_data(self, key, value):
         try:
@@ -0,0 +1,229 @@
+# --- START OF FILE geotiff.py ---
+
+import math
+import struct
+import zlib
+import logging
+from typing import Dict, Iterator, List, Sequence
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+class CogWriter:
+    """
+    Запись стопки карт индексов снимка в Cloud-Optimized GeoTIFF без GDAL.
+    Файл тайловый (TILE_SIZE x TILE_SIZE), float32 с чересполосным хранением каналов,
+    сжатие deflate с предиктором для чисел с плавающей точкой, внутренние обзоры
+    (уменьшение в 2 раза, пока сторона больше тайла), NoData = NaN.
+    Раскладка COG: все IFD в начале файла, затем данные тайлов от самого мелкого
+    обзора к полному разрешению - клиенту достаточно прочитать заголовок и нужные тайлы.
+    Растры снимков лежат в проекции Web Mercator (миниатюры GEE), поэтому файл
+    привязывается в EPSG:3857 по границам снимка.
+    Файл не собирается в памяти целиком: первый проход сжимает тайлы только ради
+    их размеров (для смещений в IFD), второй сжимает их заново и отдает по одному.
+    """
+    TILE_SIZE = 256
+    COMPRESS_LEVEL = 6
+    EARTH_RADIUS = 6378137.0
+    EPSG_WEB_MERCATOR = 3857
+
+    # Типы полей TIFF
+    SHORT, LONG, ASCII, DOUBLE = 3, 4, 2, 12
+    TYPE_SIZES = {SHORT: 2, LONG: 4, ASCII: 1, DOUBLE: 8}
+    TYPE_FORMATS = {SHORT: 'H', LONG: 'I', DOUBLE: 'd'}
+
+    def __init__(self, index_maps: Dict[str, np.ndarray], band_names: Sequence[str], bounds: List[List[float]],
+                 metadata: Dict[str, str] = None):
+        """
+        index_maps - {имя: 2D карта}, в файл попадают каналы band_names в этом порядке.
+        bounds - [[min_lat, min_lon], [max_lat, max_lon]], как в результатах анализа.
+        """
+        self.band_names = [name for name in band_names if name in index_maps]
+        if not self.band_names:
+            raise ValueError("Нет карт индексов для экспорта")
+        stack = np.stack([index_maps[name] for name in self.band_names], axis=-1).astype(np.float32)
+        self.levels = self._build_overviews(stack)
+        self.bounds = bounds
+        self.metadata = metadata or {}
+        self._tile_sizes = None
+
+    # --- Обзоры ---
+
+    @classmethod
+    def _build_overviews(cls, stack: np.ndarray) -> List[np.ndarray]:
+        """Полное разрешение и обзоры: каждый следующий - среднее блоков 2x2 без учета NaN."""
+        levels = [stack]
+        while max(levels[-1].shape[:2]) > cls.TILE_SIZE:
+            prev = levels[-1]
+            h, w, bands = prev.shape
+            padded = np.full((h + h % 2, w + w % 2, bands), np.nan, dtype=np.float32)
+            padded[:h, :w] = prev
+            blocks = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2, bands)
+            valid = np.isfinite(blocks)
+            counts = valid.sum(axis=(1, 3))
+            sums = np.where(valid, blocks, 0).sum(axis=(1, 3))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                levels.append(np.where(counts > 0, sums / np.maximum(counts, 1), np.nan).astype(np.float32))
+        return levels
+
+    # --- Тайлы ---
+
+    def _tile_grid(self, level: np.ndarray):
+        h, w = level.shape[:2]
+        return math.ceil(h / self.TILE_SIZE), math.ceil(w / self.TILE_SIZE)
+
+    def _iter_tiles(self, level: np.ndarray) -> Iterator[np.ndarray]:
+        """Тайлы уровня построчно; краевые тайлы дополняются NaN до полного размера."""
+        size = self.TILE_SIZE
+        rows, cols = self._tile_grid(level)
+        for row in range(rows):
+            for col in range(cols):
+                block = level[row * size:(row + 1) * size, col * size:(col + 1) * size]
+                if block.shape[:2] != (size, size):
+                    tile = np.full((size, size, level.shape[2]), np.nan, dtype=np.float32)
+                    tile[:block.shape[0], :block.shape[1]] = block
+                    block = tile
+                yield block
+
+    def _encode_tile(self, tile: np.ndarray) -> bytes:
+        """
+        Предиктор 3 (TIFF Technical Note 3): байты каждой строки раскладываются по
+        значимости (сначала старшие байты всех значений), затем берется разность
+        с байтом соседнего пикселя того же канала. Похожие соседние значения дают
+        длинные серии нулей, и deflate сжимает их намного лучше сырых float32.
+        """
+        size, bands = self.TILE_SIZE, tile.shape[2]
+        values = np.ascontiguousarray(tile, dtype='<f4').reshape(size, size * bands)
+        planes = values.view(np.uint8).reshape(size, size * bands, 4)[:, :, ::-1]
+        row_bytes = np.ascontiguousarray(planes.transpose(0, 2, 1)).reshape(size, 4 * size * bands)
+        diff = row_bytes.copy()
+        diff[:, bands:] = row_bytes[:, bands:] - row_bytes[:, :-bands]
+        return zlib.compress(diff.tobytes(), self.COMPRESS_LEVEL)
+
+    def _level_tile_sizes(self) -> List[List[int]]:
+        """Первый проход: размеры сжатых тайлов каждого уровня (сами тайлы не хранятся)."""
+        if self._tile_sizes is None:
+            self._tile_sizes = [[len(self._encode_tile(tile)) for tile in self._iter_tiles(level)]
+                                for level in self.levels]
+        return self._tile_sizes
+
+    # --- Привязка ---
+
+    def _geo_tags(self) -> Dict[int, tuple]:
+        (min_lat, min_lon), (max_lat, max_lon) = self.bounds
+        h, w = self.levels[0].shape[:2]
+        left = self.EARTH_RADIUS * math.radians(min_lon)
+        right = self.EARTH_RADIUS * math.radians(max_lon)
+        top = self.EARTH_RADIUS * math.log(math.tan(math.pi / 4 + math.radians(max_lat) / 2))
+        bottom = self.EARTH_RADIUS * math.log(math.tan(math.pi / 4 + math.radians(min_lat) / 2))
+        geo_keys = [
+            1, 1, 0, 3,                                  # версия, ревизия, число ключей
+            1024, 0, 1, 1,                               # GTModelTypeGeoKey = проекционная СК
+            1025, 0, 1, 1,                               # GTRasterTypeGeoKey = PixelIsArea
+            3072, 0, 1, self.EPSG_WEB_MERCATOR,          # ProjectedCSTypeGeoKey
+        ]
+        return {
+            33550: (self.DOUBLE, ((right - left) / w, (top - bottom) / h, 0.0)),   # ModelPixelScale
+            33922: (self.DOUBLE, (0.0, 0.0, 0.0, left, top, 0.0)),                 # ModelTiepoint
+            34735: (self.SHORT, tuple(geo_keys)),                                  # GeoKeyDirectory
+        }
+
+    def _gdal_metadata(self) -> str:
+        items = [f'<Item name="{key}">{value}</Item>' for key, value in self.metadata.items()]
+        items += [f'<Item name="DESCRIPTION" sample="{i}" role="description">{name}</Item>'
+                  for i, name in enumerate(self.band_names)]
+        return '<GDALMetadata>' + ''.join(items) + '</GDALMetadata>'
+
+    # --- Структура файла ---
+
+    def _ifd_tags(self, level_index: int, offsets: List[int], byte_counts: List[int]) -> Dict[int, tuple]:
+        level = self.levels[level_index]
+        h, w, bands = level.shape
+        tags = {
+            254: (self.LONG, (1 if level_index else 0,)),        # NewSubfileType: обзор / основное
+            256: (self.LONG, (w,)),                              # ImageWidth
+            257: (self.LONG, (h,)),                              # ImageLength
+            258: (self.SHORT, (32,) * bands),                    # BitsPerSample
+            259: (self.SHORT, (8,)),                             # Compression = Deflate
+            262: (self.SHORT, (1,)),                             # Photometric = MinIsBlack
+            277: (self.SHORT, (bands,)),                         # SamplesPerPixel
+            284: (self.SHORT, (1,)),                             # PlanarConfiguration = чересполосно
+            317: (self.SHORT, (3,)),                             # Predictor = плавающая точка
+            322: (self.SHORT, (self.TILE_SIZE,)),                # TileWidth
+            323: (self.SHORT, (self.TILE_SIZE,)),                # TileLength
+            324: (self.LONG, tuple(offsets)),                    # TileOffsets
+            325: (self.LONG, tuple(byte_counts)),                # TileByteCounts
+            339: (self.SHORT, (3,) * bands),                     # SampleFormat = IEEE float
+            42113: (self.ASCII, 'nan'),                          # GDAL_NODATA
+        }
+        if bands > 1:
+            tags[338] = (self.SHORT, (0,) * (bands - 1))         # ExtraSamples: прочие каналы без роли
+        if level_index == 0:
+            tags.update(self._geo_tags())
+            tags[42112] = (self.ASCII, self._gdal_metadata())    # GDAL_METADATA: имена каналов
+        return tags
+
+    def _value_bytes(self, field_type: int, values) -> bytes:
+        if field_type == self.ASCII:
+            return values.encode('utf-8') + b'\0'
+        return struct.pack(f'<{len(values)}{self.TYPE_FORMATS[field_type]}', *values)
+
+    def _ifd_size(self, tags: Dict[int, tuple]) -> int:
+        size = 2 + 12 * len(tags) + 4
+        for field_type, values in tags.values():
+            length = len(self._value_bytes(field_type, values))
+            if length > 4:
+                size += length + length % 2
+        return size
+
+    def _pack_ifd(self, tags: Dict[int, tuple], ifd_offset: int, next_offset: int) -> bytes:
+        entries = [struct.pack('<H', len(tags))]
+        extra = b''
+        extra_offset = ifd_offset + 2 + 12 * len(tags) + 4
+        for tag in sorted(tags):
+            field_type, values = tags[tag]
+            data = self._value_bytes(field_type, values)
+            count = len(data) // self.TYPE_SIZES[field_type]
+            if len(data) <= 4:
+                entries.append(struct.pack('<HHI', tag, field_type, count) + data.ljust(4, b'\0'))
+            else:
+                entries.append(struct.pack('<HHII', tag, field_type, count, extra_offset + len(extra)))
+                extra += data + b'\0' * (len(data) % 2)
+        entries.append(struct.pack('<I', next_offset))
+        return b''.join(entries) + extra
+
+    def _build_header(self):
+        """Заголовок и все IFD; возвращает (байты заголовка, полный размер файла)."""
+        tile_sizes = self._level_tile_sizes()
+        # Размер IFD не зависит от значений смещений, поэтому сначала считаем его с нулями
+        placeholders = [self._ifd_tags(i, [0] * len(sizes), sizes) for i, sizes in enumerate(tile_sizes)]
+        ifd_offsets, position = [], 8
+        for tags in placeholders:
+            ifd_offsets.append(position)
+            position += self._ifd_size(tags)
+
+        # Данные: от самого мелкого обзора к полному разрешению
+        tile_offsets = [None] * len(self.levels)
+        for i in reversed(range(len(self.levels))):
+            offsets = []
+            for size in tile_sizes[i]:
+                offsets.append(position)
+                position += size
+            tile_offsets[i] = offsets
+
+        header = [b'II', struct.pack('<HI', 42, ifd_offsets[0])]
+        for i, sizes in enumerate(tile_sizes):
+            next_offset = ifd_offsets[i + 1] if i + 1 < len(ifd_offsets) else 0
+            header.append(self._pack_ifd(self._ifd_tags(i, tile_offsets[i], sizes), ifd_offsets[i], next_offset))
+        return b''.join(header), position
+
+    def content_length(self) -> int:
+        return self._build_header()[1]
+
+    def iter_bytes(self) -> Iterator[bytes]:
+        """Отдает файл по частям: заголовок с IFD, затем сжатые тайлы."""
+        header, _ = self._build_header()
+        yield header
+        for level in reversed(self.levels):
+            for tile in self._iter_tiles(level):
+                yield self._encode_tile(tile)
@@ -0,0 +1,83 @@
+# --- START OF FILE image_encoder.py ---
+
+import logging
+from io import BytesIO
+from typing import Dict, Tuple
+import numpy as np
+from PIL import Image
+from app_config import AppConfig
+
+logger = logging.getLogger(__name__)
+
+class ImageEncoder:
+    """
+    Кодирует готовые uint8-изображения (L, RGB или RGBA) в байты выбранного формата.
+    Для каждого типа выходного изображения задан свой профиль кодирования;
+    профили переопределяются в секции "image_encoding" файла конфигурации, например:
+        {"image_encoding": {"rgb": {"format": "webp", "quality": 80}}}
+    Поддерживаемые параметры профиля:
+        format        - "jpeg", "png" или "webp"
+        quality       - качество для JPEG и WebP с потерями (1-100)
+        lossless      - WebP без потерь
+        method        - скорость/степень сжатия WebP (0-6)
+        quantize      - для PNG: перевести в палитру из colors цветов
+        colors        - размер палитры (2-256)
+        compress_level - уровень zlib для PNG (0-9)
+    """
+    MEDIA_TYPES = {'jpeg': 'image/jpeg', 'png': 'image/png', 'webp': 'image/webp'}
+    DEFAULT_PROFILES = {
+        # Снимок в естественных цветах
+        'rgb': {'format': 'jpeg', 'quality': 85},
+        # Серые карты индексов: палитра почти не теряет информации, но сильно уменьшает размер
+        'index': {'format': 'png', 'quantize': True, 'colors': 64, 'compress_level': 6},
+        # Цветной оверлей с прозрачностью
+        'overlay': {'format': 'png', 'quantize': True, 'colors': 128, 'compress_level': 6},
+        'problem_zones': {'format': 'jpeg', 'quality': 80},
+        # Тайлы карты: PNG без палитры, чтобы соседние тайлы не отличались цветами
+        'tile': {'format': 'png', 'compress_level': 6},
+        # Одиночные изображения эндпоинтов /image/*
+        'channel': {'format': 'jpeg', 'quality': 85},
+    }
+
+    def __init__(self, profiles: Dict = None):
+        configured = profiles if profiles is not None else AppConfig.get_section('image_encoding', {})
+        self.profiles = {}
+        for output_type, profile in self.DEFAULT_PROFILES.items():
+            self.profiles[output_type] = {**profile, **configured.get(output_type, {})}
+        for output_type, profile in configured.items():
+            self.profiles.setdefault(output_type, dict(profile))
+
+    def get_profile(self, output_type: str, image_format: str = None) -> Dict:
+        profile = dict(self.profiles.get(output_type, self.DEFAULT_PROFILES['rgb']))
+        if image_format:
+            profile['format'] = image_format.lower()
+        if profile['format'] == 'jpg':
+            profile['format'] = 'jpeg'
+        if profile['format'] not in self.MEDIA_TYPES:
+            raise ValueError(f"Неподдерживаемый формат изображения: {profile['format']}")
+        return profile
+
+    def encode(self, array: np.ndarray, output_type: str, image_format: str = None) -> Tuple[bytes, str]:
+        """Возвращает (байты изображения, media type)."""
+        profile = self.get_profile(output_type, image_format)
+        image_format = profile['format']
+        image = Image.fromarray(np.ascontiguousarray(array, dtype=np.uint8))
+
+        if image_format == 'jpeg' and image.mode not in ('L', 'RGB'):
+            image = image.convert('RGB')
+
+        buffered = BytesIO()
+        if image_format == 'jpeg':
+            image.save(buffered, format='JPEG', quality=int(profile.get('quality', 85)))
+        elif image_format == 'webp':
+            image.save(buffered, format='WEBP', quality=int(profile.get('quality', 80)),
+                       lossless=bool(profile.get('lossless', False)), method=int(profile.get('method', 4)))
+        else:
+            if profile.get('quantize'):
+                colors = int(profile.get('colors', 256))
+                # FASTOCTREE - единственный метод квантования PIL, сохраняющий альфа-канал
+                method = Image.Quantize.FASTOCTREE if image.mode == 'RGBA' else Image.Quantize.MEDIANCUT
+                image = image.quantize(colors=colors, method=method)
+            image.save(buffered, format='PNG', compress_level=int(profile.get('compress_level', 6)))
+
+        return buffered.getvalue(), self.MEDIA_TYPES[image_format]
@@ -5,6 +5,10 @@ class VegetationIndexCalculator:
     """
     Принимает готовые каналы (RGB для визуализации, Red, Green, Blue, NIR для
     расчетов) и выполняет вычисление и визуализацию индексов.
+    Если передана маска области (mask), индексы считаются только для пикселей
+    внутри нее: каналы один раз сжимаются до вектора пикселей маски, а в карты
+    индексов результат раскладывается обратно, вне маски - NaN.
+    Значения индексов только внутри маски доступны в index_values.
     """
     EPSILON = 1e-8
     L_SAVI = 0.5 # Коэффициент коррекции почвы для SAVI, стандартное значение
@@ -16,25 +20,42 @@ class VegetationIndexCalculator:
 
     def __init__(self, rgb_image: np.ndarray, red_channel: np.ndarray,
                  green_channel: np.ndarray, blue_channel: np.ndarray,
-                 nir_channel: np.ndarray = None):
+                 nir_channel: np.ndarray = None, mask: np.ndarray = None):
         """Инициализируется готовыми NumPy массивами."""
         if rgb_image is None:
             raise ValueError("RGB изображение (rgb_image) для визуализации должно быть предоставлено.")
         self.rgb_image = rgb_image
-        self.red_channel = red_channel.astype(np.float32)
-        self.green_channel = green_channel.astype(np.float32)
-        self.blue_channel = blue_channel.astype(np.float32)
-        self.nir_channel = nir_channel.astype(np.float32) if nir_channel is not None else None
+        self.mask = mask
+        self.red_channel = self._prepare_channel(red_channel)
+        self.green_channel = self._prepare_channel(green_channel)
+        self.blue_channel = self._prepare_channel(blue_channel)
+        self.nir_channel = self._prepare_channel(nir_channel) if nir_channel is not None else None
+        self.index_values = {}
 
         self.vari_map = None
         self.ndvi_map = None
         self.savi_map = None # Добавлено
         self.evi_map = None # Добавлено
 
+    def _prepare_channel(self, channel: np.ndarray) -> np.ndarray:
+        """Канал в float32; при наличии маски - только пиксели внутри нее."""
+        if self.mask is not None:
+            return channel[self.mask].astype(np.float32)
+        return channel.astype(np.float32)
+
+    def _to_map(self, index_name: str, values: np.ndarray) -> np.ndarray:
+        """Запоминает значения индекса и возвращает его карту в размере снимка."""
+        self.index_values[index_name] = values
+        if self.mask is None:
+            return values
+        index_map = np.full(self.mask.shape, np.nan, dtype=np.float32)
+        index_map[self.mask] = values
+        return index_map
+
     def calculate_vari(self) -> np.ndarray:
         """Вычисляет индекс VARI по научным данным каналов."""
-        self.vari_map = ((self.green_channel - self.red_channel) /
-                         (self.green_channel + self.red_channel - self.blue_channel + self.EPSILON))
+        self.vari_map = self._to_map('vari', (self.green_channel - self.red_channel) /
+                                     (self.green_channel + self.red_channel - self.blue_channel + self.EPSILON))
         return self.vari_map
 
     def calculate_ndvi(self) -> np.ndarray:
@@ -42,8 +63,8 @@ class VegetationIndexCalculator:
         if self.nir_channel is None:
             raise ValueError("Для расчета NDVI необходим NIR канал (nir_channel).")
 
-        self.ndvi_map = ((self.nir_channel - self.red_channel) /
-                         (self.nir_channel + self.red_channel + self.EPSILON))
+        self.ndvi_map = self._to_map('ndvi', (self.nir_channel - self.red_channel) /
+                                     (self.nir_channel + self.red_channel + self.EPSILON))
         return self.ndvi_map
 
     # --- НОВЫЙ МЕТОД ---
@@ -54,7 +75,7 @@ class VegetationIndexCalculator:
 
         numerator = self.nir_channel - self.red_channel
         denominator = self.nir_channel + self.red_channel + self.L_SAVI
-        self.savi_map = ((numerator / (denominator + self.EPSILON)) * (1 + self.L_SAVI))
+        self.savi_map = self._to_map('savi', (numerator / (denominator + self.EPSILON)) * (1 + self.L_SAVI))
         return self.savi_map
         
     # --- НОВЫЙ МЕТОД ---
@@ -68,5 +89,5 @@ class VegetationIndexCalculator:
         denominator = (self.nir_channel + self.C1_EVI * self.red_channel - 
                        self.C2_EVI * self.blue_channel + self.L_EVI)
         
-        self.evi_map = self.G_EVI * (numerator / (denominator + self.EPSILON))
+        self.evi_map = self._to_map('evi', self.G_EVI * (numerator / (denominator + self.EPSILON)))
         return self.evi_map
\ No newline at end of file
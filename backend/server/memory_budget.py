@@ -0,0 +1,140 @@
+# --- START OF FILE memory_budget.py ---
+
+import gc
+import math
+import time
+import threading
+import logging
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class MemoryBudget:
+    """
+    Ограничение памяти процесса при обработке снимков - один объект на процесс
+    (MemoryBudget.shared), общий для всех одновременно выполняющихся анализов.
+    Перед загрузкой снимка анализ резервирует оценку памяти на его обработку (reserve),
+    а после освобождения массивов снимка возвращает резерв (release). Резерв выдается
+    под блокировкой, только если текущий RSS вместе со всеми невозвращенными резервами
+    помещается в лимит; иначе снимок запрашивается в уменьшенном разрешении, а если
+    не помещается даже MIN_SCALE - анализ ждет, пока другие анализы вернут резервы.
+    Оценка с запасом: память уже обрабатываемых снимков учитывается и в RSS, и в резерве.
+    Память процесса читается из /proc/self/status (Linux); если он недоступен,
+    лимит не применяется.
+    """
+    # Оценка рабочей памяти на пиксель снимка: RGB (3 байта) + 4 канала float32 (16)
+    # + 4 карты индексов float32 и их значения внутри маски (32) + растр и изображения (~13)
+    BYTES_PER_PIXEL = 64
+    # Сильнее уменьшать снимок бессмысленно: такой снимок лучше пропустить
+    MIN_SCALE = 0.25
+    # Сколько ждать освобождения памяти другими анализами, прежде чем пропустить снимок
+    WAIT_SECONDS = 120
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, limit_mb: Optional[float] = None):
+        self.limit_mb = float(limit_mb) if limit_mb else None
+        self._cond = threading.Condition()
+        self._reserved_mb = 0.0
+        self._stats = {'reservations': 0, 'downsampled': 0, 'waits': 0, 'rejected': 0,
+                       'active': 0, 'max_reserved_mb': 0.0}
+
+    @classmethod
+    def shared(cls, limit_mb: Optional[float] = None) -> 'MemoryBudget':
+        """Общий для процесса бюджет; лимит берется из последней настройки."""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls(limit_mb)
+            else:
+                cls._shared.limit_mb = float(limit_mb) if limit_mb else None
+            return cls._shared
+
+    @staticmethod
+    def _read_status_mb(field: str) -> Optional[float]:
+        try:
+            with open('/proc/self/status', 'r') as f:
+                for line in f:
+                    if line.startswith(field + ':'):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+        return None
+
+    def rss_mb(self) -> Optional[float]:
+        """Текущий объем памяти процесса (VmRSS), МБ."""
+        return self._read_status_mb('VmRSS')
+
+    def peak_rss_mb(self) -> Optional[float]:
+        """Пиковый объем памяти процесса за время работы (VmHWM), МБ."""
+        return self._read_status_mb('VmHWM')
+
+    def _available_mb(self) -> Optional[float]:
+        rss = self.rss_mb()
+        if rss is None:
+            return None
+        return self.limit_mb - rss - self._reserved_mb
+
+    def reserve(self, pixels: int) -> Tuple[float, float]:
+        """
+        Резервирует память на обработку снимка из pixels пикселей. Возвращает
+        (коэффициент уменьшения стороны снимка - 1.0 без уменьшения, зарезервировано МБ);
+        резерв нужно вернуть через release, даже если обработка не удалась.
+        Если снимок не помещается даже с MIN_SCALE и дождаться памяти не удалось,
+        выбрасывает MemoryError.
+        """
+        if self.limit_mb is None:
+            return 1.0, 0.0
+        needed_mb = pixels * self.BYTES_PER_PIXEL / (1024 * 1024)
+        deadline = time.monotonic() + self.WAIT_SECONDS
+        with self._cond:
+            collected = False
+            while True:
+                available_mb = self._available_mb()
+                if available_mb is None:
+                    return 1.0, 0.0
+                if available_mb < needed_mb and not collected:
+                    # Массивы предыдущего снимка могли остаться в циклических ссылках
+                    gc.collect()
+                    collected = True
+                    available_mb = self._available_mb()
+                scale = 1.0 if available_mb >= needed_mb else math.sqrt(max(available_mb, 0.0) / needed_mb)
+                if scale >= self.MIN_SCALE:
+                    break
+                remaining = deadline - time.monotonic()
+                if self._reserved_mb <= 0 or remaining <= 0:
+                    self._stats['rejected'] += 1
+                    raise MemoryError(f"Недостаточно памяти для обработки снимка: свободно {max(available_mb, 0):.0f} МБ "
+                                      f"из {self.limit_mb:.0f} МБ, резерв других анализов {self._reserved_mb:.0f} МБ")
+                # Память занята другими анализами: ждем, пока они вернут резерв
+                self._stats['waits'] += 1
+                self._cond.wait(remaining)
+                collected = False
+
+            reserved_mb = needed_mb * scale * scale
+            self._reserved_mb += reserved_mb
+            self._stats['reservations'] += 1
+            self._stats['active'] += 1
+            self._stats['max_reserved_mb'] = max(self._stats['max_reserved_mb'], round(self._reserved_mb, 1))
+            if scale < 1.0:
+                self._stats['downsampled'] += 1
+                logger.info(f"Снимок будет уменьшен в {1 / scale:.2f} раза, чтобы уложиться в лимит памяти {self.limit_mb:.0f} МБ")
+            return scale, reserved_mb
+
+    def release(self, reserved_mb: float):
+        """Возвращает резерв, полученный от reserve."""
+        if not reserved_mb:
+            return
+        with self._cond:
+            self._reserved_mb = max(0.0, self._reserved_mb - reserved_mb)
+            self._stats['active'] -= 1
+            self._cond.notify_all()
+
+    def get_stats(self) -> Dict:
+        with self._cond:
+            stats = dict(self._stats)
+            stats['reserved_mb'] = round(self._reserved_mb, 1)
+        stats['limit_mb'] = self.limit_mb
+        stats['rss_mb'] = self.rss_mb()
+        stats['peak_rss_mb'] = self.peak_rss_mb()
+        return stats
@@ -0,0 +1,95 @@
+# --- START OF FILE payload_codec.py ---
+
+import zlib
+import logging
+from typing import Dict, Optional, Union
+from app_config import AppConfig
+
+logger = logging.getLogger(__name__)
+
+class PayloadCodec:
+    """
+    Сжатие JSON-данных, хранящихся в БД (analyses.data, большие user_data).
+    Сжатое значение хранится в той же колонке как BLOB:
+        MAGIC (2 байта) + ID словаря (1 байт) + поток zlib со словарем (zdict).
+    Несжатые строки (все строки, записанные до появления сжатия, и короткие значения)
+    остаются TEXT и читаются как есть, поэтому формат определяется по самому значению.
+    Словарь - типичный фрагмент JSON анализа: повторяющиеся ключи сжимаются уже
+    в первых байтах, что особенно заметно на небольших анализах. Словари неизменяемы:
+    новый словарь добавляется под новым ID, старые нужны для чтения старых строк.
+    Параметры задаются в секции "compression" файла конфигурации.
+    """
+    MAGIC = b'\x00z'
+    DEFAULT_SETTINGS = {
+        'enabled': True,
+        'level': 6,
+        # Значения короче этого размера хранятся текстом: сжатие не окупается
+        'min_size_bytes': 1024,
+        # Фоновое сжатие строк, сохраненных без сжатия (см. RecompressionJob)
+        'recompress_on_start': True,
+        'recompress_batch_size': 50,
+        'recompress_pause_seconds': 0.5,
+    }
+    DICTIONARIES = {
+        1: (
+            '{"analysis_id": "", "timestamp": , "area_of_interest": {"type": "point_radius", "lon": , "lat": , "radius_km": }, '
+            '{"type": "polygon", "coordinates": [[, ]]}, "date_range": {"start": "", "end": ""}, "image_count": , '
+            '"results_per_image": [{"scene_id": "COPERNICUS/S2_SR_HARMONIZED/", "date": "", "cloud_coverage": , '
+            '"raster": {"blob_id": "", "media_type": "application/x-npz", "url": "/api/images/"}, "bounds": [[, ], [, ]], '
+            '"statistics": {"ndvi": {"min": , "max": , "mean": , "std": }, "savi": {"min": , "max": , "mean": , "std": }, '
+            '"vari": {"min": , "max": , "mean": , "std": }, "evi": {"min": , "max": , "mean": , "std": }}, '
+            '"zoning": {"ndvi": {"low": , "medium": , "high": }, "savi": {"low": , "medium": , "high": }, '
+            '"vari": {"low": , "medium": , "high": }, "evi": {"low": , "medium": , "high": }}, '
+            '"histograms": {"ndvi": {"min": -1.0, "max": 1.0, "bins": 20, "counts": [, ]}, '
+            '"savi": {"min": -1.5, "max": 1.5, "bins": 20, "counts": [, ]}, '
+            '"vari": {"min": -1.0, "max": 1.0, "bins": 20, "counts": [, ]}, '
+            '"evi": {"min": -1.0, "max": 1.0, "bins": 20, "counts": [, ]}}, '
+            '"images": {"rgb": {"layer": "rgb", "url": "/api/analysis//scenes//rgb"}, '
+            '"ndvi": {"layer": "ndvi", "url": "/api/analysis//scenes//ndvi"}, '
+            '"savi": {"layer": "savi", "url": "/api/analysis//scenes//savi"}, '
+            '"vari": {"layer": "vari", "url": "/api/analysis//scenes//vari"}, '
+            '"evi": {"layer": "evi", "url": "/api/analysis//scenes//evi"}}, '
+            '"ndvi_overlay_image": {"layer": "ndvi_overlay", "url": "/api/analysis//scenes//ndvi_overlay"}, '
+            '"problem_zones_image": {"layer": "problem_zones", "url": "/api/analysis//scenes//problem_zones"}, '
+            '"resolution_scale": }], "metadata": {"resolution": "10m", "source": "Sentinel-2", "render_mode": "lazy", '
+            '"status": "completed", "base_analysis_id": "", "reused_scenes": , "new_scenes": , "field_id": "", "batch": true}}'
+        ).encode('utf-8'),
+    }
+    CURRENT_DICTIONARY = 1
+
+    def __init__(self, settings: Dict = None):
+        self.settings = settings if settings is not None else AppConfig.get_section('compression', self.DEFAULT_SETTINGS)
+        self.enabled = bool(self.settings['enabled'])
+        self.level = int(self.settings['level'])
+        self.min_size = int(self.settings['min_size_bytes'])
+
+    @classmethod
+    def is_compressed(cls, value) -> bool:
+        return isinstance(value, bytes) and value.startswith(cls.MAGIC)
+
+    def should_compress(self, text: str) -> bool:
+        return self.enabled and len(text) >= self.min_size
+
+    def encode(self, text: Optional[str]) -> Union[str, bytes, None]:
+        """Значение для записи в БД: сжатый BLOB или исходная строка, если сжимать не нужно."""
+        if text is None or not self.should_compress(text):
+            return text
+        zdict = self.DICTIONARIES[self.CURRENT_DICTIONARY]
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, zlib.MAX_WBITS, 9, zlib.Z_DEFAULT_STRATEGY, zdict)
+        data = compressor.compress(text.encode('utf-8')) + compressor.flush()
+        return self.MAGIC + bytes([self.CURRENT_DICTIONARY]) + data
+
+    @classmethod
+    def decode(cls, value: Union[str, bytes, None]) -> Optional[str]:
+        """Строка из значения, прочитанного из БД, в любом из форматов."""
+        if value is None or isinstance(value, str):
+            return value
+        if not cls.is_compressed(value):
+            return bytes(value).decode('utf-8')
+        dictionary_id = value[len(cls.MAGIC)]
+        zdict = cls.DICTIONARIES.get(dictionary_id)
+        if zdict is None:
+            raise ValueError(f"Неизвестный словарь сжатия: {dictionary_id}")
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS, zdict)
+        data = decompressor.decompress(value[len(cls.MAGIC) + 1:]) + decompressor.flush()
+        return data.decode('utf-8')
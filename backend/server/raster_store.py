@@ -0,0 +1,37 @@
+# --- START OF FILE raster_store.py ---
+
+import logging
+from io import BytesIO
+from typing import Dict, Tuple
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+class RasterCodec:
+    """
+    Компактная упаковка растров снимка для хранения: RGB в uint8 и карты индексов
+    в float16 в одном сжатом npz-архиве. Из этих данных можно заново построить
+    любую визуализацию, тайлы или экспорт без повторного запроса к GEE.
+    """
+    MEDIA_TYPE = 'application/x-npz'
+    INDEX_NAMES = ('ndvi', 'savi', 'vari', 'evi')
+    # Предел float16: значения за ним (деление на почти ноль в VARI/EVI) обрезаются, а не превращаются в inf
+    FLOAT16_MAX = float(np.finfo(np.float16).max)
+
+    @classmethod
+    def pack(cls, rgb_image: np.ndarray, index_maps: Dict[str, np.ndarray]) -> bytes:
+        arrays = {'rgb': np.ascontiguousarray(rgb_image, dtype=np.uint8)}
+        for name in cls.INDEX_NAMES:
+            if name in index_maps:
+                arrays[name] = np.clip(index_maps[name], -cls.FLOAT16_MAX, cls.FLOAT16_MAX).astype(np.float16)
+        buffered = BytesIO()
+        np.savez_compressed(buffered, **arrays)
+        return buffered.getvalue()
+
+    @classmethod
+    def unpack(cls, data: bytes) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        """Возвращает (rgb uint8, {индекс: float32 карта})."""
+        with np.load(BytesIO(data)) as archive:
+            rgb_image = archive['rgb']
+            index_maps = {name: archive[name].astype(np.float32) for name in cls.INDEX_NAMES if name in archive.files}
+        return rgb_image, index_maps
@@ -0,0 +1,79 @@
+# --- START OF FILE recompression.py ---
+
+import time
+import threading
+import logging
+from typing import Dict
+from payload_codec import PayloadCodec
+from app_config import AppConfig
+
+logger = logging.getLogger(__name__)
+
+class RecompressionJob:
+    """
+    Фоновое сжатие данных, сохраненных до включения сжатия (см. PayloadCodec).
+    Проходит таблицы analyses и user_data небольшими порциями с паузой между ними,
+    чтобы не занимать блокировку записи надолго, и завершается, когда несжатых
+    строк больше нет. Новые данные сжимаются сразу при записи, поэтому повторный
+    проход нужен только после смены настроек (например, включения сжатия).
+    Освободившиеся страницы файла БД переиспользуются для новых данных.
+    """
+    TABLES = ('analyses', 'user_data')
+
+    def __init__(self, db_manager, settings: Dict = None):
+        self.db = db_manager
+        self.settings = settings if settings is not None else AppConfig.get_section('compression', PayloadCodec.DEFAULT_SETTINGS)
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._stats = {'state': 'idle', 'rows': 0, 'bytes_before': 0, 'bytes_after': 0,
+                       'batches': 0, 'errors': 0, 'started_at': None, 'finished_at': None}
+
+    def start(self) -> bool:
+        """Запускает проход в фоновом потоке; False, если сжатие выключено или проход уже идет."""
+        if not self.settings.get('enabled', True):
+            return False
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run, name="recompression", daemon=True)
+            self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        """Полный проход по всем таблицам (выполняется в фоновом потоке)."""
+        batch_size = int(self.settings.get('recompress_batch_size', 50))
+        pause = float(self.settings.get('recompress_pause_seconds', 0.5))
+        with self._lock:
+            self._stats.update({'state': 'running', 'started_at': time.time(), 'finished_at': None})
+        logger.info("Запущено фоновое сжатие ранее сохраненных данных")
+        try:
+            for table in self.TABLES:
+                while not self._stop.is_set():
+                    result = self.db.recompress_payloads(table, batch_size)
+                    if result is None:
+                        with self._lock:
+                            self._stats['errors'] += 1
+                        break
+                    if result['scanned'] == 0:
+                        break
+                    with self._lock:
+                        self._stats['batches'] += 1
+                        for key in ('rows', 'bytes_before', 'bytes_after'):
+                            self._stats[key] += result[key]
+                    self._stop.wait(pause)
+        finally:
+            with self._lock:
+                self._stats['state'] = 'stopped' if self._stop.is_set() else 'finished'
+                self._stats['finished_at'] = time.time()
+                stats = dict(self._stats)
+            logger.info(f"Фоновое сжатие завершено: строк {stats['rows']}, "
+                        f"{stats['bytes_before']} -> {stats['bytes_after']} байт")
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return dict(self._stats)
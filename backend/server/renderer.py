@@ -0,0 +1,151 @@
+# --- START OF FILE renderer.py ---
+
+import logging
+from typing import Dict, Iterable, List, Tuple
+import numpy as np
+import cv2
+
+logger = logging.getLogger(__name__)
+
+class ColormapRegistry:
+    """
+    Реестр цветовых карт. Каждая карта - таблица из 256 RGB-цветов, которая строится
+    один раз векторной интерполяцией по опорным цветам и кэшируется на уровне класса.
+    Раскрашивание выполняется через cv2.LUT, прозрачность NaN - отдельным альфа-каналом.
+    """
+    COLORMAPS = {
+        # Красный -> желтый -> зеленый (как в прежнем оверлее NDVI)
+        'red_yellow_green': [(0.0, (255, 0, 0)), (0.5, (255, 255, 0)), (1.0, (0, 255, 0))],
+        # Расходящаяся карта для разностей: снижение - красный, рост - зеленый
+        'red_white_green': [(0.0, (215, 25, 28)), (0.5, (255, 255, 255)), (1.0, (26, 150, 65))],
+        'gray': [(0.0, (0, 0, 0)), (1.0, (255, 255, 255))],
+    }
+    # Цветовая карта и диапазон значений оверлея для каждого индекса
+    INDEX_COLORMAPS = {
+        'ndvi': ('red_yellow_green', 0.0, 1.0),
+        'savi': ('red_yellow_green', 0.0, 1.0),
+        'evi': ('red_yellow_green', 0.0, 1.0),
+        'vari': ('red_yellow_green', -0.2, 0.5),
+    }
+    _luts = {}
+
+    @classmethod
+    def get_lut(cls, name: str) -> List[np.ndarray]:
+        """Возвращает три таблицы (R, G, B) по 256 значений uint8."""
+        luts = cls._luts.get(name)
+        if luts is None:
+            stops = cls.COLORMAPS[name]
+            positions = np.array([p for p, _ in stops]) * 255
+            colors = np.array([c for _, c in stops], dtype=np.float64)
+            grid = np.arange(256)
+            luts = [np.round(np.interp(grid, positions, colors[:, channel])).astype(np.uint8) for channel in range(3)]
+            cls._luts[name] = luts
+        return luts
+
+    @classmethod
+    def get_index_colormap(cls, index_name: str) -> Tuple[str, float, float]:
+        return cls.INDEX_COLORMAPS.get(index_name, ('red_yellow_green', 0.0, 1.0))
+
+    @staticmethod
+    def quantize(values: np.ndarray, valid: np.ndarray, vmin: float, vmax: float) -> np.ndarray:
+        """Линейно переводит значения диапазона [vmin, vmax] в 0..255; невалидные пиксели -> 0."""
+        if not (np.isfinite(vmin) and np.isfinite(vmax)) or vmax <= vmin:
+            return np.zeros(values.shape, dtype=np.uint8)
+        scale = 255.0 / (vmax - vmin)
+        quantized = cv2.convertScaleAbs(np.clip(values, vmin, vmax), alpha=scale, beta=-vmin * scale)
+        return cv2.bitwise_and(quantized, quantized, mask=valid.view(np.uint8))
+
+    @classmethod
+    def apply(cls, name: str, values: np.ndarray, valid: np.ndarray, vmin: float, vmax: float) -> np.ndarray:
+        """Раскрашивает карту значений в RGBA; NaN становятся прозрачными."""
+        quantized = cls.quantize(values, valid, vmin, vmax)
+        channels = [cv2.LUT(quantized, lut) for lut in cls.get_lut(name)]
+        alpha = valid.view(np.uint8) * np.uint8(255)
+        return cv2.merge(channels + [alpha])
+
+
+class SceneRenderer:
+    """
+    Строит все визуализации одного снимка за общий проход: маски валидных пикселей,
+    серое изображение снимка и квантованные карты индексов вычисляются один раз
+    и переиспользуются всеми слоями.
+    Слои: 'rgb', '<index>' (серая карта индекса), '<index>_overlay' (цветной оверлей
+    с прозрачностью), 'problem_zones' (низкий NDVI красным на сером снимке).
+    """
+    INDEX_NAMES = ('ndvi', 'savi', 'vari', 'evi')
+    DEFAULT_LAYERS = ('rgb', 'ndvi', 'savi', 'vari', 'evi', 'ndvi_overlay', 'problem_zones')
+    # Подсветка проблемных зон: 60% серого + 40% красного, заранее для всех 256 уровней серого
+    PROBLEM_TINT_RED = np.round(np.arange(256) * 0.6 + 255 * 0.4).astype(np.uint8)
+    PROBLEM_TINT_OTHER = np.round(np.arange(256) * 0.6).astype(np.uint8)
+
+    @staticmethod
+    def output_type(layer: str) -> str:
+        """Профиль кодирования ImageEncoder для слоя."""
+        if layer == 'rgb':
+            return 'rgb'
+        if layer == 'problem_zones':
+            return 'problem_zones'
+        if layer.endswith('_overlay'):
+            return 'overlay'
+        return 'index'
+
+    @classmethod
+    def available_layers(cls) -> List[str]:
+        return ['rgb', 'problem_zones'] + list(cls.INDEX_NAMES) + [f'{name}_overlay' for name in cls.INDEX_NAMES]
+
+    @classmethod
+    def render_scene(cls, rgb_image: np.ndarray, index_maps: Dict[str, np.ndarray],
+                     stats: Dict[str, Dict] = None, layers: Iterable[str] = DEFAULT_LAYERS,
+                     problem_threshold: float = 0.2) -> Dict[str, np.ndarray]:
+        """
+        Возвращает {слой: uint8 массив}. stats (min/max по индексам) можно передать,
+        чтобы не пересчитывать их для растяжения серых карт.
+        """
+        layers = list(layers)
+        stats = stats or {}
+        valid_masks = {}
+
+        def valid_mask(index_name):
+            if index_name not in valid_masks:
+                valid_masks[index_name] = np.isfinite(index_maps[index_name])
+            return valid_masks[index_name]
+
+        rendered = {}
+        for layer in layers:
+            if layer == 'rgb':
+                rendered[layer] = rgb_image
+            elif layer in cls.INDEX_NAMES:
+                values = index_maps[layer]
+                valid = valid_mask(layer)
+                if layer in stats:
+                    vmin, vmax = stats[layer]['min'], stats[layer]['max']
+                elif valid.any():
+                    vmin, vmax = float(values[valid].min()), float(values[valid].max())
+                else:
+                    vmin, vmax = 0.0, 0.0
+                rendered[layer] = ColormapRegistry.quantize(values, valid, vmin, vmax)
+            elif layer.endswith('_overlay') and layer[:-len('_overlay')] in cls.INDEX_NAMES:
+                index_name = layer[:-len('_overlay')]
+                cmap, vmin, vmax = ColormapRegistry.get_index_colormap(index_name)
+                rendered[layer] = ColormapRegistry.apply(cmap, index_maps[index_name], valid_mask(index_name), vmin, vmax)
+            elif layer == 'problem_zones':
+                rendered[layer] = cls._render_problem_zones(rgb_image, index_maps['ndvi'], valid_mask('ndvi'), problem_threshold)
+            else:
+                raise ValueError(f"Неизвестный слой визуализации: {layer}")
+        return rendered
+
+    @classmethod
+    def _render_problem_zones(cls, rgb_image: np.ndarray, ndvi_map: np.ndarray,
+                              valid: np.ndarray, threshold: float) -> np.ndarray:
+        """Подсвечивает пиксели с NDVI < threshold без промежуточного красного слоя."""
+        gray = cv2.cvtColor(rgb_image, cv2.COLOR_RGB2GRAY)
+        h, w = gray.shape
+        if ndvi_map.shape != (h, w):
+            # INTER_NEAREST, чтобы не создавать новых значений NDVI при интерполяции
+            ndvi_map = cv2.resize(ndvi_map, (w, h), interpolation=cv2.INTER_NEAREST)
+            valid = np.isfinite(ndvi_map)
+
+        problem_mask = valid & (ndvi_map < threshold)
+        red = np.where(problem_mask, cv2.LUT(gray, cls.PROBLEM_TINT_RED), gray)
+        other = np.where(problem_mask, cv2.LUT(gray, cls.PROBLEM_TINT_OTHER), gray)
+        return cv2.merge([red, other, other])
@@ -0,0 +1,243 @@
+# --- START OF FILE retention.py ---
+
+import time
+import datetime
+import threading
+import logging
+from typing import Dict, Optional
+from app_config import AppConfig
+
+logger = logging.getLogger(__name__)
+
+class RetentionJob:
+    """
+    Фоновое ограничение размера БД. Каждые interval_seconds:
+      1. удаляет анализы сверх ограничений хранения: больше max_analyses_per_user у пользователя,
+         старше max_age_days, не помещающиеся в квоту quota_mb_per_user (удаляются самые старые);
+      2. удаляет осиротевшие анализы, которых нет в списке ни одного пользователя,
+         незавершенные анализы старше orphan_grace_hours и служебные анализы сравнения
+         снимков старше internal_analysis_days (в ограничениях пункта 1 они не учитываются);
+      3. снимает закрепление изображений вне анализов (карты изменений) старше standalone_blob_days
+         и удаляет изображения, на которые больше не ссылается ни один анализ или пользователь.
+    Удаление идет порциями по batch_size с паузой, чтобы не занимать блокировку записи надолго.
+    Удаленные строки освобождают страницы внутри файла; вернуть их файловой системе может
+    только очистка (vacuum), поэтому в часы низкой нагрузки (vacuum_hours, локальное время)
+    запускается инкрементальная очистка небольшими шагами. Режим auto_vacuum = INCREMENTAL
+    включается один раз полным VACUUM (тоже в часы низкой нагрузки).
+    0 в ограничениях отключает ограничение. Параметры задаются в секции "retention".
+    """
+    DEFAULT_SETTINGS = {
+        'enabled': True,
+        'max_analyses_per_user': 500,
+        'max_age_days': 0,
+        'quota_mb_per_user': 1024,
+        'orphan_grace_hours': 24,
+        'standalone_blob_days': 30,
+        'internal_analysis_days': 30,
+        'interval_seconds': 3600,
+        'batch_size': 100,
+        'pause_seconds': 0.2,
+        # Часы низкой нагрузки [начало, конец) по локальному времени сервера; конец может быть меньше начала
+        'vacuum_hours': [2, 6],
+        'vacuum_pages_per_step': 2048,
+        'enable_incremental_vacuum': True,
+    }
+
+    def __init__(self, db_manager, settings: Dict = None):
+        self.db = db_manager
+        self.settings = settings if settings is not None else AppConfig.get_section('retention', self.DEFAULT_SETTINGS)
+        self._thread = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._force_vacuum = False
+        self._lock = threading.Lock()
+        self._stats = {'state': 'idle', 'runs': 0, 'expired': {'count': 0, 'age': 0, 'quota': 0}, 'orphans': 0,
+                       'rendered_deleted': 0, 'standalone_expired': 0, 'blobs_deleted': 0, 'bytes_deleted': 0, 'vacuum_pages': 0,
+                       'errors': 0, 'last_run_at': None, 'last_run_seconds': None}
+
+    # --- Ограничения ---
+
+    def limits(self) -> Dict:
+        """Действующие ограничения хранения (None - ограничения нет)."""
+        def positive(name):
+            value = self.settings.get(name) or 0
+            return value if value > 0 else None
+        quota_mb = positive('quota_mb_per_user')
+        return {'max_analyses': positive('max_analyses_per_user'), 'max_age_days': positive('max_age_days'),
+                'quota_bytes': int(quota_mb * 1024 * 1024) if quota_mb else None}
+
+    def in_vacuum_window(self, now: Optional[datetime.datetime] = None) -> bool:
+        start, end = self.settings.get('vacuum_hours') or (0, 0)
+        hour = (now or datetime.datetime.now()).hour
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+    # --- Управление потоком ---
+
+    def start(self) -> bool:
+        """Запускает фоновый поток; False, если задача выключена или уже запущена."""
+        if not self.settings.get('enabled', True):
+            return False
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name="retention", daemon=True)
+            self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def trigger(self, vacuum: bool = False) -> bool:
+        """Внеочередной проход (vacuum=True - с очисткой файла независимо от времени суток)."""
+        if self._thread is None or not self._thread.is_alive():
+            return False
+        self._force_vacuum = self._force_vacuum or vacuum
+        self._wake.set()
+        return True
+
+    def _loop(self):
+        interval = float(self.settings.get('interval_seconds', 3600))
+        while not self._stop.is_set():
+            vacuum, self._force_vacuum = self._force_vacuum, False
+            self.run_once(force_vacuum=vacuum)
+            self._wake.wait(interval)
+            self._wake.clear()
+
+    # --- Проход ---
+
+    def _add(self, key: str, value: int):
+        with self._lock:
+            self._stats[key] += value
+
+    def _error(self):
+        self._add('errors', 1)
+
+    def _pause(self) -> bool:
+        """Пауза между порциями; False, если задачу остановили."""
+        return not self._stop.wait(float(self.settings.get('pause_seconds', 0.2)))
+
+    def run_once(self, force_vacuum: bool = False):
+        """Полный проход (выполняется в фоновом потоке)."""
+        started = time.time()
+        with self._lock:
+            self._stats['state'] = 'running'
+        try:
+            self._expire_analyses()
+            self._collect_orphans()
+            self._collect_blobs()
+            if force_vacuum or self.in_vacuum_window():
+                self._vacuum(force_vacuum)
+        except Exception as e:
+            logger.error(f"Ошибка прохода очистки хранилища: {e}")
+            self._error()
+        finally:
+            with self._lock:
+                self._stats['state'] = 'stopped' if self._stop.is_set() else 'idle'
+                self._stats['runs'] += 1
+                self._stats['last_run_at'] = started
+                self._stats['last_run_seconds'] = round(time.time() - started, 3)
+                stats = dict(self._stats)
+            logger.info(f"Очистка хранилища завершена за {stats['last_run_seconds']} с; всего с запуска: "
+                        f"истекших анализов {sum(stats['expired'].values())}, осиротевших {stats['orphans']}, "
+                        f"изображений {stats['blobs_deleted']}, освобождено страниц {stats['vacuum_pages']}")
+
+    def _expire_analyses(self):
+        limits = self.limits()
+        created_before = time.time() - limits['max_age_days'] * 86400 if limits['max_age_days'] else None
+        batch_size = int(self.settings.get('batch_size', 100))
+        while not self._stop.is_set():
+            expired = self.db.find_expired_analyses(limits['max_analyses'], created_before, limits['quota_bytes'], batch_size)
+            if expired is None:
+                self._error()
+                return
+            if not expired:
+                return
+            if self.db.delete_analyses([analysis_id for analysis_id, _, _ in expired]) is None:
+                self._error()
+                return
+            with self._lock:
+                for _, reason, size in expired:
+                    self._stats['expired'][reason] += 1
+                    self._stats['bytes_deleted'] += size
+            if not self._pause():
+                return
+
+    def _collect_orphans(self):
+        stale_before = time.time() - float(self.settings.get('orphan_grace_hours', 24)) * 3600
+        internal_days = self.settings.get('internal_analysis_days') or 0
+        internal_before = time.time() - internal_days * 86400 if internal_days > 0 else None
+        batch_size = int(self.settings.get('batch_size', 100))
+        while not self._stop.is_set():
+            orphans = self.db.find_orphan_analyses(stale_before, batch_size, internal_before)
+            if orphans is None or (orphans and self.db.delete_analyses(orphans) is None):
+                self._error()
+                return
+            if not orphans:
+                return
+            self._add('orphans', len(orphans))
+            if not self._pause():
+                return
+
+    def _collect_blobs(self):
+        batch_size = int(self.settings.get('batch_size', 100))
+        standalone_days = self.settings.get('standalone_blob_days') or 0
+        if standalone_days > 0:
+            linked_before = time.time() - standalone_days * 86400
+            while not self._stop.is_set():
+                expired = self.db.expire_user_blobs(linked_before, batch_size)
+                if expired is None:
+                    self._error()
+                    return
+                self._add('standalone_expired', expired)
+                if expired == 0 or not self._pause():
+                    break
+        created_before = time.time() - float(self.settings.get('orphan_grace_hours', 24)) * 3600
+        while not self._stop.is_set():
+            result = self.db.collect_unused_blobs(created_before, batch_size)
+            if result is None:
+                self._error()
+                return
+            with self._lock:
+                self._stats['rendered_deleted'] += result['rendered']
+                self._stats['blobs_deleted'] += result['blobs']
+                self._stats['bytes_deleted'] += result['bytes']
+            if result['blobs'] == 0 and result['rendered'] == 0:
+                return
+            if not self._pause():
+                return
+
+    def _vacuum(self, forced: bool = False):
+        file_stats = self.db.get_file_stats()
+        if file_stats is None:
+            self._error()
+            return
+        if file_stats['auto_vacuum'] != 'incremental':
+            if not self.settings.get('enable_incremental_vacuum', True):
+                return
+            logger.info(f"Перевод БД в режим инкрементальной очистки (VACUUM, {file_stats['file_bytes']} байт)")
+            if not self.db.enable_incremental_vacuum():
+                self._error()
+            return
+        pages = int(self.settings.get('vacuum_pages_per_step', 2048))
+        while not self._stop.is_set():
+            freed = self.db.incremental_vacuum(pages)
+            if freed is None:
+                self._error()
+                return
+            self._add('vacuum_pages', freed)
+            if freed < pages or not self._pause():
+                return
+            if not forced and not self.in_vacuum_window():
+                return
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['expired'] = dict(self._stats['expired'])
+        stats['limits'] = self.limits()
+        stats['file'] = self.db.get_file_stats()
+        return stats
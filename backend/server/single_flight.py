@@ -0,0 +1,76 @@
+# --- START OF FILE single_flight.py ---
+
+import threading
+import logging
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+logger = logging.getLogger(__name__)
+
+class SingleFlight:
+    """
+    Объединение одновременных одинаковых вызовов: первый вызов с данным ключом
+    выполняет работу, а вызовы с тем же ключом, пришедшие до ее завершения,
+    ждут тот же Future и получают общий результат (или то же исключение).
+    Результат не кэшируется: после завершения следующий вызов снова выполняет работу.
+    Группы именованные и создаются через SingleFlight.group(name), чтобы статистику
+    всех групп можно было получить одним вызовом SingleFlight.all_stats().
+    """
+    _groups = {}
+    _groups_lock = threading.Lock()
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._stats = {'executed': 0, 'coalesced': 0, 'errors': 0}
+
+    @classmethod
+    def group(cls, name: str) -> 'SingleFlight':
+        """Возвращает группу с указанным именем, создавая ее при первом обращении."""
+        with cls._groups_lock:
+            if name not in cls._groups:
+                cls._groups[name] = cls(name)
+            return cls._groups[name]
+
+    @classmethod
+    def all_stats(cls) -> Dict[str, Dict]:
+        with cls._groups_lock:
+            groups = list(cls._groups.values())
+        return {group.name: group.get_stats() for group in groups}
+
+    def do(self, key: Hashable, fn: Callable, *args, **kwargs) -> Tuple[Any, bool]:
+        """
+        Выполняет fn(*args, **kwargs) или присоединяется к уже выполняющемуся вызову с тем же ключом.
+        Возвращает (результат, shared), где shared=True, если результат получен от другого вызова.
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._in_flight[key] = future
+                self._stats['executed'] += 1
+            else:
+                self._stats['coalesced'] += 1
+
+        if not leader:
+            logger.info(f"[{self.name}] Ожидание уже выполняющегося запроса {key}")
+            return future.result(), True
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            with self._lock:
+                self._stats['errors'] += 1
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._in_flight[key]
+        future.set_result(result)
+        return result, False
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self._stats, 'in_flight': len(self._in_flight)}
@@ -0,0 +1,146 @@
+# --- START OF FILE tiles.py ---
+
+import math
+import threading
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import cv2
+from aoi_mask import AoiMask
+
+logger = logging.getLogger(__name__)
+
+class TileRenderer:
+    """
+    Нарезка визуализаций снимка на тайлы Web Mercator (схема XYZ, как у OSM).
+    Растры снимка уже лежат в проекции Web Mercator (миниатюры GEE), поэтому тайл
+    получается одним аффинным преобразованием растра: долгота и меркаторская y
+    в пределах снимка линейны по пикселям.
+    Слой снимка строится целиком один раз (SceneRenderer с общей статистикой снимка,
+    чтобы растяжение не отличалось от тайла к тайлу) и держится в LRU-кэше,
+    пока клиент запрашивает тайлы видимой области.
+    Все тайлы - RGBA: пиксели вне снимка и вне поля прозрачные.
+    """
+    TILE_SIZE = 256
+    MAX_ZOOM = 22
+    MAX_CACHED_LAYERS = 16
+    # Снимки, тайлы которых запрашивались недавно: растр, границы и статистика снимка,
+    # чтобы каждый тайл не загружал и не разбирал JSON всего анализа
+    MAX_CACHED_SCENES = 256
+
+    _layers = OrderedDict()
+    _scenes = OrderedDict()
+    _lock = threading.Lock()
+
+    @classmethod
+    def tile_bounds(cls, z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+        """Границы тайла (west, east, top, bottom): долгота в градусах, y - меркаторская (радианы)."""
+        n = 1 << z
+        west = x / n * 360.0 - 180.0
+        east = (x + 1) / n * 360.0 - 180.0
+        top = math.pi * (1 - 2 * y / n)
+        bottom = math.pi * (1 - 2 * (y + 1) / n)
+        return west, east, top, bottom
+
+    @classmethod
+    def validate(cls, z: int, x: int, y: int):
+        if not 0 <= z <= cls.MAX_ZOOM:
+            raise ValueError(f"Уровень масштаба должен быть от 0 до {cls.MAX_ZOOM}")
+        n = 1 << z
+        if not (0 <= x < n and 0 <= y < n):
+            raise ValueError("Тайл с такими координатами не существует")
+
+    @classmethod
+    def intersects(cls, bounds: List[List[float]], z: int, x: int, y: int) -> bool:
+        """Пересекает ли тайл границы снимка [[min_lat, min_lon], [max_lat, max_lon]]."""
+        (min_lat, min_lon), (max_lat, max_lon) = bounds
+        west, east, top, bottom = cls.tile_bounds(z, x, y)
+        return (west < max_lon and east > min_lon
+                and bottom < float(AoiMask._mercator_y(max_lat)) and top > float(AoiMask._mercator_y(min_lat)))
+
+    @classmethod
+    def get_layer(cls, cache_key: str) -> Optional[np.ndarray]:
+        with cls._lock:
+            layer = cls._layers.get(cache_key)
+            if layer is not None:
+                cls._layers.move_to_end(cache_key)
+            return layer
+
+    @classmethod
+    def put_layer(cls, cache_key: str, layer: np.ndarray):
+        layer.setflags(write=False)
+        with cls._lock:
+            cls._layers[cache_key] = layer
+            while len(cls._layers) > cls.MAX_CACHED_LAYERS:
+                cls._layers.popitem(last=False)
+
+    @classmethod
+    def get_scene(cls, scene_key: Tuple) -> Optional[Dict]:
+        with cls._lock:
+            scene = cls._scenes.get(scene_key)
+            if scene is not None:
+                cls._scenes.move_to_end(scene_key)
+            return scene
+
+    @classmethod
+    def put_scene(cls, scene_key: Tuple, scene: Dict):
+        with cls._lock:
+            cls._scenes[scene_key] = scene
+            while len(cls._scenes) > cls.MAX_CACHED_SCENES:
+                cls._scenes.popitem(last=False)
+
+    @classmethod
+    def forget_analysis(cls, analysis_id: str):
+        """Убирает из кэша снимки удаленного анализа. Ключ снимка - (user_id, analysis_id, номер снимка)."""
+        with cls._lock:
+            for scene_key in [key for key in cls._scenes if key[1] == analysis_id]:
+                del cls._scenes[scene_key]
+
+    @staticmethod
+    def to_rgba(image: np.ndarray, valid: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Приводит изображение слоя (L, RGB или RGBA) к RGBA. valid - маска пикселей
+        с данными (например, конечные значения индекса); остальные становятся прозрачными.
+        """
+        if image.ndim == 2:
+            rgba = cv2.cvtColor(image, cv2.COLOR_GRAY2RGBA)
+        elif image.shape[2] == 3:
+            rgba = cv2.cvtColor(image, cv2.COLOR_RGB2RGBA)
+        else:
+            rgba = image.copy()
+        if valid is not None:
+            alpha = rgba[:, :, 3]
+            alpha[~valid] = 0
+        return rgba
+
+    @classmethod
+    def cut(cls, layer: np.ndarray, bounds: List[List[float]], z: int, x: int, y: int,
+            interpolation: int = cv2.INTER_NEAREST) -> np.ndarray:
+        """
+        Вырезает тайл z/x/y из RGBA-изображения слоя с границами bounds.
+        Возвращает RGBA-массив TILE_SIZE x TILE_SIZE.
+        """
+        (min_lat, min_lon), (max_lat, max_lon) = bounds
+        h, w = layer.shape[:2]
+        raster_top = float(AoiMask._mercator_y(max_lat))
+        raster_bottom = float(AoiMask._mercator_y(min_lat))
+        west, east, top, bottom = cls.tile_bounds(z, x, y)
+
+        # Обратное отображение: пиксель тайла (i, j) -> координаты пикселя растра.
+        # Используются центры пикселей, поэтому сдвиги на 0.5 с обеих сторон.
+        size = cls.TILE_SIZE
+        sx = (east - west) / size / ((max_lon - min_lon) / w)
+        sy = (top - bottom) / size / ((raster_top - raster_bottom) / h)
+        tx = (west - min_lon) / ((max_lon - min_lon) / w) + 0.5 * sx - 0.5
+        ty = (raster_top - top) / ((raster_top - raster_bottom) / h) + 0.5 * sy - 0.5
+        matrix = np.array([[sx, 0.0, tx], [0.0, sy, ty]], dtype=np.float64)
+
+        # Прозрачность берется из альфа-канала слоя, поэтому цвет и альфа
+        # интерполируются вместе, а за краем растра все каналы равны нулю
+        return cv2.warpAffine(layer, matrix, (size, size), flags=interpolation | cv2.WARP_INVERSE_MAP,
+                              borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0, 0))
+
+    @classmethod
+    def empty_tile(cls) -> np.ndarray:
+        return np.zeros((cls.TILE_SIZE, cls.TILE_SIZE, 4), dtype=np.uint8)
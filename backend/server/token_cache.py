@@ -0,0 +1,77 @@
+# --- START OF FILE token_cache.py ---
+
+import time
+import threading
+import logging
+from collections import OrderedDict
+from typing import Dict, Optional
+from app_config import AppConfig
+
+logger = logging.getLogger(__name__)
+
+class TokenCache:
+    """
+    Кэш токен -> пользователь (ID и профиль) в памяти процесса. Почти каждый запрос
+    начинается с проверки токена, и с кэшем она стоит поиска в словаре вместо
+    запроса к БД. Размер ограничен (вытесняются давно не использованные токены),
+    записи живут ttl_seconds, после чего пользователь перечитывается из БД.
+    При изменении пользователя запись нужно сбросить через invalidate/invalidate_user.
+    Параметры задаются в секции "token_cache" файла конфигурации.
+    """
+    DEFAULT_SETTINGS = {'ttl_seconds': 300, 'max_size': 10000}
+
+    def __init__(self, settings: Dict = None):
+        settings = settings if settings is not None else AppConfig.get_section('token_cache', self.DEFAULT_SETTINGS)
+        self.ttl = float(settings['ttl_seconds'])
+        self.max_size = int(settings['max_size'])
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0, 'invalidated': 0}
+
+    def get(self, token: str) -> Optional[Dict]:
+        """Возвращает {'user_id', 'login', 'first_name', 'last_name'} или None, если токена нет в кэше."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            expires_at, user = entry
+            if expires_at <= now:
+                del self._entries[token]
+                self._stats['expired'] += 1
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(token)
+            self._stats['hits'] += 1
+            return dict(user)
+
+    def put(self, token: str, user: Dict):
+        with self._lock:
+            self._entries[token] = (time.monotonic() + self.ttl, dict(user))
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats['evicted'] += 1
+
+    def invalidate(self, token: str):
+        with self._lock:
+            if self._entries.pop(token, None) is not None:
+                self._stats['invalidated'] += 1
+
+    def invalidate_user(self, user_id: int):
+        """Сбрасывает все токены пользователя (например, после изменения профиля или удаления)."""
+        with self._lock:
+            tokens = [token for token, (_, user) in self._entries.items() if user['user_id'] == user_id]
+            for token in tokens:
+                del self._entries[token]
+            self._stats['invalidated'] += len(tokens)
+
+    def clear(self):
+        with self._lock:
+            self._stats['invalidated'] += len(self._entries)
+            self._entries.clear()
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {**self._stats, 'size': len(self._entries), 'max_size': self.max_size, 'ttl_seconds': self.ttl}
@@ -0,0 +1,47 @@
+# --- START OF FILE worker_pool.py ---
+
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from app_config import AppConfig
+
+logger = logging.getLogger(__name__)
+
+class WorkerPool:
+    """
+    Именованные пулы потоков для тяжелой работы вне event loop FastAPI.
+    Для разных видов задач используются разные пулы, чтобы задача из одного пула
+    могла ждать задачи другого без риска взаимной блокировки.
+    Размеры задаются в секции "worker_pools" файла конфигурации.
+    """
+    DEFAULT_SIZES = {
+        'encode': 4,
+        'render': 2,
+        # Полный анализ: потоки в основном ждут GEE, поэтому пул можно держать больше числа ядер
+        'analysis': 4,
+        # Запросы к SQLite из обработчиков (AsyncDatabaseManager): у каждого потока свое соединение
+        'database': 4,
+    }
+    _pools = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls, name: str) -> ThreadPoolExecutor:
+        """Возвращает пул с указанным именем, создавая его при первом обращении."""
+        pool = cls._pools.get(name)
+        if pool is not None:
+            return pool
+        with cls._lock:
+            if name not in cls._pools:
+                sizes = AppConfig.get_section('worker_pools', cls.DEFAULT_SIZES)
+                max_workers = int(sizes.get(name, 2))
+                cls._pools[name] = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{name}-worker")
+                logger.info(f"Создан пул потоков '{name}' на {max_workers} потоков")
+            return cls._pools[name]
+
+    @classmethod
+    def shutdown(cls):
+        with cls._lock:
+            for pool in cls._pools.values():
+                pool.shutdown(wait=False)
+            cls._pools.clear()
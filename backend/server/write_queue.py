@@ -0,0 +1,186 @@
+# --- START OF FILE write_queue.py ---
+
+import time
+import queue
+import threading
+import logging
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Dict
+from app_config import AppConfig
+
+logger = logging.getLogger(__name__)
+
+class GroupCommitWriter:
+    """
+    Очередь записи в SQLite с групповой фиксацией. Все записи выполняет один поток-писатель:
+    он забирает из очереди накопившиеся за короткое окно записи и выполняет их в одной
+    транзакции, так что fsync и захват блокировки записи SQLite делятся на всю группу,
+    а не платятся каждой записью отдельно.
+    Вызывающий поток ждет, пока транзакция с его записью будет зафиксирована, поэтому
+    после возврата из execute запись уже надежно сохранена. Каждая запись выполняется
+    внутри своей точки сохранения (SAVEPOINT): ошибка одной записи откатывает только ее,
+    остальные записи группы фиксируются.
+    Параметры задаются в секции "write_queue" файла конфигурации.
+    """
+    DEFAULT_SETTINGS = {
+        'enabled': True,
+        # Сколько писатель ждет следующие записи после первой, прежде чем фиксировать группу
+        'window_ms': 2,
+        'max_batch': 64,
+    }
+    # Сколько последних фиксаций учитывается в перцентилях метрик
+    LATENCY_SAMPLES = 1000
+
+    def __init__(self, pool, settings: Dict = None):
+        """pool - ConnectionPool: поток-писатель получает из него собственное соединение."""
+        self.pool = pool
+        self.settings = settings if settings is not None else AppConfig.get_section('write_queue', self.DEFAULT_SETTINGS)
+        self.enabled = bool(self.settings['enabled'])
+        self.window = float(self.settings['window_ms']) / 1000
+        self.max_batch = max(1, int(self.settings['max_batch']))
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {'writes': 0, 'failed': 0, 'batches': 0, 'max_batch': 0, 'commit_errors': 0}
+        self._commit_ms = deque(maxlen=self.LATENCY_SAMPLES)
+        self._batch_sizes = deque(maxlen=self.LATENCY_SAMPLES)
+
+    # --- Интерфейс для вызывающих потоков ---
+
+    def execute(self, write: Callable):
+        """
+        Выполняет write(cursor) в потоке-писателе и ждет фиксации. Возвращает результат write
+        или пробрасывает его исключение. write не должен сам обращаться к очереди записи.
+        """
+        if not self.enabled:
+            return self._execute_direct(write)
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("Запись из потока-писателя в собственную очередь приведет к взаимной блокировке")
+        self._ensure_started()
+        future = Future()
+        self._queue.put((write, future))
+        return future.result()
+
+    def _execute_direct(self, write: Callable):
+        """Без очереди: отдельная транзакция на соединении вызывающего потока."""
+        conn = self.pool.get()
+        with conn:
+            return write(conn.cursor())
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+
+    def close(self):
+        """Дожидается записи всех поставленных в очередь данных и останавливает писателя."""
+        with self._start_lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and thread.is_alive():
+            self._queue.put(None)
+            thread.join()
+
+    # --- Поток-писатель ---
+
+    def _collect_batch(self, first) -> list:
+        batch = [first]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # Остановка: сначала фиксируем уже собранное
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        logger.info("Запущен поток групповой записи в БД")
+        conn = self.pool.get()
+        while True:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch = self._collect_batch(first)
+            self._commit_batch(conn, batch)
+        logger.info("Поток групповой записи в БД остановлен")
+
+    def _commit_batch(self, conn, batch: list):
+        started = time.perf_counter()
+        results = []
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            for write, future in batch:
+                cursor.execute('SAVEPOINT write_item')
+                try:
+                    results.append((future, True, write(cursor)))
+                    cursor.execute('RELEASE write_item')
+                except Exception as e:
+                    cursor.execute('ROLLBACK TO write_item')
+                    cursor.execute('RELEASE write_item')
+                    results.append((future, False, e))
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Ошибка групповой фиксации ({len(batch)} записей): {e}")
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            with self._stats_lock:
+                self._stats['commit_errors'] += 1
+                self._stats['failed'] += len(batch)
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        failed = sum(1 for _, ok, _ in results if not ok)
+        with self._stats_lock:
+            self._stats['batches'] += 1
+            self._stats['writes'] += len(batch) - failed
+            self._stats['failed'] += failed
+            self._stats['max_batch'] = max(self._stats['max_batch'], len(batch))
+            self._commit_ms.append(elapsed_ms)
+            self._batch_sizes.append(len(batch))
+        for future, ok, value in results:
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    # --- Метрики ---
+
+    @staticmethod
+    def _percentile(values, fraction: float) -> float:
+        if not values:
+            return 0.0
+        ordered = sorted(values)
+        return float(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))])
+
+    def get_stats(self) -> Dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+            commit_ms = list(self._commit_ms)
+            batch_sizes = list(self._batch_sizes)
+        stats.update({
+            'enabled': self.enabled,
+            'queued': self._queue.qsize(),
+            'avg_batch': round(sum(batch_sizes) / len(batch_sizes), 2) if batch_sizes else 0.0,
+            'commit_ms_avg': round(sum(commit_ms) / len(commit_ms), 3) if commit_ms else 0.0,
+            'commit_ms_p50': round(self._percentile(commit_ms, 0.5), 3),
+            'commit_ms_p95': round(self._percentile(commit_ms, 0.95), 3),
+            'commit_ms_max': round(max(commit_ms), 3) if commit_ms else 0.0,
+            'window_ms': self.window * 1000,
+            'max_batch_size': self.max_batch,
+        })
+        return stats
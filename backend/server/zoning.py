@@ -0,0 +1,85 @@
+# --- START OF FILE zoning.py ---
+
+import logging
+from typing import Dict, List
+import numpy as np
+from app_config import AppConfig
+
+logger = logging.getLogger(__name__)
+
+class ZoningEngine:
+    """
+    Зонирование карт вегетационных индексов и построение гистограмм.
+    Зоны задаются упорядоченными порогами (N порогов -> N+1 зона), пиксель
+    попадает в зону за один проход np.digitize + np.bincount.
+    Пороги для каждого индекса можно переопределить в секции "zoning"
+    файла конфигурации, например:
+        {"zoning": {"ndvi": {"thresholds": [0.2, 0.5], "labels": ["low", "medium", "high"]}}}
+    """
+    DEFAULT_ZONES = {
+        'ndvi': {'thresholds': [0.2, 0.5], 'labels': ['low', 'medium', 'high']},
+        'savi': {'thresholds': [0.15, 0.4], 'labels': ['low', 'medium', 'high']},
+        'vari': {'thresholds': [0.0, 0.2], 'labels': ['low', 'medium', 'high']},
+        'evi': {'thresholds': [0.2, 0.5], 'labels': ['low', 'medium', 'high']},
+    }
+    # Фиксированные диапазоны гистограмм, чтобы распределения разных снимков были сравнимы
+    DEFAULT_HISTOGRAM = {
+        'bins': 20,
+        'ranges': {'ndvi': [-1.0, 1.0], 'savi': [-1.5, 1.5], 'vari': [-1.0, 1.0], 'evi': [-1.0, 1.0]}
+    }
+
+    def __init__(self, zones_config: Dict = None, histogram_config: Dict = None):
+        zones_config = zones_config if zones_config is not None else AppConfig.get_section('zoning', self.DEFAULT_ZONES)
+        histogram_config = histogram_config if histogram_config is not None else AppConfig.get_section('histogram', self.DEFAULT_HISTOGRAM)
+
+        self.zones = {}
+        for index_name, zone_def in zones_config.items():
+            thresholds = sorted(float(t) for t in zone_def.get('thresholds', []))
+            labels = zone_def.get('labels') or [f'zone_{i}' for i in range(len(thresholds) + 1)]
+            if len(labels) != len(thresholds) + 1:
+                raise ValueError(f"Для индекса {index_name} число меток зон должно быть на 1 больше числа порогов.")
+            self.zones[index_name] = {'thresholds': np.asarray(thresholds, dtype=np.float32), 'labels': list(labels)}
+
+        self.histogram_bins = int(histogram_config.get('bins', self.DEFAULT_HISTOGRAM['bins']))
+        self.histogram_ranges = {**self.DEFAULT_HISTOGRAM['ranges'], **histogram_config.get('ranges', {})}
+
+    def calculate_zones(self, index_name: str, values: np.ndarray) -> Dict[str, float]:
+        """Возвращает процент пикселей в каждой зоне. values - только валидные (конечные) значения."""
+        zone_def = self.zones.get(index_name)
+        if zone_def is None:
+            return {}
+        labels = zone_def['labels']
+        if values.size == 0:
+            return {label: 0 for label in labels}
+
+        zone_idx = np.digitize(values, zone_def['thresholds'])
+        counts = np.bincount(zone_idx, minlength=len(labels))
+        percentages = counts * (100.0 / values.size)
+        return {label: round(float(p), 2) for label, p in zip(labels, percentages)}
+
+    def calculate_histogram(self, index_name: str, values: np.ndarray) -> Dict:
+        """Гистограмма с фиксированными корзинами; значения вне диапазона попадают в крайние корзины."""
+        lower, upper = self.histogram_ranges.get(index_name, [-1.0, 1.0])
+        bins = self.histogram_bins
+        if values.size == 0:
+            counts = np.zeros(bins, dtype=np.int64)
+        else:
+            bin_idx = ((values - lower) * (bins / (upper - lower))).astype(np.int64)
+            np.clip(bin_idx, 0, bins - 1, out=bin_idx)
+            counts = np.bincount(bin_idx, minlength=bins)
+        return {'min': float(lower), 'max': float(upper), 'bins': bins, 'counts': counts.tolist()}
+
+    def analyze(self, index_name: str, index_map: np.ndarray) -> Dict:
+        """Считает зоны и гистограмму по одной выборке валидных пикселей."""
+        return self.analyze_values(index_name, index_map[np.isfinite(index_map)])
+
+    def analyze_values(self, index_name: str, values: np.ndarray) -> Dict:
+        """То же, что analyze, для уже отобранных валидных значений."""
+        return {
+            'zones': self.calculate_zones(index_name, values),
+            'histogram': self.calculate_histogram(index_name, values)
+        }
+
+    def get_thresholds(self, index_name: str) -> List[float]:
+        zone_def = self.zones.get(index_name)
+        return zone_def['thresholds'].tolist() if zone_def else []
@@ -4,6 +4,7 @@ import time
 import random
 import logging
 import base64
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from PIL import Image
 
@@ -203,6 +204,110 @@ class ServerTester:
         logger.info("✓ Все операции с анализом прошли успешно.")
         return True
 
+    def test_concurrent_analysis(self):
+        """
+        Одновременные одинаковые запросы анализа выполняются один раз, но ответ
+        должны получить все вызывающие, а не только ведущий запрос.
+        """
+        self._start_test("Одновременные одинаковые анализы (/analysis/perform)")
+        token = self.test_user_data.get("token")
+        end_date = time.strftime("%Y-%m-%d")
+        start_date = time.strftime("%Y-%m-%d", time.gmtime(time.time() - 60*24*60*60))
+        params = {"token": token, "lon": 37.6173, "lat": 55.7558, "start_date": start_date,
+                  "end_date": end_date, "use_cache": "false"}
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            responses = list(executor.map(lambda _: self.make_request("/analysis/perform", method="POST", params=params), range(3)))
+
+        details = [r.json().get("detail", "") if r is not None else "No response" for r in responses]
+        if any("Не найдено чистых снимков" in d for d in details):
+            logger.warning("⚠ Тест пропущен: не найдено подходящих снимков в GEE.")
+            return "skipped"
+        if not all(r is not None and r.status_code == 200 and r.json().get("status") == "success" for r in responses):
+            logger.error(f"✗ Не все одновременные запросы завершились успешно: {details}")
+            return False
+
+        analysis_ids = {r.json().get("analysis_id") for r in responses}
+        logger.info(f"✓ Все 3 запроса успешны; объединено: {sum(1 for r in responses if r.json().get('coalesced'))}.")
+        for analysis_id in analysis_ids:
+            self.make_request(f"/analysis/{analysis_id}", method="DELETE", params={"token": token})
+        return True
+
+    def _get_user_keys(self, token):
+        """Текущие ключи пользователя (множество) и версия его данных, или (None, None)."""
+        response = self.make_request("/givefield", params={"token": token})
+        if not (response and response.status_code == 200 and response.json().get("status") == "success"):
+            return None, None
+        data = response.json()
+        keys = data.get("keys") or ""
+        return {key for key in keys.split(",") if key}, data.get("version")
+
+    def test_concurrent_data_edit(self):
+        """
+        Одновременные изменения данных пользователя (/data/edit) применяются к свежим данным,
+        поэтому ни одно добавление ключа не теряется.
+        """
+        self._start_test("Одновременные изменения данных пользователя (/data/edit)")
+        token = self.test_user_data.get("token")
+        resp_save = self.make_request("/savedata", method="POST", params={"token": token, "key_array": "base"})
+        if not (resp_save and resp_save.status_code == 200 and resp_save.json().get("status") == "success"):
+            logger.error("✗ Провал на этапе сохранения исходных данных.")
+            return False
+
+        new_keys = [f"key{i}" for i in range(10)]
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            responses = list(executor.map(
+                lambda key: self.make_request("/data/edit", method="PATCH", params={"token": token, "keys_to_add": key}),
+                new_keys))
+        if not all(r is not None and r.status_code == 200 and r.json().get("status") == "success" for r in responses):
+            details = [r.json().get("detail", "") if r is not None else "No response" for r in responses]
+            logger.error(f"✗ Не все одновременные изменения завершились успешно: {details}")
+            return False
+
+        keys, _ = self._get_user_keys(token)
+        expected = set(new_keys) | {"base"}
+        if keys != expected:
+            logger.error(f"✗ Потеряны ключи: {sorted(expected - (keys or set()))}")
+            return False
+        logger.info(f"✓ Все {len(new_keys)} одновременных изменений сохранены.")
+        return True
+
+    def test_stale_version_rejected(self):
+        """Изменение с устаревшей версией (/data/update, /data/edit) отклоняется ответом о конфликте."""
+        self._start_test("Отклонение изменения с устаревшей версией (/data/update, /data/edit)")
+        token = self.test_user_data.get("token")
+        _, version = self._get_user_keys(token)
+        if version is None:
+            logger.error("✗ Не удалось получить версию данных пользователя.")
+            return False
+
+        resp_update = self.make_request("/data/update", method="PUT", params={"token": token, "key_array": "a,b", "version": version})
+        if not (resp_update and resp_update.status_code == 200 and resp_update.json().get("status") == "success"):
+            logger.error("✗ Провал изменения с актуальной версией.")
+            return False
+        current_version = resp_update.json().get("version")
+
+        # Оба запроса передают версию, прочитанную до предыдущего изменения
+        stale_requests = [
+            ("/data/update", "PUT", {"token": token, "key_array": "c", "version": version}),
+            ("/data/edit", "PATCH", {"token": token, "keys_to_add": "d", "version": version}),
+        ]
+        for endpoint, method, params in stale_requests:
+            response = self.make_request(endpoint, method=method, params=params)
+            data = response.json() if response is not None and response.status_code == 200 else {}
+            if not (data.get("status") == "error" and data.get("version") == current_version
+                    and set(data.get("keys", "").split(",")) == {"a", "b"}):
+                logger.error(f"✗ {endpoint} с устаревшей версией не отклонен ответом о конфликте: {data}")
+                return False
+            logger.info(f"✓ {endpoint} с устаревшей версией отклонен, в ответе актуальные данные и версия.")
+
+        keys, final_version = self._get_user_keys(token)
+        if keys != {"a", "b"} or final_version != current_version:
+            logger.error(f"✗ Отклоненные изменения записаны: ключи {keys}, версия {final_version}.")
+            return False
+        logger.info("✓ Данные не изменились после отклоненных запросов.")
+        return True
+
     def test_get_all_users_admin(self):
         self._start_test("Получение списка всех пользователей (админ, /users/all)")
         response = self.make_request("/users/all", params={"password": "12345"})
@@ -266,12 +371,15 @@ class ServerTester:
                 # Тесты, требующие валидного токена
                 self.results["get_user_profile"] = self.test_get_user_profile()
                 self.results["saved_fields_operations"] = self.test_saved_fields_operations()
+                self.results["concurrent_data_edit"] = self.test_concurrent_data_edit()
+                self.results["stale_version_rejected"] = self.test_stale_version_rejected()
                 
                 analysis_result = self.test_analysis_operations()
                 if analysis_result == "skipped":
                     self.results["analysis_operations"] = "skipped"
                 else:
                     self.results["analysis_operations"] = analysis_result
+                    self.results["concurrent_analysis"] = self.test_concurrent_analysis()
                     
             else:
                 self.results["user_login"] = False
@@ -22,9 +22,9 @@ class AnalysisWorker(QThread):
     error = Signal(str)
     progress = Signal(str)
 
-    def __init__(self, make_request_func, field_name, lat, lng, token):
+    def __init__(self, stream_request_func, field_name, lat, lng, token):
         super().__init__()
-        self.make_request_func = make_request_func
+        self.stream_request_func = stream_request_func
         self.field_name = field_name
         self.lat = lat
         self.lng = lng
@@ -40,17 +40,24 @@ class AnalysisWorker(QThread):
 
             self.progress.emit("Отправляем запрос на сервер...")
 
-            # Выполняем запрос
-            response = self.make_request_func(
-                "/analysis/perform",
-                method="POST",
+            # Сервер передает прогресс по мере обработки снимков, поэтому таймаут
+            # ограничивает паузу между событиями, а не длительность всего анализа
+            response = None
+            for event in self.stream_request_func(
+                "/analysis/perform/stream",
                 params={
                     "lon": self.lng,
                     "lat": self.lat,
                     "start_date": start_date,
                     "end_date": end_date
                 }
-            )
+            ):
+                if event.get("event") == "started":
+                    self.progress.emit(f"Найдено снимков: {event.get('total_scenes', 0)}")
+                elif event.get("event") in ("scene", "scene_skipped"):
+                    self.progress.emit(f"Обработано снимков: {event.get('processed')} из {event.get('total_scenes')}")
+                elif event.get("event") in ("completed", "error"):
+                    response = event
 
             if response and response.get("status") == "success":
                 self.progress.emit("Анализ успешно завершен!")
@@ -383,6 +390,35 @@ class MainWindow(QMainWindow):
             print(f"JSON decode error for {url}: {e}")
             return None
 
+    def make_server_stream_request(self, endpoint, params=None):
+        """Выполняет POST-запрос к потоковому эндпоинту и возвращает события NDJSON по мере их поступления"""
+        if not self.user_token:
+            print("Токен не установлен")
+            return
+
+        base_url = "https://localhost:8000"
+        url = f"{base_url}{endpoint}"
+        try:
+            session = requests.Session()
+            session.verify = False
+
+            params = dict(params or {})
+            params.setdefault('token', self.user_token)
+
+            # (таймаут соединения, максимальная пауза между событиями)
+            with session.post(url, params=params, stream=True, timeout=(10, 120)) as response:
+                if response.status_code != 200:
+                    print(f"HTTP Error {response.status_code} for {url}: {response.text}")
+                    return
+                for line in response.iter_lines(decode_unicode=True):
+                    if line:
+                        yield json.loads(line)
+
+        except requests.exceptions.RequestException as e:
+            print(f"Request error for {url}: {e}")
+        except json.JSONDecodeError as e:
+            print(f"JSON decode error for {url}: {e}")
+
     def load_user_fields_from_server(self):
         """Асинхронно загружает поля пользователя с сервера"""
         if not self.user_token:
@@ -573,7 +609,7 @@ class MainWindow(QMainWindow):
         self.progress_dialog.show()
 
         # Запускаем асинхронный анализ
-        self.analysis_worker = AnalysisWorker(self.make_server_request, field_name, lat, lng, self.user_token)
+        self.analysis_worker = AnalysisWorker(self.make_server_stream_request, field_name, lat, lng, self.user_token)
         self.analysis_worker.finished.connect(self.on_analysis_finished)
         self.analysis_worker.error.connect(self.on_analysis_error)
         self.analysis_worker.progress.connect(self.on_analysis_progress)
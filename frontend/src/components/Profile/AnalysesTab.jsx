@@ -1,6 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import { getCookie } from '../../utils/cookies';
-import { getAnalysisList, getAnalysisById, getAnalysisRecommendations } from '../../utils/fetch';
+import { getAnalysisList, getAnalysisById, getAnalysisRecommendations, getImageSrc } from '../../utils/fetch';
 import MapOverlay from './MapOverlay';
 
 function AnalysesTab() {
@@ -8,6 +8,8 @@ function AnalysesTab() {
   const [selectedAnalysis, setSelectedAnalysis] = useState(null);
   const [recommendations, setRecommendations] = useState(null);
   const [loading, setLoading] = useState(true);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [loadingDetails, setLoadingDetails] = useState(false);
   const [error, setError] = useState('');
 
@@ -29,10 +31,10 @@ function AnalysesTab() {
         console.log('AnalysesTab: Данные списка анализов получены', { status: data.status, count: data.analyses?.length });
         
         if (data.status === 'success') {
-          // Сортируем анализы по дате (новые сверху)
-          const sortedAnalyses = (data.analyses || []).sort((a, b) => b.timestamp - a.timestamp);
-          setAnalysesList(sortedAnalyses);
-          console.log('AnalysesTab: Список анализов обновлен', { count: sortedAnalyses.length });
+          // Сервер отдает анализы страницами, уже отсортированными по дате (новые сверху)
+          setAnalysesList(data.analyses || []);
+          setNextCursor(data.next_cursor || null);
+          console.log('AnalysesTab: Список анализов обновлен', { count: data.analyses?.length, hasMore: !!data.next_cursor });
         } else {
           setError('Ошибка при загрузке списка анализов');
           console.error('AnalysesTab: Ошибка в статусе ответа списка анализов', data);
@@ -49,6 +51,33 @@ function AnalysesTab() {
     }
   };
 
+  // Загрузка следующей страницы списка анализов
+  const loadMoreAnalyses = async () => {
+    if (!nextCursor) return;
+    console.log('AnalysesTab: Загрузка следующей страницы анализов');
+    try {
+      setLoadingMore(true);
+      const token = getCookie('token');
+      const response = await getAnalysisList(token, { cursor: nextCursor });
+      if (response.ok) {
+        const data = await response.json();
+        if (data.status === 'success') {
+          setAnalysesList(prev => [...prev, ...(data.analyses || [])]);
+          setNextCursor(data.next_cursor || null);
+          console.log('AnalysesTab: Добавлена страница анализов', { count: data.analyses?.length, hasMore: !!data.next_cursor });
+        } else {
+          console.error('AnalysesTab: Ошибка в статусе ответа следующей страницы', data);
+        }
+      } else {
+        console.error('AnalysesTab: Ошибка HTTP при загрузке следующей страницы', response.status);
+      }
+    } catch (error) {
+      console.error('AnalysesTab: Исключение при загрузке следующей страницы:', error);
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
   useEffect(() => {
     loadAnalyses();
   }, []);
@@ -191,6 +220,16 @@ function AnalysesTab() {
                 </div>
               </div>
             ))}
+            {nextCursor && (
+              <button
+                onClick={loadMoreAnalyses}
+                disabled={loadingMore}
+                className="w-full p-3 md:p-4 rounded-lg md:rounded-xl border-2 border-gray-200 hover:border-gray-300
+                text-base md:text-lg text-gray-600 cursor-pointer transition-all disabled:opacity-50"
+              >
+                {loadingMore ? 'Загрузка...' : 'Показать еще'}
+              </button>
+            )}
           </div>
         </div>
 
@@ -321,6 +360,11 @@ function AnalysisDetails({ analysis, recommendations }) {
               imageData={selectedImageData}
               bounds={selectedImageBounds}
               imageType={selectedMapType}
+              tileLayer={analysis.results_per_image[0].raster ? {
+                analysisId: analysis.analysis_id,
+                sceneIndex: 0,
+                layer: selectedMapType === 'ndvi_overlay_image' ? 'ndvi_overlay' : 'problem_zones'
+              } : null}
             />
           </div>
           
@@ -403,11 +447,11 @@ function AnalysisImages({ images }) {
 
   return (
     <div className="grid grid-cols-1 md:grid-cols-2 gap-3 md:gap-4 lg:gap-5">
-      {Object.entries(images).map(([type, base64Data]) => (
+      {Object.entries(images).map(([type, image]) => (
         <div key={type} className="text-center">
           <div className="font-medium text-lg md:text-xl mb-2 md:mb-3 capitalize">{type}</div>
           <img 
-            src={`data:image/png;base64,${base64Data}`} 
+            src={getImageSrc(image, getCookie('token'))} 
             alt={type}
             className="w-full h-40 md:h-52 object-cover rounded-lg border border-gray-200"
           />
@@ -1,6 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import { getCookie } from '../../utils/cookies';
-import { performAnalysis, getAnalysisList, getAnalysisById, getAnalysisRecommendations } from '../../utils/fetch';
+import { performAnalysis, getAnalysisList, getAnalysisById, getAnalysisRecommendations, getImageSrc } from '../../utils/fetch';
 
 function FieldDetailsOverlay({ isVisible, onClose, field }) {
   const [currentAnalysis, setCurrentAnalysis] = useState(null);
@@ -492,11 +492,11 @@ function AnalysisImages({ images }) {
 
   return (
     <div className="grid grid-cols-1 md:grid-cols-2 gap-5">
-      {Object.entries(images).map(([type, base64Data]) => (
+      {Object.entries(images).map(([type, image]) => (
         <div key={type} className="text-center">
           <div className="font-medium text-xl mb-3 capitalize">{type}</div>
           <img 
-            src={`data:image/png;base64,${base64Data}`} 
+            src={getImageSrc(image, getCookie('token'))} 
             alt={type}
             className="w-full h-52 object-cover rounded-lg border border-gray-200"
           />
@@ -11,8 +11,10 @@ import { getWidth } from 'ol/extent';
 import ScaleLine from 'ol/control/ScaleLine';
 import Zoom from 'ol/control/Zoom';
 import FullScreen from 'ol/control/FullScreen';
+import { getCookie } from '../../utils/cookies';
+import { getImageSrc, getTileUrlTemplate } from '../../utils/fetch';
 
-function MapOverlay({ imageData, bounds, imageType }) {
+function MapOverlay({ imageData, bounds, imageType, tileLayer }) {
   const mapRef = useRef(null);
   const mapInstance = useRef(null);
   const [tileSource, setTileSource] = useState('osm');
@@ -59,10 +61,22 @@ function MapOverlay({ imageData, bounds, imageType }) {
 
     // Преобразуем bounds в EPSG:3857
     const imageExtent = transformExtent(bounds.flat(), 'EPSG:4326', 'EPSG:3857');
+
+    // Если сервер хранит растр снимка, загружаем только видимые тайлы нужного масштаба
+    if (tileLayer) {
+      return new TileLayer({
+        source: new XYZ({
+          url: getTileUrlTemplate(tileLayer.analysisId, tileLayer.sceneIndex, tileLayer.layer, getCookie('token')),
+          maxZoom: 18
+        }),
+        extent: imageExtent,
+        opacity: 0.8
+      });
+    }
     
     return new ImageLayer({
       source: new ImageStatic({
-        url: `data:image/png;base64,${imageData}`,
+        url: getImageSrc(imageData, getCookie('token')),
         imageExtent: imageExtent,
         projection: 'EPSG:3857'
       }),
@@ -132,7 +146,7 @@ function MapOverlay({ imageData, bounds, imageType }) {
     }
 
     mapInstance.current.updateSize();
-  }, [imageData, bounds, imageType]);
+  }, [imageData, bounds, imageType, tileLayer?.analysisId, tileLayer?.sceneIndex, tileLayer?.layer]);
 
   // Обновление базового слоя
   useEffect(() => {
@@ -105,14 +105,36 @@ async function performAnalysis(token, startDate, endDate, options) {
     return fetch(url, { method: 'POST' });
 }
 
-async function getAnalysisList(token) {
-    return fetch(`${API_BASE}/analysis/list?token=${encodeURIComponent(token)}`);
+async function getAnalysisList(token, options = {}) {
+    let url = `${API_BASE}/analysis/list?token=${encodeURIComponent(token)}`;
+    if (options.cursor) {
+        url += `&cursor=${encodeURIComponent(options.cursor)}`;
+    }
+    if (options.limit) {
+        url += `&limit=${encodeURIComponent(options.limit)}`;
+    }
+    return fetch(url);
 }
 
 async function getAnalysisById(analysisId, token) {
     return fetch(`${API_BASE}/analysis/${encodeURIComponent(analysisId)}?token=${encodeURIComponent(token)}`);
 }
 
+// Изображения анализа хранятся на сервере отдельно и приходят ссылками
+// (готовое изображение или слой, который строится при первом запросе);
+// старые анализы могут содержать base64-строки
+function getImageSrc(image, token) {
+    if (!image) return null;
+    if (typeof image === 'string') return `data:image/png;base64,${image}`;
+    const path = image.url.replace(/^\/api/, '');
+    return `${API_BASE}${path}?token=${encodeURIComponent(token)}`;
+}
+
+// Шаблон URL тайлов слоя снимка для источника XYZ (OpenLayers подставит {z}/{x}/{y})
+function getTileUrlTemplate(analysisId, sceneIndex, layer, token) {
+    return `${API_BASE}/tiles/${encodeURIComponent(analysisId)}/${sceneIndex}/${layer}/{z}/{x}/{y}.png?token=${encodeURIComponent(token)}`;
+}
+
 async function deleteAnalysis(analysisId, token) {
     return fetch(`${API_BASE}/analysis/${encodeURIComponent(analysisId)}?token=${encodeURIComponent(token)}`, {
         method: 'DELETE'
@@ -134,14 +156,17 @@ async function getUserData(token) {
     return fetch(`${API_BASE}/givefield?token=${encodeURIComponent(token)}`);
 }
 
-async function updateUserData(token, newKeyArray) {
-    return fetch(`${API_BASE}/data/update?token=${encodeURIComponent(token)}&key_array=${encodeURIComponent(JSON.stringify(newKeyArray))}`, {
+// version - версия из getUserData: изменение выполнится, только если данные с тех пор не менялись
+async function updateUserData(token, newKeyArray, version = null) {
+    const versionParam = version !== null ? `&version=${version}` : '';
+    return fetch(`${API_BASE}/data/update?token=${encodeURIComponent(token)}&key_array=${encodeURIComponent(JSON.stringify(newKeyArray))}${versionParam}`, {
         method: 'PUT'
     });
 }
 
-async function partialUpdateUserData(token, keysToAdd = [], keysToRemove = []) {
-    return fetch(`${API_BASE}/data/edit?token=${encodeURIComponent(token)}&keys_to_add=${encodeURIComponent(JSON.stringify(keysToAdd))}&keys_to_remove=${encodeURIComponent(JSON.stringify(keysToRemove))}`, {
+async function partialUpdateUserData(token, keysToAdd = [], keysToRemove = [], version = null) {
+    const versionParam = version !== null ? `&version=${version}` : '';
+    return fetch(`${API_BASE}/data/edit?token=${encodeURIComponent(token)}&keys_to_add=${encodeURIComponent(JSON.stringify(keysToAdd))}&keys_to_remove=${encodeURIComponent(JSON.stringify(keysToRemove))}${versionParam}`, {
         method: 'PATCH'
     });
 }
@@ -205,6 +230,8 @@ export {
     performAnalysis,
     getAnalysisList,
     getAnalysisById,
+    getImageSrc,
+    getTileUrlTemplate,
     deleteAnalysis,
     getAnalysisRecommendations,
     saveUserData,